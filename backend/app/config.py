@@ -14,11 +14,42 @@ class Settings(BaseSettings):
     tmdb_api_key: str = ""
     tmdb_base_url: str = "https://api.themoviedb.org/3"
     tmdb_image_base_url: str = "https://image.tmdb.org/t/p"
+    tmdb_timeout: float = 30.0  # 请求超时（秒）
+    tmdb_max_connections: int = 20  # 连接池最大连接数
+    tmdb_max_keepalive_connections: int = 10  # 最大保持活动连接数
+    tmdb_rate_limit: float = 40.0  # 每秒允许的请求数，0 表示不限制
+    tmdb_rate_burst: int = 40  # 令牌桶容量（允许的突发请求数）
+    tmdb_max_retries: int = 3  # 429/5xx 最大重试次数
+    tmdb_retry_backoff: float = 0.5  # 重试退避基数（秒）
+    tmdb_max_concurrency: int = 10  # 批量获取详情时的最大并发请求数
+    
+    # TMDB 响应缓存配置
+    tmdb_cache_enabled: bool = True  # 是否启用 TMDB 响应缓存
+    tmdb_cache_memory_size: int = 2000  # 内存 LRU 缓存条目数
+    tmdb_cache_detail_ttl: int = 7 * 86400  # 详情类数据缓存时间（秒）
+    tmdb_cache_airing_ttl: int = 6 * 3600  # 有下一集播出信息的剧集缓存时间（秒）
+    tmdb_cache_list_ttl: int = 3600  # 趋势/热门/发现等列表缓存时间（秒）
+    tmdb_cache_stale_seconds: int = 86400  # 过期后仍可返回旧数据并后台刷新的时间（秒）
     
     # 应用配置
     secret_key: str = "change-this-secret-key"
     database_url: str = "sqlite+aiosqlite:///./data/emby_tracker.db"
     
+    # 数据库连接配置
+    db_pool_size: int = 5  # 连接池常驻连接数
+    db_max_overflow: int = 10  # 连接池允许额外创建的连接数
+    db_pool_timeout: int = 30  # 获取连接的等待时间（秒）
+    db_pool_recycle: int = 3600  # 连接最长使用时间（秒）
+    
+    # SQLite 性能配置（每个连接建立时设置）
+    sqlite_wal: bool = True  # 使用 WAL 日志模式，写入时不阻塞读取
+    sqlite_synchronous: str = "NORMAL"  # WAL 模式下 NORMAL 足够安全且写入更快
+    sqlite_cache_size_mb: int = 64  # 每个连接的页缓存大小（MB）
+    sqlite_mmap_size_mb: int = 256  # 内存映射 I/O 大小（MB），0 表示禁用
+    sqlite_temp_store_memory: bool = True  # 临时表和排序使用内存
+    sqlite_busy_timeout_ms: int = 10000  # 数据库被锁定时的等待时间（毫秒）
+    sqlite_maintenance_minutes: int = 60  # 定时执行 PRAGMA optimize 和 WAL checkpoint 的间隔（分钟），0 表示禁用
+    
     # 管理员账户配置
     admin_username: str = "admin"
     admin_password: str = "admin123"
@@ -26,6 +57,34 @@ class Settings(BaseSettings):
     # 同步配置
     sync_interval_minutes: int = 30  # 定时同步间隔（分钟），0 表示禁用
     sync_on_startup: bool = True  # 启动时是否自动同步
+    sync_full_interval_hours: int = 24  # 全量对账间隔（小时），其余同步只获取新的播放记录
+    sync_max_concurrent_users: int = 4  # 同时同步的最大用户数
+    sync_page_concurrency: int = 4  # 同步时并发获取的分页数
+    series_cache_size: int = 5000  # 剧集信息缓存条目数
+    series_cache_ttl_hours: int = 72  # 剧集信息缓存时间（小时）
+    series_tree_cache_size: int = 500  # 剧集季/集结构缓存条目数
+    series_tree_cache_ttl_seconds: int = 1800  # 剧集季/集结构缓存时间（秒）
+    progress_max_concurrency: int = 8  # 计算剧集进度时并发处理的剧集数
+    library_counts_ttl_seconds: int = 300  # 媒体库数量快照缓存时间（秒）
+    
+    # 播出日程配置
+    airing_refresh_minutes: int = 60  # 播出日程后台刷新间隔（分钟），0 表示禁用
+    airing_max_age_hours: int = 24  # 播出信息最长多久必须重新从 TMDB 获取（小时）
+    calendar_ical_days: int = 30  # iCal 导出未来多少天的日程
+    calendar_movie_max_pages: int = 5  # 电影日历最多获取的 discover 页数（并发获取）
+    calendar_movie_cache_size: int = 100  # 电影日历按日期范围缓存的条目数
+    
+    # 导出配置
+    export_batch_size: int = 1000  # 流式导出时每批读取的记录数
+    import_batch_size: int = 1000  # 导入时每批写入（并提交）的记录数
+    
+    # Emby HTTP 连接池配置
+    emby_timeout: float = 30.0  # 请求超时（秒）
+    emby_max_connections: int = 20  # 连接池最大连接数
+    emby_max_keepalive_connections: int = 10  # 最大保持活动连接数
+    emby_keepalive_expiry: float = 30.0  # 空闲连接保持时间（秒）
+    emby_http2: bool = False  # 是否启用 HTTP/2
+    emby_max_concurrency_per_host: int = 10  # 单个主机的最大并发请求数
     
     # 调试配置
     debug: bool = False
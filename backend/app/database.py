@@ -1,20 +1,66 @@
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.orm import DeclarativeBase
-from sqlalchemy import text
+from sqlalchemy import select, text, event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+import asyncio
+import logging
 from app.config import get_settings
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_maintenance_task = None
 
 # 处理 SQLite URL
 database_url = settings.database_url
 if database_url.startswith("sqlite:///"):
     database_url = database_url.replace("sqlite:///", "sqlite+aiosqlite:///")
 
+is_sqlite = database_url.startswith("sqlite")
+is_memory = is_sqlite and (":memory:" in database_url or database_url.rstrip("/").endswith(":"))
+
+# 文件数据库使用连接池复用连接（aiosqlite 默认每次新建连接，PRAGMA 也要重新执行）；
+# 内存数据库使用单连接的连接池，不支持连接池参数
+pool_options = {} if is_memory else {
+    "poolclass": AsyncAdaptedQueuePool,
+    "pool_size": settings.db_pool_size,
+    "max_overflow": settings.db_max_overflow,
+    "pool_timeout": settings.db_pool_timeout,
+    "pool_recycle": settings.db_pool_recycle,
+}
+
 engine = create_async_engine(
     database_url,
     echo=settings.debug,
+    **pool_options,
 )
 
+
+def _sqlite_pragmas() -> list[str]:
+    """每个 SQLite 连接建立时执行的 PRAGMA"""
+    pragmas = [
+        f"busy_timeout = {settings.sqlite_busy_timeout_ms}",
+        f"synchronous = {settings.sqlite_synchronous}",
+        f"cache_size = -{settings.sqlite_cache_size_mb * 1024}",  # 负数表示 KB
+        f"mmap_size = {settings.sqlite_mmap_size_mb * 1024 * 1024}",
+    ]
+    if settings.sqlite_wal and not is_memory:
+        pragmas.insert(1, "journal_mode = WAL")
+    if settings.sqlite_temp_store_memory:
+        pragmas.append("temp_store = MEMORY")
+    return pragmas
+
+
+if is_sqlite:
+    @event.listens_for(engine.sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in _sqlite_pragmas():
+                cursor.execute(f"PRAGMA {pragma}")
+        finally:
+            cursor.close()
+
 async_session_maker = async_sessionmaker(
     engine,
     class_=AsyncSession,
@@ -34,19 +80,166 @@ async def get_db():
             await session.close()
 
 
+async def _column_exists(conn, table: str, column: str) -> bool:
+    result = await conn.execute(text(f"PRAGMA table_info({table})"))
+    return any(row[1] == column for row in result.all())
+
+
+async def _add_column(conn, table: str, column: str, ddl: str):
+    """添加列（已存在时跳过）"""
+    if not await _column_exists(conn, table, column):
+        await conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        print(f"Added {column} column to {table} table")
+
+
+async def _migration_watch_history_poster_path(conn):
+    await _add_column(conn, "watch_history", "poster_path", "VARCHAR(500)")
+
+
+async def _migration_media_cache_key(conn):
+    # TMDB 响应缓存的键和过期时间
+    await _add_column(conn, "media_cache", "cache_key", "VARCHAR(500)")
+    await _add_column(conn, "media_cache", "expires_at", "DATETIME")
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_media_cache_cache_key ON media_cache (cache_key)"
+    ))
+
+
+async def _migration_sync_high_water_mark(conn):
+    # 观看历史增量同步的高水位
+    await _add_column(conn, "library_sync_status", "history_high_water_mark", "DATETIME")
+    await _add_column(conn, "library_sync_status", "last_full_sync_at", "DATETIME")
+
+
+async def _migration_watch_history_user_emby(conn):
+    # (user_id, emby_id) 唯一索引，创建前先合并重复记录：
+    # 保留同步来源的记录（没有时保留最早的一条），观看时间取最新，播放次数累加
+    await conn.execute(text(
+        "CREATE TEMP TABLE _watch_history_dups AS "
+        "SELECT user_id, emby_id, "
+        "(SELECT w.id FROM watch_history w WHERE w.user_id = g.user_id AND w.emby_id = g.emby_id "
+        "ORDER BY w.source = 'emby' DESC, w.id LIMIT 1) AS keep_id, "
+        "MAX(watched_at) AS watched_at, MAX(last_played_date) AS last_played_date, "
+        "SUM(COALESCE(play_count, 0)) AS play_count, MAX(watched) AS watched, "
+        "MAX(watch_progress) AS watch_progress "
+        "FROM watch_history g WHERE user_id IS NOT NULL AND emby_id IS NOT NULL "
+        "GROUP BY user_id, emby_id HAVING COUNT(*) > 1"
+    ))
+    await conn.execute(text(
+        "UPDATE watch_history SET "
+        + ", ".join(
+            f"{column} = (SELECT d.{column} FROM _watch_history_dups d WHERE d.keep_id = watch_history.id)"
+            for column in ("watched_at", "last_played_date", "play_count", "watched", "watch_progress")
+        )
+        + " WHERE id IN (SELECT keep_id FROM _watch_history_dups)"
+    ))
+    result = await conn.execute(text(
+        "DELETE FROM watch_history WHERE (user_id, emby_id) IN (SELECT user_id, emby_id FROM _watch_history_dups) "
+        "AND id NOT IN (SELECT keep_id FROM _watch_history_dups)"
+    ))
+    await conn.execute(text("DROP TABLE _watch_history_dups"))
+    if result.rowcount:
+        # 观看时间变化后重建每日汇总和年度回顾（init_db 发现汇总表为空时从观看历史回填）
+        await conn.execute(text("DELETE FROM watch_daily_rollup"))
+        await conn.execute(text("DELETE FROM yearly_review_cache"))
+        logger.info(f"已合并 {result.rowcount} 条重复的观看记录 (user_id, emby_id)")
+    await conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_watch_history_user_emby ON watch_history (user_id, emby_id)"
+    ))
+
+
+async def _migration_watch_history_composite_indexes(conn):
+    # 按用户 + 时间 / 类型 / 剧集查询的复合索引，单独的 user_id 索引由它们的前缀覆盖
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_watch_history_user_watched_at "
+        "ON watch_history (user_id, watched_at)"
+    ))
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_watch_history_user_type_watched_at "
+        "ON watch_history (user_id, media_type, watched_at)"
+    ))
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_watch_history_user_series_episode "
+        "ON watch_history (user_id, series_id, season_number, episode_number)"
+    ))
+    await conn.execute(text("DROP INDEX IF EXISTS ix_watch_history_user_id"))
+    # 更新统计信息，让查询规划器使用新索引
+    await conn.execute(text("ANALYZE watch_history"))
+
+
+# 展开一条观看记录的类型列表（只取字符串元素，genres 不是合法 JSON 时视为空列表）
+_GENRES_OF = "json_each(CASE WHEN json_valid({row}.genres) THEN {row}.genres ELSE '[]' END)"
+
+_WATCH_HISTORY_GENRE_TRIGGERS = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_watch_history_genres_insert
+    AFTER INSERT ON watch_history
+    BEGIN
+        INSERT OR IGNORE INTO watch_history_genres (history_id, user_id, genre)
+        SELECT NEW.id, NEW.user_id, value FROM {_GENRES_OF.format(row="NEW")} WHERE type = 'text';
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_watch_history_genres_update
+    AFTER UPDATE OF genres, user_id ON watch_history
+    BEGIN
+        DELETE FROM watch_history_genres WHERE history_id = OLD.id;
+        INSERT OR IGNORE INTO watch_history_genres (history_id, user_id, genre)
+        SELECT NEW.id, NEW.user_id, value FROM {_GENRES_OF.format(row="NEW")} WHERE type = 'text';
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_watch_history_genres_delete
+    AFTER DELETE ON watch_history
+    BEGIN
+        DELETE FROM watch_history_genres WHERE history_id = OLD.id;
+    END
+    """,
+]
+
+
+async def _migration_watch_history_genres(conn):
+    # 类型索引表由触发器维护，同步、导入、手动添加和清理等所有写入路径都不需要单独处理；
+    # 创建触发器后从已有观看历史回填
+    for trigger in _WATCH_HISTORY_GENRE_TRIGGERS:
+        await conn.execute(text(trigger))
+    await conn.execute(text("DELETE FROM watch_history_genres"))
+    await conn.execute(text(
+        "INSERT OR IGNORE INTO watch_history_genres (history_id, user_id, genre) "
+        f"SELECT wh.id, wh.user_id, g.value FROM watch_history wh, {_GENRES_OF.format(row='wh')} g "
+        "WHERE g.type = 'text'"
+    ))
+    await conn.execute(text("ANALYZE watch_history_genres"))
+
+
+# (版本号, 名称, 迁移函数)，版本号只增不改，已执行的版本记录在 schema_migrations 表
+MIGRATIONS = [
+    (1, "watch_history.poster_path", _migration_watch_history_poster_path),
+    (2, "media_cache.cache_key", _migration_media_cache_key),
+    (3, "library_sync_status.history_high_water_mark", _migration_sync_high_water_mark),
+    (4, "watch_history (user_id, emby_id) unique index", _migration_watch_history_user_emby),
+    (5, "watch_history composite indexes", _migration_watch_history_composite_indexes),
+    (6, "watch_history_genres index table", _migration_watch_history_genres),
+]
+
+
 async def migrate_db():
-    """执行数据库迁移（添加新列）"""
-    async with engine.begin() as conn:
-        # 检查并添加 poster_path 列到 watch_history 表
-        try:
-            await conn.execute(text(
-                "ALTER TABLE watch_history ADD COLUMN poster_path VARCHAR(500)"
-            ))
-            print("Added poster_path column to watch_history table")
-        except Exception as e:
-            # 列已存在时会报错，忽略
-            if "duplicate column" not in str(e).lower() and "already exists" not in str(e).lower():
-                print(f"Migration warning (poster_path): {e}")
+    """按版本号执行尚未执行的数据库迁移（每个版本一个事务）"""
+    from app.models import SchemaMigration
+
+    async with engine.connect() as conn:
+        result = await conn.execute(select(SchemaMigration.version))
+        applied = set(result.scalars().all())
+
+    for version, name, migration in MIGRATIONS:
+        if version in applied:
+            continue
+        async with engine.begin() as conn:
+            await migration(conn)
+            await conn.execute(
+                SchemaMigration.__table__.insert().values(version=version, name=name)
+            )
+        logger.info(f"已执行数据库迁移 {version}: {name}")
 
 
 async def init_db():
@@ -58,3 +251,62 @@ async def init_db():
 
     # 执行数据库迁移
     await migrate_db()
+
+    # 首次启用每日汇总时，从已有观看历史回填
+    from app.models import WatchDailyRollup, WatchHistory
+    from app.services.rollup import rebuild_rollup
+
+    async with async_session_maker() as db:
+        has_rollup = (await db.execute(select(WatchDailyRollup.id).limit(1))).first()
+        has_history = (await db.execute(
+            select(WatchHistory.id).where(WatchHistory.watched_at.isnot(None)).limit(1)
+        )).first()
+        if has_history and not has_rollup:
+            await rebuild_rollup(db)
+            await db.commit()
+            print("Rebuilt watch_daily_rollup from watch_history")
+
+
+async def optimize_db():
+    """执行 PRAGMA optimize 并把 WAL 中的内容写回数据库文件"""
+    if not is_sqlite:
+        return
+    async with engine.connect() as conn:
+        await conn.exec_driver_sql("PRAGMA optimize")
+        if settings.sqlite_wal and not is_memory:
+            result = await conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            busy, log_frames, checkpointed = result.first()
+            if busy:
+                logger.info(f"WAL checkpoint 未完成（有正在进行的读写），已写回 {checkpointed}/{log_frames} 页")
+
+
+async def _maintenance_loop():
+    interval = settings.sqlite_maintenance_minutes
+    while True:
+        await asyncio.sleep(interval * 60)
+        try:
+            await optimize_db()
+        except Exception as e:
+            logger.warning(f"数据库维护失败: {e}")
+
+
+def start_db_maintenance():
+    """启动定时数据库维护任务"""
+    global _maintenance_task
+
+    if is_sqlite and settings.sqlite_maintenance_minutes > 0:
+        _maintenance_task = asyncio.create_task(_maintenance_loop())
+
+
+async def stop_db_maintenance():
+    """停止定时维护任务，关闭前再执行一次维护并释放连接"""
+    global _maintenance_task
+
+    if _maintenance_task:
+        _maintenance_task.cancel()
+        _maintenance_task = None
+    try:
+        await optimize_db()
+    except Exception as e:
+        logger.warning(f"数据库维护失败: {e}")
+    await engine.dispose()
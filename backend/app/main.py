@@ -4,9 +4,13 @@ import logging
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.config import get_settings
-from app.database import init_db
+from app.database import init_db, start_db_maintenance, stop_db_maintenance
 from app.routers import emby, tmdb, watchlist, stats, auth, history, hero, calendar, progress, recommend, lists, ratings, export, checkin, sync
 from app.services.sync import sync_all_users, start_sync_scheduler, stop_sync_scheduler
+from app.services.airing import start_airing_scheduler, stop_airing_scheduler
+from app.services.emby import start_emby_client, close_emby_client
+from app.services.tmdb import start_tmdb_client, close_tmdb_client
+from app.services.cache import tmdb_cache
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
@@ -17,6 +21,18 @@ async def lifespan(app: FastAPI):
     # 启动时初始化数据库
     await init_db()
     
+    # 启动共享的 HTTP 连接池
+    await start_emby_client()
+    await start_tmdb_client()
+    
+    # 清理过期的 TMDB 缓存
+    try:
+        purged = await tmdb_cache.purge_expired()
+        if purged:
+            logger.info(f"已清理 {purged} 条过期的 TMDB 缓存")
+    except Exception as e:
+        logger.warning(f"清理 TMDB 缓存失败: {e}")
+    
     # 启动时同步
     if settings.sync_on_startup:
         logger.info("启动时自动同步观看历史...")
@@ -25,10 +41,24 @@ async def lifespan(app: FastAPI):
     # 启动定时同步
     start_sync_scheduler()
     
+    # 启动播出日程刷新
+    start_airing_scheduler()
+    
+    # 启动定时数据库维护（PRAGMA optimize / WAL checkpoint）
+    start_db_maintenance()
+    
     yield
     
     # 关闭时停止同步调度器
     stop_sync_scheduler()
+    stop_airing_scheduler()
+    
+    # 关闭 HTTP 连接池
+    await close_emby_client()
+    await close_tmdb_client()
+    
+    # 停止数据库维护并释放连接
+    await stop_db_maintenance()
 
 
 app = FastAPI(
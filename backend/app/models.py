@@ -1,8 +1,17 @@
-from sqlalchemy import Column, Integer, String, Float, Boolean, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, Boolean, Date, DateTime, Text, JSON, Index
 from sqlalchemy.sql import func
 from app.database import Base
 
 
+class SchemaMigration(Base):
+    """已执行的数据库迁移版本"""
+    __tablename__ = "schema_migrations"
+    
+    version = Column(Integer, primary_key=True)
+    name = Column(String(200))
+    applied_at = Column(DateTime, server_default=func.now())
+
+
 class User(Base):
     """系统用户"""
     __tablename__ = "users"
@@ -24,9 +33,18 @@ class User(Base):
 class WatchHistory(Base):
     """观看历史记录"""
     __tablename__ = "watch_history"
+    __table_args__ = (
+        # 同步时按 (user_id, emby_id) 匹配已有记录
+        Index("ix_watch_history_user_emby", "user_id", "emby_id", unique=True),
+        # 统计、历史列表按时间范围查询（user_id 开头的复合索引同时覆盖只按用户过滤的查询）
+        Index("ix_watch_history_user_watched_at", "user_id", "watched_at"),
+        Index("ix_watch_history_user_type_watched_at", "user_id", "media_type", "watched_at"),
+        # 剧集进度按剧集/季/集查找
+        Index("ix_watch_history_user_series_episode", "user_id", "series_id", "season_number", "episode_number"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(String(100), index=True)  # Emby 用户 ID
+    user_id = Column(String(100))  # Emby 用户 ID
     emby_id = Column(String(100), index=True)  # Emby 媒体 ID
     tmdb_id = Column(Integer, index=True, nullable=True)  # TMDB ID
     media_type = Column(String(20))  # Movie / Episode
@@ -63,6 +81,72 @@ class WatchHistory(Base):
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
 
+class WatchHistoryGenre(Base):
+    """观看记录的类型索引（每条记录的每个类型一行），由 watch_history 上的触发器维护"""
+    __tablename__ = "watch_history_genres"
+    __table_args__ = (
+        # 按类型过滤、按用户统计类型分布
+        Index("ix_watch_history_genres_user_genre", "user_id", "genre", "history_id"),
+    )
+
+    history_id = Column(Integer, primary_key=True)  # watch_history.id
+    genre = Column(String(100), primary_key=True)  # 类型名称
+    user_id = Column(String(100))  # Emby 用户 ID
+
+
+class WatchDailyRollup(Base):
+    """每日观看汇总（按用户、日期、小时、类型），供统计接口使用"""
+    __tablename__ = "watch_daily_rollup"
+    __table_args__ = (
+        Index("ix_watch_daily_rollup_key", "user_id", "date", "hour", "media_type", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String(100))  # Emby 用户 ID
+    date = Column(Date)  # 观看日期
+    hour = Column(Integer)  # 观看小时 (0-23)
+    media_type = Column(String(20))  # Movie / Episode
+    count = Column(Integer, default=0)  # 观看数量
+    runtime_minutes = Column(Integer, default=0)  # 观看时长（分钟）
+
+
+class SeriesProgress(Base):
+    """剧集追剧进度（按用户和标准化剧名），同步时更新，进度页直接读取"""
+    __tablename__ = "series_progress"
+    __table_args__ = (
+        Index("ix_series_progress_user_show", "user_id", "show_key", unique=True),
+        Index("ix_series_progress_user_last_watched", "user_id", "last_watched"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String(100))  # Emby 用户 ID
+    show_key = Column(String(500))  # 标准化剧名（去除空格、转小写）
+    series_id = Column(String(100))  # 最近观看的 series_id
+    series_ids = Column(JSON, default=list)  # 同名剧集的所有 series_id
+    series_name = Column(String(500))
+    total_episodes = Column(Integer, default=0)
+    watched_episodes = Column(Integer, default=0)
+    progress = Column(Float, default=0)
+    last_watched = Column(DateTime, nullable=True)
+    fingerprint = Column(String(200))  # 观看记录摘要，变化时需要重新计算
+    data = Column(JSON)  # 完整的进度数据（季、集、下一集）
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class YearlyReviewCache(Base):
+    """已结束年份的年度回顾缓存，该年观看记录变化时删除"""
+    __tablename__ = "yearly_review_cache"
+    __table_args__ = (
+        Index("ix_yearly_review_cache_key", "user_id", "year", unique=True),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String(100))  # Emby 用户 ID
+    year = Column(Integer)
+    data = Column(JSON)  # 年度回顾结果
+    created_at = Column(DateTime, server_default=func.now())
+
+
 class Watchlist(Base):
     """想看列表"""
     __tablename__ = "watchlist"
@@ -85,14 +169,52 @@ class MediaCache(Base):
     __tablename__ = "media_cache"
     
     id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String(500), unique=True, index=True)  # 请求路径 + 参数
     tmdb_id = Column(Integer, index=True)
     media_type = Column(String(20))  # movie / tv
     data = Column(JSON)  # 完整的 TMDB 数据
+    expires_at = Column(DateTime, nullable=True)  # 过期时间
+    
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
+class SeriesMetadataCache(Base):
+    """Emby 剧集信息缓存（同步时补全剧集的类型、评分等）"""
+    __tablename__ = "series_metadata_cache"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    series_id = Column(String(100), unique=True, index=True)  # Emby 剧集 ID
+    genres = Column(JSON, default=list)
+    community_rating = Column(Float, nullable=True)
+    primary_image_tag = Column(String(100), nullable=True)
+    tmdb_id = Column(String(50), nullable=True)
+    expires_at = Column(DateTime, index=True)  # 过期时间
     
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
 
+class AiringSchedule(Base):
+    """追踪剧集的下一集播出信息（后台定时根据 TMDB 变更刷新，日历和 iCal 按播出日期查询）"""
+    __tablename__ = "airing_schedule"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    tmdb_id = Column(Integer, unique=True, index=True)  # TMDB 剧集 ID
+    name = Column(String(500))
+    poster_path = Column(String(255), nullable=True)
+    backdrop_path = Column(String(255), nullable=True)
+    vote_average = Column(Float, nullable=True)
+    in_production = Column(Boolean, default=True)  # 已完结的剧集只在 TMDB 有变更时刷新
+    air_date = Column(Date, nullable=True, index=True)  # 下一集播出日期，没有待播出的集时为空
+    season_number = Column(Integer, nullable=True)
+    episode_number = Column(Integer, nullable=True)
+    episode_name = Column(String(500), nullable=True)
+    overview = Column(Text, nullable=True)
+    checked_at = Column(DateTime)  # 最近一次从 TMDB 获取的时间
+    updated_at = Column(DateTime)  # 播出信息最近一次变化的时间
+
+
 class HeroSlide(Base):
     """首页轮播海报配置"""
     __tablename__ = "hero_slides"
@@ -208,6 +330,30 @@ class LibraryCache(Base):
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
 
+class LibraryItemIndex(Base):
+    """媒体库条目索引（电影和剧集，同步媒体库时重建）"""
+    __tablename__ = "library_item_index"
+    __table_args__ = (
+        Index("ix_library_item_index_user_item", "user_id", "item_id", unique=True),
+        Index("ix_library_item_index_year", "user_id", "item_type", "played", "year"),
+        Index("ix_library_item_index_rating", "user_id", "item_type", "played", "community_rating"),
+    )
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(String(100), nullable=False)  # Emby 用户 ID
+    library_id = Column(String(100), index=True)  # 所属媒体库 ID
+    item_id = Column(String(100), nullable=False)  # Emby 媒体 ID
+    item_type = Column(String(50))  # Movie / Series
+    name = Column(String(500))
+    year = Column(Integer, nullable=True)
+    community_rating = Column(Float, nullable=True)
+    genres = Column(JSON, default=list)
+    tmdb_id = Column(String(50), nullable=True)
+    played = Column(Boolean, default=False)
+    
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+
 class LibrarySyncStatus(Base):
     """媒体库同步状态"""
     __tablename__ = "library_sync_status"
@@ -218,5 +364,9 @@ class LibrarySyncStatus(Base):
     sync_status = Column(String(20), default="idle")  # idle / running / error
     error_message = Column(Text, nullable=True)  # 错误信息
     
+    # 观看历史增量同步
+    history_high_water_mark = Column(DateTime, nullable=True)  # 已同步的最新播放时间
+    last_full_sync_at = Column(DateTime, nullable=True)  # 最后一次全量同步时间
+    
     created_at = Column(DateTime, server_default=func.now())
     updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
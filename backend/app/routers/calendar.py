@@ -1,17 +1,30 @@
 """日历视图路由"""
-from fastapi import APIRouter, Depends, Query, HTTPException
+import asyncio
+import hashlib
+from email.utils import format_datetime, parsedate_to_datetime
+from fastapi import APIRouter, Depends, Query, HTTPException, Request
+from fastapi.responses import Response
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_
+from sqlalchemy import select
 from typing import Optional
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from collections import defaultdict
 from app.database import get_db
-from app.models import WatchHistory, Watchlist
+from app.models import Watchlist
 from app.services.tmdb import tmdb_service
-from app.services.emby import emby_service
+from app.services.cache import LRUCache
+from app.services.airing import get_watching_tmdb_ids, ensure_airing_schedule, get_airing_between
+from app.config import get_settings
+
+settings = get_settings()
 
 router = APIRouter(prefix="/calendar", tags=["Calendar"])
 
+# (开始日期, 结束日期, 地区) -> 上映的电影
+_movie_releases = LRUCache(settings.calendar_movie_cache_size)
+# user_id -> (iCal 内容的 ETag, 该内容首次生成的时间)
+_ical_versions: dict[str, tuple[str, datetime]] = {}
+
 
 @router.get("/shows")
 async def get_shows_calendar(
@@ -32,35 +45,20 @@ async def get_shows_calendar(
     
     calendar_items = []
     
-    # 获取正在追的剧集（从观看历史中提取）
-    watching_series = set()
-    if user_id:
-        result = await db.execute(
-            select(WatchHistory.series_id, WatchHistory.series_name)
-            .where(
-                and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.media_type == "Episode",
-                    WatchHistory.series_id.isnot(None)
-                )
-            )
-            .distinct()
-        )
-        for row in result.fetchall():
-            if row[0]:
-                watching_series.add((row[0], row[1]))
-    
-    # 获取想看列表中的剧集
+    # 获取正在追的剧集和想看列表中剧集的 TMDB ID（集合，便于成员判断）
+    watching_tmdb_ids = set(await get_watching_tmdb_ids(db, user_id)) if user_id else set()
     watchlist_result = await db.execute(
-        select(Watchlist).where(Watchlist.media_type == "tv")
+        select(Watchlist.tmdb_id).where(Watchlist.media_type == "tv")
     )
-    watchlist_shows = watchlist_result.scalars().all()
+    watchlist_tmdb_ids = {tmdb_id for tmdb_id in watchlist_result.scalars().all() if tmdb_id}
     
     # 从 TMDB 获取今日/本周播出的剧集
     try:
         # 获取正在播出的剧集
-        on_air = await tmdb_service.get_tv_on_the_air(page=1)
-        airing_today = await tmdb_service.get_tv_airing_today(page=1)
+        on_air, airing_today = await asyncio.gather(
+            tmdb_service.get_tv_on_the_air(page=1),
+            tmdb_service.get_tv_airing_today(page=1),
+        )
         
         # 合并并去重
         all_shows = {}
@@ -68,35 +66,29 @@ async def get_shows_calendar(
             if show.get("id") not in all_shows:
                 all_shows[show["id"]] = show
         
-        # 处理每个剧集
+        # 下一集播出信息从播出日程中按日期范围查询（缺失的先从 TMDB 获取）
+        await ensure_airing_schedule(db, all_shows)
+        schedule = await get_airing_between(db, all_shows, start.date(), end.date())
+        
         for show_id, show in all_shows.items():
-            # 获取下一集播出信息
-            try:
-                show_detail = await tmdb_service.get_tv_show(show_id)
-                next_episode = show_detail.get("next_episode_to_air")
-                
-                if next_episode and next_episode.get("air_date"):
-                    air_date = datetime.strptime(next_episode["air_date"], "%Y-%m-%d")
-                    
-                    # 检查是否在日期范围内
-                    if start <= air_date <= end:
-                        calendar_items.append({
-                            "id": show_id,
-                            "type": "episode",
-                            "title": show.get("name"),
-                            "date": next_episode["air_date"],
-                            "episode_title": next_episode.get("name"),
-                            "season_number": next_episode.get("season_number"),
-                            "episode_number": next_episode.get("episode_number"),
-                            "overview": next_episode.get("overview"),
-                            "poster_path": show.get("poster_path"),
-                            "backdrop_path": show.get("backdrop_path"),
-                            "vote_average": show.get("vote_average"),
-                            "is_watching": str(show_id) in [s[0] for s in watching_series] if watching_series else False,
-                            "in_watchlist": any(w.tmdb_id == show_id for w in watchlist_shows),
-                        })
-            except Exception:
+            record = schedule.get(show_id)
+            if record is None:
                 continue
+            calendar_items.append({
+                "id": show_id,
+                "type": "episode",
+                "title": show.get("name"),
+                "date": record.air_date.isoformat(),
+                "episode_title": record.episode_name,
+                "season_number": record.season_number,
+                "episode_number": record.episode_number,
+                "overview": record.overview,
+                "poster_path": show.get("poster_path"),
+                "backdrop_path": show.get("backdrop_path"),
+                "vote_average": show.get("vote_average"),
+                "is_watching": show_id in watching_tmdb_ids,
+                "in_watchlist": show_id in watchlist_tmdb_ids,
+            })
                 
     except Exception as e:
         print(f"获取 TMDB 日历数据失败: {e}")
@@ -107,10 +99,74 @@ async def get_shows_calendar(
     return {"items": calendar_items}
 
 
+async def _get_movie_releases(start_date: str, end_date: str, region: Optional[str]) -> list[dict]:
+    """获取日期范围内上映的电影（按 (开始日期, 结束日期, 地区) 缓存，不含想看标记）"""
+    key = f"{start_date}:{end_date}:{region or ''}"
+    entry = _movie_releases.get(key)
+    if entry is not None and datetime.utcnow() < entry[0]:
+        return entry[1]
+    
+    try:
+        # 使用 discover API 获取指定日期范围的电影，其余分页并发获取
+        params = {
+            "primary_release_date.gte": start_date,
+            "primary_release_date.lte": end_date,
+            "sort_by": "primary_release_date.asc",
+        }
+        if region:
+            params["region"] = region
+        results, complete = await tmdb_service.discover_movie_pages(
+            params, settings.calendar_movie_max_pages
+        )
+    except Exception as e:
+        print(f"获取电影日历数据失败: {e}")
+        return []
+    
+    releases = [
+        {
+            "id": movie.get("id"),
+            "type": "movie",
+            "title": movie.get("title"),
+            "date": movie["release_date"],
+            "overview": movie.get("overview"),
+            "poster_path": movie.get("poster_path"),
+            "backdrop_path": movie.get("backdrop_path"),
+            "vote_average": movie.get("vote_average"),
+        }
+        for movie in results
+        if movie.get("release_date")
+    ]
+    # 部分分页失败时不缓存，下次请求重新获取
+    if complete:
+        ttl = timedelta(seconds=settings.tmdb_cache_list_ttl)
+        _movie_releases.set(key, datetime.utcnow() + ttl, releases)
+    return releases
+
+
+async def _movie_calendar_items(db: AsyncSession, releases: list[dict]) -> list[dict]:
+    """为上映的电影加上想看标记，并按日期排序"""
+    # 获取想看列表中的电影
+    watchlist_result = await db.execute(
+        select(Watchlist).where(Watchlist.media_type == "movie")
+    )
+    watchlist_movies = watchlist_result.scalars().all()
+    watchlist_ids = {w.tmdb_id for w in watchlist_movies if w.tmdb_id}
+    
+    calendar_items = [
+        {**movie, "in_watchlist": movie["id"] in watchlist_ids}
+        for movie in releases
+    ]
+    
+    # 按日期排序
+    calendar_items.sort(key=lambda x: x["date"])
+    return calendar_items
+
+
 @router.get("/movies")
 async def get_movies_calendar(
     start_date: str = Query(..., description="开始日期 YYYY-MM-DD"),
     end_date: str = Query(..., description="结束日期 YYYY-MM-DD"),
+    region: Optional[str] = Query(None, description="上映地区（ISO 3166-1），如 CN"),
     db: AsyncSession = Depends(get_db),
 ):
     """
@@ -123,67 +179,8 @@ async def get_movies_calendar(
     except ValueError:
         raise HTTPException(status_code=400, detail="日期格式错误，请使用 YYYY-MM-DD")
     
-    calendar_items = []
-    
-    # 获取想看列表中的电影
-    watchlist_result = await db.execute(
-        select(Watchlist).where(Watchlist.media_type == "movie")
-    )
-    watchlist_movies = watchlist_result.scalars().all()
-    watchlist_ids = {w.tmdb_id for w in watchlist_movies if w.tmdb_id}
-    
-    try:
-        # 使用 discover API 获取指定日期范围的电影
-        params = {
-            "primary_release_date.gte": start_date,
-            "primary_release_date.lte": end_date,
-            "sort_by": "primary_release_date.asc",
-            "page": 1,
-        }
-        result = await tmdb_service.discover_movie(params)
-        
-        for movie in result.get("results", []):
-            release_date = movie.get("release_date")
-            if release_date:
-                calendar_items.append({
-                    "id": movie.get("id"),
-                    "type": "movie",
-                    "title": movie.get("title"),
-                    "date": release_date,
-                    "overview": movie.get("overview"),
-                    "poster_path": movie.get("poster_path"),
-                    "backdrop_path": movie.get("backdrop_path"),
-                    "vote_average": movie.get("vote_average"),
-                    "in_watchlist": movie.get("id") in watchlist_ids,
-                })
-        
-        # 获取更多页
-        total_pages = min(result.get("total_pages", 1), 5)  # 最多5页
-        for page in range(2, total_pages + 1):
-            params["page"] = page
-            result = await tmdb_service.discover_movie(params)
-            for movie in result.get("results", []):
-                release_date = movie.get("release_date")
-                if release_date:
-                    calendar_items.append({
-                        "id": movie.get("id"),
-                        "type": "movie",
-                        "title": movie.get("title"),
-                        "date": release_date,
-                        "overview": movie.get("overview"),
-                        "poster_path": movie.get("poster_path"),
-                        "backdrop_path": movie.get("backdrop_path"),
-                        "vote_average": movie.get("vote_average"),
-                        "in_watchlist": movie.get("id") in watchlist_ids,
-                    })
-                    
-    except Exception as e:
-        print(f"获取电影日历数据失败: {e}")
-    
-    # 按日期排序
-    calendar_items.sort(key=lambda x: x["date"])
-    
-    return {"items": calendar_items}
+    releases = await _get_movie_releases(start_date, end_date, region)
+    return {"items": await _movie_calendar_items(db, releases)}
 
 
 @router.get("/all")
@@ -191,16 +188,27 @@ async def get_all_calendar(
     start_date: str = Query(..., description="开始日期 YYYY-MM-DD"),
     end_date: str = Query(..., description="结束日期 YYYY-MM-DD"),
     user_id: Optional[str] = Query(None, description="Emby 用户 ID"),
+    region: Optional[str] = Query(None, description="电影上映地区（ISO 3166-1），如 CN"),
     db: AsyncSession = Depends(get_db),
 ):
     """
     获取综合日历（剧集 + 电影）
     """
-    shows = await get_shows_calendar(start_date, end_date, user_id, db)
-    movies = await get_movies_calendar(start_date, end_date, db)
+    try:
+        datetime.strptime(start_date, "%Y-%m-%d")
+        datetime.strptime(end_date, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="日期格式错误，请使用 YYYY-MM-DD")
+    
+    # 剧集和电影并发获取（电影部分不使用数据库会话，获取完成后再查想看列表）
+    shows, releases = await asyncio.gather(
+        get_shows_calendar(start_date, end_date, user_id, db),
+        _get_movie_releases(start_date, end_date, region),
+    )
+    movies = await _movie_calendar_items(db, releases)
     
     # 合并并按日期分组
-    all_items = shows["items"] + movies["items"]
+    all_items = shows["items"] + movies
     all_items.sort(key=lambda x: x["date"])
     
     # 按日期分组
@@ -214,6 +222,59 @@ async def get_all_calendar(
     }
 
 
+async def _collect_my_shows(
+    db: AsyncSession,
+    user_id: str,
+    start: date,
+    end: date,
+    cached_only: bool = False,
+) -> list[dict]:
+    """
+    获取正在追的剧集和想看列表中的剧集在日期范围内的播出信息（按日期排序）
+
+    cached_only 为 True 时只读取本地的播出日程，不请求 Emby / TMDB（缺失的剧集由后台刷新任务补全）
+    """
+    # 获取正在追的剧集（TMDB ID -> 剧名）
+    watching_series = await get_watching_tmdb_ids(db, user_id, resolve_missing=not cached_only)
+    
+    # 获取想看列表中的剧集
+    watchlist_result = await db.execute(
+        select(Watchlist).where(Watchlist.media_type == "tv")
+    )
+    for show in watchlist_result.scalars().all():
+        if show.tmdb_id and show.tmdb_id not in watching_series:
+            watching_series[show.tmdb_id] = show.title
+    
+    # 从播出日程中按日期范围查询（缺失或过期的先从 TMDB 获取）
+    if not cached_only:
+        await ensure_airing_schedule(db, watching_series)
+    schedule = await get_airing_between(db, watching_series, start, end)
+    
+    calendar_items = []
+    for tmdb_id, title in watching_series.items():
+        record = schedule.get(tmdb_id)
+        if record is None:
+            continue
+        calendar_items.append({
+            "id": tmdb_id,
+            "type": "episode",
+            "title": record.name or title,
+            "date": record.air_date.isoformat(),
+            "episode_title": record.episode_name,
+            "season_number": record.season_number,
+            "episode_number": record.episode_number,
+            "overview": record.overview,
+            "poster_path": record.poster_path,
+            "backdrop_path": record.backdrop_path,
+            "vote_average": record.vote_average,
+            "is_watching": True,
+        })
+    
+    # 按日期排序
+    calendar_items.sort(key=lambda x: x["date"])
+    return calendar_items
+
+
 @router.get("/my-shows")
 async def get_my_shows_calendar(
     start_date: str = Query(..., description="开始日期 YYYY-MM-DD"),
@@ -231,75 +292,7 @@ async def get_my_shows_calendar(
     except ValueError:
         raise HTTPException(status_code=400, detail="日期格式错误，请使用 YYYY-MM-DD")
     
-    calendar_items = []
-    
-    # 获取正在追的剧集（从观看历史中提取 TMDB ID）
-    # 需要通过 Emby 的 ProviderIds 获取 TMDB ID
-    watching_series = {}
-    
-    # 从观看历史获取剧集
-    result = await db.execute(
-        select(WatchHistory.series_id, WatchHistory.series_name)
-        .where(
-            and_(
-                WatchHistory.user_id == user_id,
-                WatchHistory.media_type == "Episode",
-                WatchHistory.series_id.isnot(None)
-            )
-        )
-        .distinct()
-    )
-    
-    for row in result.fetchall():
-        emby_series_id, series_name = row
-        if emby_series_id:
-            try:
-                # 从 Emby 获取剧集详情以获取 TMDB ID
-                series_detail = await emby_service.get_item(user_id, emby_series_id)
-                tmdb_id = series_detail.provider_ids.get("Tmdb")
-                if tmdb_id:
-                    watching_series[int(tmdb_id)] = series_name
-            except Exception:
-                continue
-    
-    # 获取想看列表中的剧集
-    watchlist_result = await db.execute(
-        select(Watchlist).where(Watchlist.media_type == "tv")
-    )
-    for show in watchlist_result.scalars().all():
-        if show.tmdb_id and show.tmdb_id not in watching_series:
-            watching_series[show.tmdb_id] = show.title
-    
-    # 获取每个剧集的下一集播出信息
-    for tmdb_id, title in watching_series.items():
-        try:
-            show_detail = await tmdb_service.get_tv_show(tmdb_id)
-            next_episode = show_detail.get("next_episode_to_air")
-            
-            if next_episode and next_episode.get("air_date"):
-                air_date = datetime.strptime(next_episode["air_date"], "%Y-%m-%d")
-                
-                if start <= air_date <= end:
-                    calendar_items.append({
-                        "id": tmdb_id,
-                        "type": "episode",
-                        "title": show_detail.get("name", title),
-                        "date": next_episode["air_date"],
-                        "episode_title": next_episode.get("name"),
-                        "season_number": next_episode.get("season_number"),
-                        "episode_number": next_episode.get("episode_number"),
-                        "overview": next_episode.get("overview"),
-                        "poster_path": show_detail.get("poster_path"),
-                        "backdrop_path": show_detail.get("backdrop_path"),
-                        "vote_average": show_detail.get("vote_average"),
-                        "is_watching": True,
-                    })
-        except Exception as e:
-            print(f"获取剧集 {tmdb_id} 信息失败: {e}")
-            continue
-    
-    # 按日期排序
-    calendar_items.sort(key=lambda x: x["date"])
+    calendar_items = await _collect_my_shows(db, user_id, start.date(), end.date())
     
     # 按日期分组
     grouped = defaultdict(list)
@@ -312,25 +305,45 @@ async def get_my_shows_calendar(
     }
 
 
+def _ical_not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """根据 If-None-Match / If-Modified-Since 判断客户端缓存是否仍然有效"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        # 有 If-None-Match 时忽略 If-Modified-Since
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return last_modified.replace(microsecond=0) <= since
+    return False
+
+
 @router.get("/ical")
 async def export_ical(
+    request: Request,
     user_id: str = Query(..., description="Emby 用户 ID"),
     db: AsyncSession = Depends(get_db),
 ):
     """
     导出 iCal 格式的日历
-    """
-    from fastapi.responses import Response
     
-    # 获取未来30天的日历
-    today = datetime.now()
-    end_date = today + timedelta(days=30)
-    
-    result = await get_my_shows_calendar(
-        start_date=today.strftime("%Y-%m-%d"),
-        end_date=end_date.strftime("%Y-%m-%d"),
-        user_id=user_id,
-        db=db,
+    带 ETag / Last-Modified，内容没有变化时返回 304
+    """
+    # 获取未来一段时间的日历（订阅会被频繁轮询，启用后台刷新时只读取本地的播出日程）
+    today = datetime.now().date()
+    items = await _collect_my_shows(
+        db,
+        user_id,
+        today,
+        today + timedelta(days=settings.calendar_ical_days),
+        cached_only=settings.airing_refresh_minutes > 0,
     )
     
     # 生成 iCal 内容
@@ -343,7 +356,7 @@ async def export_ical(
         "X-WR-CALNAME:Emby Tracker 追剧日历",
     ]
     
-    for item in result["items"]:
+    for item in items:
         event_date = item["date"].replace("-", "")
         uid = f"{item['id']}-{item['date']}@emby-tracker"
         
@@ -359,7 +372,7 @@ async def export_ical(
             f"DTSTART;VALUE=DATE:{event_date}",
             f"DTEND;VALUE=DATE:{event_date}",
             f"SUMMARY:{title}",
-            f"DESCRIPTION:{item.get('overview', '')[:200]}",
+            f"DESCRIPTION:{(item.get('overview') or '')[:200]}",
             "END:VEVENT",
         ])
     
@@ -367,8 +380,23 @@ async def export_ical(
     
     ical_content = "\r\n".join(ical_lines)
     
+    # Last-Modified 取该用户日历内容首次生成为当前版本的时间
+    etag = '"' + hashlib.sha1(ical_content.encode("utf-8")).hexdigest() + '"'
+    version = _ical_versions.get(user_id)
+    if version is None or version[0] != etag:
+        version = (etag, datetime.now(timezone.utc))
+        _ical_versions[user_id] = version
+    last_modified = version[1]
+    
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified.replace(microsecond=0), usegmt=True),
+    }
+    if _ical_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    
     return Response(
         content=ical_content,
         media_type="text/calendar",
-        headers={"Content-Disposition": "attachment; filename=emby-tracker.ics"},
+        headers={**headers, "Content-Disposition": "attachment; filename=emby-tracker.ics"},
     )
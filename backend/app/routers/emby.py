@@ -1,6 +1,7 @@
 from fastapi import APIRouter, HTTPException, Query
 from typing import Optional
 from app.services.emby import emby_service
+from app.services.library_stats import invalidate_library_counts
 from app.schemas import EmbyLibrary, EmbyMediaItem, EmbyMediaList
 from app.config import get_settings
 
@@ -126,6 +127,7 @@ async def mark_played(user_id: str, item_id: str):
     """标记为已播放"""
     try:
         await emby_service.mark_played(user_id, item_id)
+        invalidate_library_counts(user_id)
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -136,6 +138,7 @@ async def mark_unplayed(user_id: str, item_id: str):
     """标记为未播放"""
     try:
         await emby_service.mark_unplayed(user_id, item_id)
+        invalidate_library_counts(user_id)
         return {"success": True}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -3,74 +3,84 @@ from fastapi import APIRouter, Depends, Query, HTTPException, UploadFile, File
 from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
-from typing import Optional
+from typing import AsyncIterator, Optional
 from datetime import datetime
+import asyncio
 import json
 import csv
 import io
+import os
+import shutil
+import tempfile
 from app.database import get_db
-from app.models import WatchHistory, Watchlist, UserRating, CustomList, CustomListItem
+from app.models import Watchlist, UserRating, CustomList, CustomListItem
+from app.services import importer
+from app.services.importer import (
+    ImportFunc,
+    ImportFormatError,
+    create_job,
+    fail_job,
+    get_job,
+    run_import,
+    start_background_import,
+)
+from app.services.export_stream import (
+    HISTORY_FIELDS,
+    Counter,
+    iter_history,
+    csv_chunks,
+    ndjson_chunks,
+    json_array_chunks,
+    json_field,
+    json_key,
+    gzip_chunks,
+)
 
 router = APIRouter(prefix="/export", tags=["Export"])
 
 
+def _stream_export(chunks: AsyncIterator[str], media_type: str, filename: str, compress: bool) -> StreamingResponse:
+    """流式下载响应，compress 为 True 时边输出边 gzip 压缩"""
+    if compress:
+        return StreamingResponse(
+            gzip_chunks(chunks),
+            media_type="application/gzip",
+            headers={"Content-Disposition": f"attachment; filename={filename}.gz"}
+        )
+    return StreamingResponse(
+        chunks,
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
+
+async def _history_json_chunks(user_id: str) -> AsyncIterator[str]:
+    """观看历史 JSON（格式与 indent=2 一致，total 在历史记录输出完后写入）"""
+    counter = Counter()
+    exported_at = datetime.now().isoformat()
+    yield "{" + json_key("history", 1, first=True)
+    async for chunk in json_array_chunks(iter_history(user_id, newest_first=True), 1, counter):
+        yield chunk
+    yield json_field("exported_at", exported_at, 1) + json_field("total", counter.value, 1) + "\n}"
+
+
 @router.get("/history")
 async def export_history(
     user_id: str = Query(..., description="Emby 用户 ID"),
-    format: str = Query("json", description="导出格式: json / csv"),
-    db: AsyncSession = Depends(get_db),
+    format: str = Query("json", description="导出格式: json / csv / ndjson"),
+    gzip: bool = Query(False, description="是否 gzip 压缩"),
 ):
-    """导出观看历史"""
-    result = await db.execute(
-        select(WatchHistory)
-        .where(WatchHistory.user_id == user_id)
-        .order_by(WatchHistory.watched_at.desc())
-    )
-    history = result.scalars().all()
-    
-    data = [
-        {
-            "title": h.title,
-            "media_type": h.media_type,
-            "year": h.year,
-            "series_name": h.series_name,
-            "season_number": h.season_number,
-            "episode_number": h.episode_number,
-            "watched": h.watched,
-            "watch_progress": h.watch_progress,
-            "watched_at": h.watched_at.isoformat() if h.watched_at else None,
-            "community_rating": h.community_rating,
-            "genres": h.genres,
-            "runtime_minutes": h.runtime_minutes,
-            "emby_id": h.emby_id,
-            "tmdb_id": h.tmdb_id,
-        }
-        for h in history
-    ]
-    
+    """导出观看历史（流式输出，内存占用与记录数无关）"""
     if format == "csv":
-        output = io.StringIO()
-        if data:
-            writer = csv.DictWriter(output, fieldnames=data[0].keys())
-            writer.writeheader()
-            for row in data:
-                # 将列表转为字符串
-                row["genres"] = ",".join(row["genres"]) if row["genres"] else ""
-                writer.writerow(row)
-        
-        output.seek(0)
-        return StreamingResponse(
-            iter([output.getvalue()]),
-            media_type="text/csv",
-            headers={"Content-Disposition": f"attachment; filename=watch_history_{user_id}.csv"}
-        )
+        chunks = csv_chunks(iter_history(user_id, newest_first=True), HISTORY_FIELDS)
+        return _stream_export(chunks, "text/csv", f"watch_history_{user_id}.csv", gzip)
+    
+    if format == "ndjson":
+        chunks = ndjson_chunks(iter_history(user_id, newest_first=True))
+        return _stream_export(chunks, "application/x-ndjson", f"watch_history_{user_id}.ndjson", gzip)
     
     # JSON 格式
-    return StreamingResponse(
-        iter([json.dumps({"history": data, "exported_at": datetime.now().isoformat(), "total": len(data)}, ensure_ascii=False, indent=2)]),
-        media_type="application/json",
-        headers={"Content-Disposition": f"attachment; filename=watch_history_{user_id}.json"}
-    )
+    return _stream_export(_history_json_chunks(user_id), "application/json", f"watch_history_{user_id}.json", gzip)
 
 
 @router.get("/watchlist")
@@ -213,36 +223,47 @@ async def export_lists(
     )
 
 
+async def _backup_json_chunks(
+    user_id: str,
+    watchlist: list[dict],
+    ratings: list[dict],
+    lists: list[dict],
+) -> AsyncIterator[str]:
+    """完整备份 JSON（格式与 indent=2 一致，观看历史逐批输出，counts 最后写入）"""
+    counter = Counter()
+    yield (
+        "{"
+        + json_field("version", "1.0", 1, first=True)
+        + json_field("exported_at", datetime.now().isoformat(), 1)
+        + json_field("user_id", user_id, 1)
+        + json_key("data", 1)
+        + "{"
+        + json_key("history", 2, first=True)
+    )
+    async for chunk in json_array_chunks(iter_history(user_id), 2, counter):
+        yield chunk
+    yield (
+        json_field("watchlist", watchlist, 2)
+        + json_field("ratings", ratings, 2)
+        + json_field("lists", lists, 2)
+        + "\n  }"
+        + json_field("counts", {
+            "history": counter.value,
+            "watchlist": len(watchlist),
+            "ratings": len(ratings),
+            "lists": len(lists),
+        }, 1)
+        + "\n}"
+    )
+
+
 @router.get("/full-backup")
 async def export_full_backup(
     user_id: str = Query(..., description="Emby 用户 ID"),
+    gzip: bool = Query(False, description="是否 gzip 压缩"),
     db: AsyncSession = Depends(get_db),
 ):
-    """导出完整备份"""
-    # 观看历史
-    history_result = await db.execute(
-        select(WatchHistory).where(WatchHistory.user_id == user_id)
-    )
-    history = [
-        {
-            "title": h.title,
-            "media_type": h.media_type,
-            "year": h.year,
-            "series_name": h.series_name,
-            "season_number": h.season_number,
-            "episode_number": h.episode_number,
-            "watched": h.watched,
-            "watch_progress": h.watch_progress,
-            "watched_at": h.watched_at.isoformat() if h.watched_at else None,
-            "community_rating": h.community_rating,
-            "genres": h.genres,
-            "runtime_minutes": h.runtime_minutes,
-            "emby_id": h.emby_id,
-            "tmdb_id": h.tmdb_id,
-        }
-        for h in history_result.scalars().all()
-    ]
-    
+    """导出完整备份（观看历史流式输出）"""
     # 想看列表
     watchlist_result = await db.execute(select(Watchlist))
     watchlist = [
@@ -293,238 +314,112 @@ async def export_full_backup(
             ]
         })
     
-    backup = {
-        "version": "1.0",
-        "exported_at": datetime.now().isoformat(),
-        "user_id": user_id,
-        "data": {
-            "history": history,
-            "watchlist": watchlist,
-            "ratings": ratings,
-            "lists": lists,
-        },
-        "counts": {
-            "history": len(history),
-            "watchlist": len(watchlist),
-            "ratings": len(ratings),
-            "lists": len(lists),
-        }
-    }
-    
-    return StreamingResponse(
-        iter([json.dumps(backup, ensure_ascii=False, indent=2)]),
-        media_type="application/json",
-        headers={"Content-Disposition": f"attachment; filename=emby_tracker_backup_{user_id}_{datetime.now().strftime('%Y%m%d')}.json"}
-    )
+    filename = f"emby_tracker_backup_{user_id}_{datetime.now().strftime('%Y%m%d')}.json"
+    return _stream_export(_backup_json_chunks(user_id, watchlist, ratings, lists), "application/json", filename, gzip)
 
 
 # 导入路由
 import_router = APIRouter(prefix="/import", tags=["Import"])
 
 
+async def _start_import(
+    import_func: ImportFunc,
+    kind: str,
+    user_id: str,
+    file: UploadFile,
+    background: bool,
+    db: AsyncSession,
+    failure: str,
+) -> tuple[dict, Optional[dict]]:
+    """
+    执行导入，返回 (任务, 导入结果)
+
+    background 为 True 时先把上传文件复制到临时文件，在后台导入并立即返回（结果为 None）
+    """
+    job = create_job(user_id, kind, total_bytes=file.size)
+    
+    if background:
+        tmp = None
+        try:
+            with tempfile.NamedTemporaryFile(prefix="emby_tracker_import_", suffix=".json", delete=False) as tmp:
+                await asyncio.to_thread(shutil.copyfileobj, file.file, tmp)
+        except Exception as e:
+            # 复制失败时删除临时文件，任务标记为失败
+            if tmp is not None:
+                try:
+                    os.remove(tmp.name)
+                except OSError:
+                    pass
+            fail_job(job, str(e))
+            raise HTTPException(status_code=500, detail=f"{failure}: {str(e)}")
+        start_background_import(import_func, user_id, tmp.name, job)
+        return job, None
+    
+    try:
+        return job, await run_import(import_func, db, user_id, file.read, job)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="无效的 JSON 文件")
+    except ImportFormatError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"{failure}: {str(e)}")
+
+
 @import_router.post("/trakt-history")
 async def import_trakt_history(
     user_id: str = Query(..., description="Emby 用户 ID"),
     file: UploadFile = File(...),
+    background: bool = Query(False, description="是否后台导入（立即返回任务 ID，通过 /export/import/jobs/{job_id} 查询进度）"),
     db: AsyncSession = Depends(get_db),
 ):
     """
     从 Trakt 导入观看历史
-    支持 Trakt 导出的 JSON 格式
+    支持 Trakt 导出的 JSON 格式（流式解析，按批去重并批量写入）
     """
-    try:
-        content = await file.read()
-        data = json.loads(content)
-        
-        imported = 0
-        skipped = 0
-        
-        # Trakt 导出格式可能是数组或对象
-        items = data if isinstance(data, list) else data.get("history", [])
-        
-        for item in items:
-            # 尝试解析 Trakt 格式
-            media_type = item.get("type", "").lower()
-            if media_type == "movie":
-                movie = item.get("movie", {})
-                title = movie.get("title")
-                year = movie.get("year")
-                tmdb_id = movie.get("ids", {}).get("tmdb")
-            elif media_type == "episode":
-                show = item.get("show", {})
-                episode = item.get("episode", {})
-                title = episode.get("title")
-                year = show.get("year")
-                tmdb_id = show.get("ids", {}).get("tmdb")
-            else:
-                skipped += 1
-                continue
-            
-            if not title:
-                skipped += 1
-                continue
-            
-            # 检查是否已存在
-            existing = await db.execute(
-                select(WatchHistory)
-                .where(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.title == title,
-                    WatchHistory.media_type == ("Movie" if media_type == "movie" else "Episode"),
-                )
-            )
-            
-            if existing.scalar_one_or_none():
-                skipped += 1
-                continue
-            
-            # 创建记录
-            watched_at = item.get("watched_at")
-            if watched_at:
-                try:
-                    watched_at = datetime.fromisoformat(watched_at.replace("Z", "+00:00"))
-                except Exception:
-                    watched_at = datetime.now()
-            else:
-                watched_at = datetime.now()
-            
-            new_history = WatchHistory(
-                user_id=user_id,
-                title=title,
-                media_type="Movie" if media_type == "movie" else "Episode",
-                year=year,
-                tmdb_id=tmdb_id,
-                watched=True,
-                watched_at=watched_at,
-                source="trakt_import",
-            )
-            db.add(new_history)
-            imported += 1
-        
-        await db.commit()
-        
-        return {
-            "message": "导入完成",
-            "imported": imported,
-            "skipped": skipped,
-        }
-        
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="无效的 JSON 文件")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"导入失败: {str(e)}")
+    job, results = await _start_import(
+        importer.import_trakt_history, "trakt-history", user_id, file, background, db, "导入失败"
+    )
+    if results is None:
+        return {"message": "导入已开始", "job_id": job["job_id"]}
+    
+    return {
+        "message": "导入完成",
+        "imported": results["imported"],
+        "skipped": results["skipped"],
+        "job_id": job["job_id"],
+    }
 
 
 @import_router.post("/backup")
 async def import_backup(
     user_id: str = Query(..., description="Emby 用户 ID"),
     file: UploadFile = File(...),
+    background: bool = Query(False, description="是否后台导入（立即返回任务 ID，通过 /export/import/jobs/{job_id} 查询进度）"),
     db: AsyncSession = Depends(get_db),
 ):
     """
-    从备份文件恢复数据
+    从备份文件恢复数据（流式解析，按批去重并批量写入）
     """
-    try:
-        content = await file.read()
-        backup = json.loads(content)
-        
-        if backup.get("version") != "1.0":
-            raise HTTPException(status_code=400, detail="不支持的备份版本")
-        
-        data = backup.get("data", {})
-        results = {
-            "history": {"imported": 0, "skipped": 0},
-            "watchlist": {"imported": 0, "skipped": 0},
-            "ratings": {"imported": 0, "skipped": 0},
-            "lists": {"imported": 0, "skipped": 0},
-        }
-        
-        # 导入观看历史
-        for item in data.get("history", []):
-            existing = await db.execute(
-                select(WatchHistory)
-                .where(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.title == item.get("title"),
-                    WatchHistory.media_type == item.get("media_type"),
-                )
-            )
-            if existing.scalar_one_or_none():
-                results["history"]["skipped"] += 1
-                continue
-            
-            watched_at = item.get("watched_at")
-            if watched_at:
-                try:
-                    watched_at = datetime.fromisoformat(watched_at)
-                except Exception:
-                    watched_at = None
-            
-            new_history = WatchHistory(
-                user_id=user_id,
-                title=item.get("title"),
-                media_type=item.get("media_type"),
-                year=item.get("year"),
-                series_name=item.get("series_name"),
-                season_number=item.get("season_number"),
-                episode_number=item.get("episode_number"),
-                watched=item.get("watched", True),
-                watch_progress=item.get("watch_progress", 100),
-                watched_at=watched_at,
-                community_rating=item.get("community_rating"),
-                genres=item.get("genres", []),
-                runtime_minutes=item.get("runtime_minutes"),
-                tmdb_id=item.get("tmdb_id"),
-                source="backup_import",
-            )
-            db.add(new_history)
-            results["history"]["imported"] += 1
-        
-        # 导入评分
-        for item in data.get("ratings", []):
-            existing = await db.execute(
-                select(UserRating)
-                .where(
-                    UserRating.user_id == user_id,
-                    UserRating.title == item.get("title"),
-                    UserRating.media_type == item.get("media_type"),
-                )
-            )
-            if existing.scalar_one_or_none():
-                results["ratings"]["skipped"] += 1
-                continue
-            
-            rated_at = item.get("rated_at")
-            if rated_at:
-                try:
-                    rated_at = datetime.fromisoformat(rated_at)
-                except Exception:
-                    rated_at = None
-            
-            new_rating = UserRating(
-                user_id=user_id,
-                title=item.get("title"),
-                media_type=item.get("media_type"),
-                rating=item.get("rating"),
-                review=item.get("review"),
-                tmdb_id=item.get("tmdb_id"),
-                rated_at=rated_at,
-            )
-            db.add(new_rating)
-            results["ratings"]["imported"] += 1
-        
-        await db.commit()
-        
-        return {
-            "message": "恢复完成",
-            "results": results,
-        }
-        
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=400, detail="无效的 JSON 文件")
-    except Exception as e:
-        await db.rollback()
-        raise HTTPException(status_code=500, detail=f"恢复失败: {str(e)}")
+    job, results = await _start_import(
+        importer.import_backup, "backup", user_id, file, background, db, "恢复失败"
+    )
+    if results is None:
+        return {"message": "恢复已开始", "job_id": job["job_id"]}
+    
+    return {
+        "message": "恢复完成",
+        "results": results,
+        "job_id": job["job_id"],
+    }
+
+
+@import_router.get("/jobs/{job_id}")
+async def get_import_job(job_id: str):
+    """查询导入任务进度"""
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="导入任务不存在")
+    return job
 
 
 # 合并路由
@@ -1,10 +1,13 @@
 from fastapi import APIRouter, Depends, Query, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_
+from sqlalchemy import select, func, and_, tuple_
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timezone
+import base64
+import json
 from app.database import get_db
-from app.models import WatchHistory
+from app.models import WatchHistory, WatchHistoryGenre
+from app.services.rollup import apply_rollup_changes
 from pydantic import BaseModel
 
 router = APIRouter(prefix="/history", tags=["Watch History"])
@@ -60,9 +63,15 @@ async def get_history(
     sort_order: Optional[str] = Query("desc", description="排序方向: asc / desc"),
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=100),
+    mode: str = Query("page", description="分页模式: page（按页码）/ cursor（游标，适合无限滚动）"),
+    cursor: Optional[str] = Query(None, description="cursor 模式下上一页返回的 next_cursor"),
     db: AsyncSession = Depends(get_db),
 ):
-    """获取本地存储的观看历史（支持高级筛选）"""
+    """
+    获取本地存储的观看历史（支持高级筛选）
+
+    cursor 模式按 (排序字段, id) 定位下一页，不使用 OFFSET，总数只在第一页计算
+    """
     query = select(WatchHistory).where(WatchHistory.user_id == user_id)
     count_query = select(func.count(WatchHistory.id)).where(WatchHistory.user_id == user_id)
     
@@ -71,14 +80,16 @@ async def get_history(
         query = query.where(WatchHistory.media_type == media_type)
         count_query = count_query.where(WatchHistory.media_type == media_type)
     
-    # 类型（genre）筛选 - 使用 JSON 字符串匹配（兼容 SQLite）
+    # 类型（genre）筛选 - 通过类型索引表按 (user_id, genre) 查找记录
     if genre:
-        # SQLite 的 JSON 数组查询需要使用 LIKE 或 JSON 函数
-        # 这里使用 cast + like 的方式兼容 SQLite
-        from sqlalchemy import cast, String
-        genre_pattern = f'%"{genre}"%'
-        query = query.where(cast(WatchHistory.genres, String).like(genre_pattern))
-        count_query = count_query.where(cast(WatchHistory.genres, String).like(genre_pattern))
+        genre_ids = select(WatchHistoryGenre.history_id).where(
+            and_(
+                WatchHistoryGenre.user_id == user_id,
+                WatchHistoryGenre.genre == genre,
+            )
+        )
+        query = query.where(WatchHistory.id.in_(genre_ids))
+        count_query = count_query.where(WatchHistory.id.in_(genre_ids))
     
     # 年份范围筛选
     if year_from:
@@ -130,16 +141,14 @@ async def get_history(
             (WatchHistory.series_name.ilike(search_pattern))
         )
     
-    # 排序
-    sort_column = WatchHistory.watched_at
-    if sort_by == "rating":
-        sort_column = WatchHistory.community_rating
-    elif sort_by == "year":
-        sort_column = WatchHistory.year
-    elif sort_by == "runtime":
-        sort_column = WatchHistory.runtime_minutes
-    elif sort_by == "title":
-        sort_column = WatchHistory.title
+    # 排序（未知的排序字段按观看时间排序，游标中记录的也是实际使用的排序字段）
+    sort_key = sort_by if sort_by in _SORT_COLUMNS else "watched_at"
+    sort_column = _SORT_COLUMNS[sort_key]
+    
+    if mode == "cursor":
+        return await _get_history_by_cursor(
+            db, query, count_query, sort_column, sort_key, sort_order, page_size, cursor
+        )
     
     if sort_order == "asc":
         query = query.order_by(sort_column.asc().nullslast())
@@ -158,36 +167,135 @@ async def get_history(
     items = result.scalars().all()
     
     return {
-        "items": [
-            {
-                "id": item.id,
-                "emby_id": item.emby_id,
-                "tmdb_id": item.tmdb_id,
-                "media_type": item.media_type,
-                "title": item.title,
-                "series_id": item.series_id,
-                "series_name": item.series_name,
-                "season_number": item.season_number,
-                "episode_number": item.episode_number,
-                "year": item.year,
-                "runtime_minutes": item.runtime_minutes,
-                "community_rating": item.community_rating,
-                "genres": item.genres or [],
-                "poster_path": item.poster_path,
-                "watched": item.watched,
-                "watch_progress": item.watch_progress,
-                "play_count": item.play_count,
-                "watched_at": item.watched_at.isoformat() if item.watched_at else None,
-                "source": item.source,
-            }
-            for item in items
-        ],
+        "items": [_history_item(item) for item in items],
         "total_count": total_count,
         "page": page,
         "page_size": page_size,
     }
 
 
+# 排序参数 -> 排序字段
+_SORT_COLUMNS = {
+    "watched_at": WatchHistory.watched_at,
+    "rating": WatchHistory.community_rating,
+    "year": WatchHistory.year,
+    "runtime": WatchHistory.runtime_minutes,
+    "title": WatchHistory.title,
+}
+
+
+def _history_item(item: WatchHistory) -> dict:
+    return {
+        "id": item.id,
+        "emby_id": item.emby_id,
+        "tmdb_id": item.tmdb_id,
+        "media_type": item.media_type,
+        "title": item.title,
+        "series_id": item.series_id,
+        "series_name": item.series_name,
+        "season_number": item.season_number,
+        "episode_number": item.episode_number,
+        "year": item.year,
+        "runtime_minutes": item.runtime_minutes,
+        "community_rating": item.community_rating,
+        "genres": item.genres or [],
+        "poster_path": item.poster_path,
+        "watched": item.watched,
+        "watch_progress": item.watch_progress,
+        "play_count": item.play_count,
+        "watched_at": item.watched_at.isoformat() if item.watched_at else None,
+        "source": item.source,
+    }
+
+
+def _encode_cursor(sort_by: str, sort_order: str, value, item_id: int) -> str:
+    """游标：排序字段、方向、最后一条记录的排序值和 id（base64 编码的 JSON）"""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    payload = json.dumps({"s": sort_by, "o": sort_order, "v": value, "id": item_id}, ensure_ascii=False)
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: str, sort_by: str, sort_order: str) -> tuple:
+    """解析游标，返回 (排序值, id)；游标无效或与当前排序不一致时返回 400"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        value, item_id = payload["v"], int(payload["id"])
+        if sort_by == "watched_at" and value is not None:
+            value = datetime.fromisoformat(value)
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="无效的游标")
+    if payload.get("s") != sort_by or payload.get("o") != sort_order:
+        raise HTTPException(status_code=400, detail="游标与当前排序方式不一致")
+    return value, item_id
+
+
+async def _get_history_by_cursor(
+    db: AsyncSession,
+    query,
+    count_query,
+    sort_column,
+    sort_by: str,
+    sort_order: str,
+    page_size: int,
+    cursor: Optional[str],
+) -> dict:
+    """
+    游标分页：按 (排序字段, id) 排序，排序字段为空的记录排在最后
+
+    非空部分和空值部分分开查询，都可以按 (user_id, watched_at) 等索引（隐含 rowid）范围扫描
+    """
+    ascending = sort_order == "asc"
+    sort_order = "asc" if ascending else "desc"
+    limit = page_size + 1  # 多取一条判断是否还有下一页
+    
+    value, last_id = None, None
+    if cursor:
+        value, last_id = _decode_cursor(cursor, sort_by, sort_order)
+        total_count = None
+    else:
+        # 总数只在第一页计算
+        total_result = await db.execute(count_query)
+        total_count = total_result.scalar() or 0
+    
+    def ordered(q, *columns):
+        return q.order_by(*(c.asc() if ascending else c.desc() for c in columns))
+    
+    items = []
+    if not cursor or value is not None:
+        non_null = query.where(sort_column.isnot(None))
+        if cursor:
+            key, last = tuple_(sort_column, WatchHistory.id), tuple_(value, last_id)
+            non_null = non_null.where(key > last if ascending else key < last)
+        result = await db.execute(ordered(non_null, sort_column, WatchHistory.id).limit(limit))
+        items = list(result.scalars().all())
+        last_id = None
+    
+    if len(items) < limit:
+        # 排序字段为空的部分，只按 id 排序
+        nulls = query.where(sort_column.is_(None))
+        if last_id is not None:
+            nulls = nulls.where(WatchHistory.id > last_id if ascending else WatchHistory.id < last_id)
+        result = await db.execute(ordered(nulls, WatchHistory.id).limit(limit - len(items)))
+        items.extend(result.scalars().all())
+    
+    has_more = len(items) > page_size
+    items = items[:page_size]
+    
+    next_cursor = None
+    if has_more:
+        last = items[-1]
+        next_cursor = _encode_cursor(sort_by, sort_order, getattr(last, sort_column.key), last.id)
+    
+    return {
+        "items": [_history_item(item) for item in items],
+        "total_count": total_count,
+        "page_size": page_size,
+        "next_cursor": next_cursor,
+    }
+
+
 @router.get("/genres")
 async def get_history_genres(
     user_id: str,
@@ -195,16 +303,13 @@ async def get_history_genres(
 ):
     """获取用户观看历史中的所有类型"""
     result = await db.execute(
-        select(WatchHistory.genres).where(WatchHistory.user_id == user_id)
+        select(WatchHistoryGenre.genre)
+        .where(WatchHistoryGenre.user_id == user_id)
+        .distinct()
+        .order_by(WatchHistoryGenre.genre)
     )
     
-    genres_set = set()
-    for row in result.fetchall():
-        if row[0]:
-            for genre in row[0]:
-                genres_set.add(genre)
-    
-    return {"genres": sorted(list(genres_set))}
+    return {"genres": list(result.scalars().all())}
 
 
 @router.post("/sync")
@@ -222,15 +327,50 @@ async def sync_from_emby(
         raise HTTPException(status_code=500, detail=f"同步失败: {str(e)}")
 
 
+def _to_naive_utc(value: datetime) -> datetime:
+    """带时区的时间转换为 naive UTC，与数据库中的时间保持一致"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
 @router.post("/")
 async def add_history(
     user_id: str,
     data: HistoryCreate,
     db: AsyncSession = Depends(get_db),
 ):
-    """手动添加观看记录"""
-    watched_at = data.watched_at or datetime.utcnow()
-    
+    """
+    手动添加观看记录
+
+    (user_id, emby_id) 唯一：该媒体已有记录时视为重看，累加播放次数，观看时间取较新的一次
+    """
+    watched_at = _to_naive_utc(data.watched_at or datetime.utcnow())
+
+    if data.emby_id:
+        result = await db.execute(
+            select(WatchHistory).where(
+                and_(WatchHistory.user_id == user_id, WatchHistory.emby_id == data.emby_id)
+            )
+        )
+        record = result.scalar_one_or_none()
+        if record:
+            # 补录较早的观看不会让最后观看时间倒退，已看完的状态也不会被取消
+            latest = max(record.watched_at, watched_at) if record.watched_at else watched_at
+            if latest != record.watched_at:
+                await apply_rollup_changes(
+                    db,
+                    user_id,
+                    added=[(latest, record.media_type, record.runtime_minutes)],
+                    removed=[(record.watched_at, record.media_type, record.runtime_minutes)],
+                )
+                record.watched_at = latest
+            record.watched = bool(record.watched or data.watched)
+            record.watch_progress = max(record.watch_progress or 0, data.watch_progress or 0)
+            record.play_count = (record.play_count or 0) + 1
+            await db.commit()
+            return {"id": record.id, "message": "已更新已有记录"}
+
     new_record = WatchHistory(
         user_id=user_id,
         emby_id=data.emby_id,
@@ -252,6 +392,9 @@ async def add_history(
     )
     
     db.add(new_record)
+    await apply_rollup_changes(
+        db, user_id, added=[(watched_at, new_record.media_type, new_record.runtime_minutes)]
+    )
     await db.commit()
     await db.refresh(new_record)
     
@@ -276,7 +419,14 @@ async def update_history(
     if data.watch_progress is not None:
         record.watch_progress = data.watch_progress
     if data.watched_at is not None:
-        record.watched_at = data.watched_at
+        watched_at = _to_naive_utc(data.watched_at)
+        await apply_rollup_changes(
+            db,
+            record.user_id,
+            added=[(watched_at, record.media_type, record.runtime_minutes)],
+            removed=[(record.watched_at, record.media_type, record.runtime_minutes)],
+        )
+        record.watched_at = watched_at
     if data.play_count is not None:
         record.play_count = data.play_count
     
@@ -297,6 +447,9 @@ async def delete_history(
     if not record:
         raise HTTPException(status_code=404, detail="记录不存在")
     
+    await apply_rollup_changes(
+        db, record.user_id, removed=[(record.watched_at, record.media_type, record.runtime_minutes)]
+    )
     await db.delete(record)
     await db.commit()
     
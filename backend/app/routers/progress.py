@@ -1,13 +1,22 @@
 """剧集进度追踪路由"""
+import asyncio
 from fastapi import APIRouter, Depends, Query, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, func, and_, distinct, literal_column
 from typing import Optional, List
 from collections import defaultdict
 from app.database import get_db
-from app.models import WatchHistory
+from app.models import WatchHistory, SeriesProgress
 from app.services.emby import emby_service
+from app.services.series_tree import get_series_detail, get_series_tree
+from app.services.progress import (
+    EpisodeWatchIndex,
+    find_next_episode,
+    group_watched_shows,
+    refresh_series_progress,
+)
 from app.services.tmdb import tmdb_service
+from app.services.rollup import rebuild_rollup
 
 router = APIRouter(prefix="/progress", tags=["Progress"])
 
@@ -15,215 +24,39 @@ router = APIRouter(prefix="/progress", tags=["Progress"])
 @router.get("/shows")
 async def get_shows_progress(
     user_id: str = Query(..., description="Emby 用户 ID"),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(0, ge=0, le=100, description="每页剧集数，0 表示全部"),
     db: AsyncSession = Depends(get_db),
 ):
     """
     获取所有正在追的剧集进度
     按剧名去重，合并不同 series_id 的记录（解决重建媒体库后的重复问题）
     使用 (season_number, episode_number) 去重，避免多次删除重新添加后进度超过 100%
+
+    读取 series_progress，进度由同步和媒体库扫描时更新；
+    升级后尚未同步过时，按观看历史计算一次并保存
     """
-    # 从观看历史中获取所有看过的剧集，按剧名分组
-    # 使用 (season_number, episode_number) 去重而不是 emby_id，避免重复计算
-    result = await db.execute(
-        select(
-            WatchHistory.series_id,
-            WatchHistory.series_name,
-            func.max(WatchHistory.watched_at).label("last_watched"),
-        )
-        .where(
-            and_(
-                WatchHistory.user_id == user_id,
-                WatchHistory.media_type == "Episode",
-                WatchHistory.series_id.isnot(None),
-                WatchHistory.series_name.isnot(None),
-            )
-        )
-        .group_by(WatchHistory.series_id, WatchHistory.series_name)
-        .order_by(func.max(WatchHistory.watched_at).desc())
+    count_query = select(func.count(SeriesProgress.id)).where(SeriesProgress.user_id == user_id)
+    total_count = (await db.execute(count_query)).scalar() or 0
+    if not total_count and await refresh_series_progress(db, user_id):
+        total_count = (await db.execute(count_query)).scalar() or 0
+
+    # 分页：page_size 为 0 时返回全部
+    query = (
+        select(SeriesProgress.data)
+        .where(SeriesProgress.user_id == user_id)
+        .order_by(SeriesProgress.last_watched.desc().nullslast(), SeriesProgress.id)
     )
+    if page_size:
+        query = query.offset((page - 1) * page_size).limit(page_size)
+    result = await db.execute(query)
 
-    # 按剧名合并记录
-    shows_by_name = {}
-    for row in result.fetchall():
-        series_id, series_name, last_watched = row
-
-        # 标准化剧名（去除空格、转小写）用于比较
-        normalized_name = series_name.strip().lower() if series_name else ""
-
-        if normalized_name not in shows_by_name:
-            shows_by_name[normalized_name] = {
-                "series_ids": [series_id],
-                "series_name": series_name,
-                "last_watched": last_watched,
-                "primary_series_id": series_id,  # 使用最新的 series_id 作为主 ID
-            }
-        else:
-            # 合并记录
-            shows_by_name[normalized_name]["series_ids"].append(series_id)
-            # 使用最新的观看时间
-            if last_watched and (not shows_by_name[normalized_name]["last_watched"] or
-                                 last_watched > shows_by_name[normalized_name]["last_watched"]):
-                shows_by_name[normalized_name]["last_watched"] = last_watched
-                shows_by_name[normalized_name]["primary_series_id"] = series_id
-    
-    shows_progress = []
-
-    for normalized_name, show_data in shows_by_name.items():
-        series_id = show_data["primary_series_id"]
-        series_name = show_data["series_name"]
-        last_watched = show_data["last_watched"]
-
-        try:
-            # 从 Emby 获取剧集详情
-            series_detail = await emby_service.get_item(user_id, series_id)
-
-            # 获取总集数
-            total_episodes = 0
-            seasons_info = []
-
-            # 获取季列表（返回 EmbyMediaItem 对象列表）
-            seasons = await emby_service.get_seasons(user_id, series_id)
-
-            # 收集当前 Emby 中存在的所有剧集的 (season_number, episode_number)
-            current_emby_episodes = set()
-
-            for season in seasons:
-                # season 是 EmbyMediaItem 对象，使用属性访问
-                if season.name and season.name.startswith("Specials"):
-                    continue  # 跳过特别篇
-
-                season_id = season.id
-                season_number = season.index_number or 0
-
-                # 获取该季的集数
-                episodes = await emby_service.get_episodes(user_id, series_id, season_id)
-                season_total = len(episodes)
-                total_episodes += season_total
-
-                # 记录当前存在的剧集
-                for ep in episodes:
-                    current_emby_episodes.add((season_number, ep.index_number or 0))
-
-                # 统计该季已看集数（按 season_number + episode_number 去重，包括所有 series_id 的记录）
-                # 使用子查询来统计不同的 (season_number, episode_number) 组合数量
-                season_watched = await db.execute(
-                    select(func.count(distinct(
-                        func.printf('%d-%d', WatchHistory.season_number, WatchHistory.episode_number)
-                    )))
-                    .where(
-                        and_(
-                            WatchHistory.user_id == user_id,
-                            WatchHistory.series_id.in_(show_data["series_ids"]),
-                            WatchHistory.season_number == season_number,
-                            WatchHistory.episode_number.isnot(None),
-                        )
-                    )
-                )
-                season_watched_count = season_watched.scalar() or 0
-                # 确保不超过实际集数
-                season_watched_count = min(season_watched_count, season_total)
-
-                # 获取每集的观看状态
-                episodes_info = []
-                for ep in sorted(episodes, key=lambda x: x.index_number or 0):
-                    ep_watched_result = await db.execute(
-                        select(WatchHistory)
-                        .where(
-                            and_(
-                                WatchHistory.user_id == user_id,
-                                WatchHistory.emby_id == ep.id,
-                            )
-                        )
-                    )
-                    ep_record = ep_watched_result.scalar_one_or_none()
-
-                    # 如果没有找到记录，尝试用 season_number + episode_number 查找（兼容旧记录）
-                    if not ep_record:
-                        ep_watched_result = await db.execute(
-                            select(WatchHistory)
-                            .where(
-                                and_(
-                                    WatchHistory.user_id == user_id,
-                                    WatchHistory.series_id.in_(show_data["series_ids"]),
-                                    WatchHistory.season_number == season_number,
-                                    WatchHistory.episode_number == ep.index_number,
-                                )
-                            )
-                            .order_by(WatchHistory.watched_at.desc())
-                            .limit(1)
-                        )
-                        ep_record = ep_watched_result.scalar_one_or_none()
-
-                    # 判断是否已看完：watched 为 True 或 进度 >= 90%
-                    progress_percent = ep_record.watch_progress if ep_record else 0
-                    is_watched = False
-                    if ep_record:
-                        is_watched = ep_record.watched or progress_percent >= 90
-
-                    episodes_info.append({
-                        "episode_id": ep.id,
-                        "episode_number": ep.index_number or 0,
-                        "episode_name": ep.name,
-                        "is_watched": is_watched,
-                        "progress_percent": progress_percent if not is_watched else 100,
-                    })
-
-                seasons_info.append({
-                    "season_id": season_id,
-                    "season_number": season_number,
-                    "season_name": season.name,
-                    "total_episodes": season_total,
-                    "watched_episodes": season_watched_count,
-                    "progress": round(season_watched_count / season_total * 100, 1) if season_total > 0 else 0,
-                    "poster_path": season.primary_image_tag,
-                    "episodes": episodes_info,
-                })
-
-            # 计算总的已看集数（按 season_number + episode_number 去重）
-            # 使用 printf 创建唯一标识符来进行去重计数
-            total_watched_result = await db.execute(
-                select(func.count(distinct(
-                    func.printf('%d-%d', WatchHistory.season_number, WatchHistory.episode_number)
-                )))
-                .where(
-                    and_(
-                        WatchHistory.user_id == user_id,
-                        WatchHistory.series_id.in_(show_data["series_ids"]),
-                        WatchHistory.season_number.isnot(None),
-                        WatchHistory.episode_number.isnot(None),
-                    )
-                )
-            )
-            watched_count = total_watched_result.scalar() or 0
-            # 确保不超过实际总集数
-            watched_count = min(watched_count, total_episodes)
-
-            # 计算总进度
-            progress = round(watched_count / total_episodes * 100, 1) if total_episodes > 0 else 0
-
-            # 获取下一集信息
-            next_episode = await get_next_episode(user_id, series_id, db)
-            
-            shows_progress.append({
-                "series_id": series_id,
-                "series_name": series_name or series_detail.name,
-                "poster_path": series_detail.primary_image_tag,
-                "backdrop_path": series_detail.backdrop_image_tag,
-                "total_episodes": total_episodes,
-                "watched_episodes": watched_count,
-                "progress": progress,
-                "last_watched": last_watched.isoformat() if last_watched else None,
-                "seasons": seasons_info,
-                "next_episode": next_episode,
-                "tmdb_id": series_detail.provider_ids.get("Tmdb") if series_detail.provider_ids else None,
-                "status": series_detail.status if hasattr(series_detail, 'status') else None,
-            })
-            
-        except Exception as e:
-            print(f"获取剧集 {series_id} 进度失败: {e}")
-            continue
-    
-    return {"shows": shows_progress}
+    return {
+        "shows": result.scalars().all(),
+        "total_count": total_count,
+        "page": page,
+        "page_size": page_size,
+    }
 
 
 @router.get("/show/{series_id}")
@@ -236,25 +69,23 @@ async def get_show_progress(
     获取单个剧集的详细进度
     """
     try:
-        # 从 Emby 获取剧集详情
-        series_detail = await emby_service.get_item(user_id, series_id)
-        
-        # 获取所有季（返回 EmbyMediaItem 对象列表）
-        seasons = await emby_service.get_seasons(user_id, series_id)
+        # 从 Emby 获取剧集详情和所有季、集（EmbyMediaItem 对象）
+        series_detail, tree = await asyncio.gather(
+            get_series_detail(user_id, series_id),
+            get_series_tree(user_id, series_id),
+        )
+        watch_index = await EpisodeWatchIndex.load(db, user_id)
         
         seasons_progress = []
         total_episodes = 0
         total_watched = 0
         
-        for season in seasons:
+        for season, episodes in tree:
             # season 是 EmbyMediaItem 对象
             season_id = season.id
             season_number = season.index_number or 0
             season_name = season.name or f"第 {season_number} 季"
             
-            # 获取该季所有集（返回 EmbyMediaItem 对象列表）
-            episodes = await emby_service.get_episodes(user_id, series_id, season_id)
-            
             episodes_progress = []
             season_watched = 0
             
@@ -264,16 +95,7 @@ async def get_show_progress(
                 ep_number = ep.index_number or 0
                 
                 # 检查是否已看
-                watched_result = await db.execute(
-                    select(WatchHistory)
-                    .where(
-                        and_(
-                            WatchHistory.user_id == user_id,
-                            WatchHistory.emby_id == ep_id,
-                        )
-                    )
-                )
-                watch_record = watched_result.scalar_one_or_none()
+                watch_record = watch_index.get(ep_id)
                 
                 is_watched = watch_record is not None
                 if is_watched:
@@ -307,7 +129,7 @@ async def get_show_progress(
             })
         
         # 获取下一集
-        next_episode = await get_next_episode(user_id, series_id, db)
+        next_episode = find_next_episode(tree, watch_index)
         
         return {
             "series_id": series_id,
@@ -326,56 +148,6 @@ async def get_show_progress(
         raise HTTPException(status_code=500, detail=f"获取剧集进度失败: {str(e)}")
 
 
-async def get_next_episode(user_id: str, series_id: str, db: AsyncSession):
-    """获取下一集未看的剧集"""
-    try:
-        # 获取所有季（返回 EmbyMediaItem 对象列表）
-        seasons = await emby_service.get_seasons(user_id, series_id)
-        
-        for season in sorted(seasons, key=lambda x: x.index_number or 0):
-            # season 是 EmbyMediaItem 对象
-            if season.name and season.name.startswith("Specials"):
-                continue
-                
-            season_id = season.id
-            season_number = season.index_number or 0
-            
-            # 获取该季所有集（返回 EmbyMediaItem 对象列表）
-            episodes = await emby_service.get_episodes(user_id, series_id, season_id)
-            
-            for ep in sorted(episodes, key=lambda x: x.index_number or 0):
-                # ep 是 EmbyMediaItem 对象
-                ep_id = ep.id
-                
-                # 检查是否已看
-                watched_result = await db.execute(
-                    select(WatchHistory)
-                    .where(
-                        and_(
-                            WatchHistory.user_id == user_id,
-                            WatchHistory.emby_id == ep_id,
-                        )
-                    )
-                )
-                
-                if not watched_result.scalar_one_or_none():
-                    # 找到第一个未看的集
-                    return {
-                        "episode_id": ep_id,
-                        "season_number": season_number,
-                        "episode_number": ep.index_number or 0,
-                        "episode_name": ep.name,
-                        "overview": ep.overview,
-                        "runtime": ep.runtime_ticks // 600000000 if ep.runtime_ticks else 0,
-                        "still_path": ep.primary_image_tag,
-                    }
-        
-        return None  # 全部看完
-        
-    except Exception:
-        return None
-
-
 @router.get("/stats")
 async def get_progress_stats(
     user_id: str = Query(..., description="Emby 用户 ID"),
@@ -384,23 +156,14 @@ async def get_progress_stats(
     """
     获取进度统计概览
     """
-    # 统计正在追的剧集数（按剧名去重）
+    # 统计正在追的剧集数（按剧名去重，读取 series_progress）
     result = await db.execute(
-        select(WatchHistory.series_name)
-        .where(
-            and_(
-                WatchHistory.user_id == user_id,
-                WatchHistory.media_type == "Episode",
-                WatchHistory.series_name.isnot(None),
-            )
-        )
-        .distinct()
+        select(func.count(SeriesProgress.id)).where(SeriesProgress.user_id == user_id)
     )
-    unique_shows = set()
-    for row in result.fetchall():
-        if row[0]:
-            unique_shows.add(row[0].strip().lower())
-    watching_count = len(unique_shows)
+    watching_count = result.scalar() or 0
+    if not watching_count:
+        # 进度尚未计算过时按观看历史统计
+        watching_count = len(await group_watched_shows(db, user_id))
     
     # 统计总观看集数
     episodes_result = await db.execute(
@@ -543,7 +306,10 @@ async def cleanup_duplicate_series(
                 )
             )
         )
+        await rebuild_rollup(db, user_id)
         await db.commit()
+        # 删除的剧集记录从追剧进度中移除
+        await refresh_series_progress(db, user_id)
     
     return {
         "message": "预览模式，未实际删除" if dry_run else f"已删除 {deleted_count} 条重复记录",
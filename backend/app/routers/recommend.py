@@ -5,7 +5,7 @@ from sqlalchemy import select, func, and_
 from typing import Optional, List
 from collections import Counter
 from app.database import get_db
-from app.models import WatchHistory
+from app.models import WatchHistory, WatchHistoryGenre
 from app.services.tmdb import tmdb_service
 from app.services.emby import emby_service
 
@@ -25,25 +25,15 @@ async def get_recommendations_for_you(
     recommendations = []
     
     try:
-        # 1. 分析用户类型偏好
+        # 1. 分析用户类型偏好：获取前3个偏好类型
         result = await db.execute(
-            select(WatchHistory.genres)
-            .where(
-                and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.genres.isnot(None),
-                )
-            )
+            select(WatchHistoryGenre.genre)
+            .where(WatchHistoryGenre.user_id == user_id)
+            .group_by(WatchHistoryGenre.genre)
+            .order_by(func.count().desc(), func.min(WatchHistoryGenre.history_id))
+            .limit(3)
         )
-        
-        genre_counter = Counter()
-        for row in result.fetchall():
-            if row[0]:
-                for genre in row[0]:
-                    genre_counter[genre] += 1
-        
-        # 获取前3个偏好类型
-        top_genres = [g[0] for g in genre_counter.most_common(3)]
+        top_genres = list(result.scalars().all())
         
         if not top_genres:
             # 没有观看历史，返回热门内容
@@ -281,28 +271,29 @@ async def get_genre_preferences(
     获取用户类型偏好分析
     """
     try:
+        # 按 (媒体类型, 类型) 分组计数，按首次出现先后返回，同数量时保持该顺序
         result = await db.execute(
-            select(WatchHistory.genres, WatchHistory.media_type)
+            select(WatchHistory.media_type, WatchHistoryGenre.genre, func.count())
+            .select_from(WatchHistoryGenre)
+            .join(WatchHistory, WatchHistory.id == WatchHistoryGenre.history_id)
             .where(
                 and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.genres.isnot(None),
+                    WatchHistoryGenre.user_id == user_id,
+                    WatchHistory.media_type.in_(["Movie", "Episode"]),
                 )
             )
+            .group_by(WatchHistory.media_type, WatchHistoryGenre.genre)
+            .order_by(func.min(WatchHistoryGenre.history_id))
         )
         
         movie_genres = Counter()
         tv_genres = Counter()
         
-        for row in result.fetchall():
-            genres, media_type = row
-            if genres:
-                if media_type == "Movie":
-                    for g in genres:
-                        movie_genres[g] += 1
-                elif media_type == "Episode":
-                    for g in genres:
-                        tv_genres[g] += 1
+        for media_type, genre, count in result.all():
+            if media_type == "Movie":
+                movie_genres[genre] = count
+            else:
+                tv_genres[genre] = count
         
         return {
             "movie_preferences": dict(movie_genres.most_common(10)),
@@ -1,17 +1,34 @@
 from fastapi import APIRouter, Depends, Query
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, func, and_, extract
+from sqlalchemy import select, func, and_, or_, extract
 from typing import Optional
 from datetime import datetime, timedelta
 from collections import defaultdict
 from app.database import get_db
-from app.models import WatchHistory, Watchlist
+from app.models import WatchHistory, WatchHistoryGenre, Watchlist, WatchDailyRollup, YearlyReviewCache, LibraryItemIndex
 from app.schemas import WatchStats
-from app.services.emby import emby_service
+from app.services.library_stats import get_library_counts
 
 router = APIRouter(prefix="/stats", tags=["Statistics"])
 
 
+def _library_index_filter(user_id: str, library_ids: Optional[str], media_type: Optional[str]):
+    """媒体库条目索引的通用筛选：用户、已看、可见媒体库和类型"""
+    conditions = [
+        LibraryItemIndex.user_id == user_id,
+        LibraryItemIndex.played == True,
+    ]
+    if library_ids:
+        conditions.append(LibraryItemIndex.library_id.in_(library_ids.split(",")))
+    if media_type == "movie":
+        conditions.append(LibraryItemIndex.item_type == "Movie")
+    elif media_type == "show":
+        conditions.append(LibraryItemIndex.item_type == "Series")
+    else:
+        conditions.append(LibraryItemIndex.item_type.in_(["Movie", "Series"]))
+    return and_(*conditions)
+
+
 @router.get("/overview/{user_id}")
 async def get_overview_stats(
     user_id: str,
@@ -71,90 +88,22 @@ async def get_overview_stats(
         result["total_watch_time_minutes"] = int(movie_time + episode_time)
         result["total_watch_time_days"] = round(result["total_watch_time_minutes"] / 1440, 1)
 
-        # 从 Emby 获取当前媒体库统计（总数和已看数量）
-        libraries = await emby_service.get_libraries(user_id)
-
-        for library in libraries:
-            if visible_library_ids and library.id not in visible_library_ids:
+        # 从媒体库数量快照获取总数和已看数量
+        for counts in await get_library_counts(user_id):
+            if visible_library_ids and counts["library_id"] not in visible_library_ids:
                 continue
 
-            if library.collection_type == "movies":
-                # 电影总数
-                total_items = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Movie",
-                    limit=1,
-                )
-                result["movies"]["total"] += total_items.total_count
-
-                # 已看电影（包括完全看完和正在观看的）
-                watched_items = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Movie",
-                    is_played=True,
-                    limit=500,
-                )
-                result["movies"]["watched"] += watched_items.total_count
-
-                # 正在观看的电影（有播放进度但未完成）
-                # 通过 Filters=IsResumable 获取
-                try:
-                    resume_items = await emby_service.get_items(
-                        user_id=user_id,
-                        parent_id=library.id,
-                        include_item_types="Movie",
-                        filters="IsResumable",
-                        limit=100,
-                    )
-                    # 正在观看的也计入已看数量
-                    result["movies"]["watched"] += resume_items.total_count
-                except:
-                    pass
-
-            elif library.collection_type == "tvshows":
-                # 剧集总数
-                total_shows = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Series",
-                    limit=1,
-                )
-                result["shows"]["total"] += total_shows.total_count
-
-                # 集数总数
-                total_episodes = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Episode",
-                    limit=1,
-                )
-                result["shows"]["episodes_total"] += total_episodes.total_count
+            if counts["collection_type"] == "movies":
+                result["movies"]["total"] += counts["movies"]
+                # 正在观看的也计入已看数量
+                result["movies"]["watched"] += counts["movies_played"] + counts["movies_resumable"]
 
-                # 已看集数
-                watched_episodes = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Episode",
-                    is_played=True,
-                    limit=500,
+            elif counts["collection_type"] == "tvshows":
+                result["shows"]["total"] += counts["series"]
+                result["shows"]["episodes_total"] += counts["episodes"]
+                result["shows"]["episodes_watched"] += (
+                    counts["episodes_played"] + counts["episodes_resumable"]
                 )
-                result["shows"]["episodes_watched"] += watched_episodes.total_count
-
-                # 正在观看的剧集
-                try:
-                    resume_episodes = await emby_service.get_items(
-                        user_id=user_id,
-                        parent_id=library.id,
-                        include_item_types="Episode",
-                        filters="IsResumable",
-                        limit=100,
-                    )
-                    result["shows"]["episodes_watched"] += resume_episodes.total_count
-                except:
-                    pass
-                result["shows"]["episodes_watched"] += watched_episodes.total_count
 
         # 计算进度百分比
         if result["movies"]["total"] > 0:
@@ -184,31 +133,32 @@ async def get_genre_stats(
     media_type: Optional[str] = Query(None, description="movie 或 show"),
     db: AsyncSession = Depends(get_db),
 ):
-    """获取类型分布统计 - 基于本地历史记录"""
+    """获取类型分布统计 - 基于本地历史记录的类型索引"""
     genres_count = {}
     
     try:
-        # 从本地历史记录获取
-        query = select(WatchHistory).where(WatchHistory.user_id == user_id)
+        # 按类型分组计数，同数量时按首次添加先后排序
+        query = (
+            select(WatchHistoryGenre.genre, func.count())
+            .where(WatchHistoryGenre.user_id == user_id)
+            .group_by(WatchHistoryGenre.genre)
+            .order_by(func.count().desc(), func.min(WatchHistoryGenre.history_id))
+            .limit(15)
+        )
         
-        if media_type == "movie":
-            query = query.where(WatchHistory.media_type == "Movie")
-        elif media_type == "show":
-            query = query.where(WatchHistory.media_type == "Series")
+        type_filter = {"movie": "Movie", "show": "Series"}.get(media_type)
+        if type_filter:
+            query = query.join(WatchHistory, WatchHistory.id == WatchHistoryGenre.history_id).where(
+                WatchHistory.media_type == type_filter
+            )
         
         result = await db.execute(query)
-        history_items = result.scalars().all()
-        
-        for item in history_items:
-            if item.genres:
-                for genre in item.genres:
-                    genres_count[genre] = genres_count.get(genre, 0) + 1
+        genres_count = dict(result.all())
                 
     except Exception as e:
         print(f"Error fetching genre stats: {e}")
     
-    sorted_genres = sorted(genres_count.items(), key=lambda x: x[1], reverse=True)
-    return {"genres": dict(sorted_genres[:15])}
+    return {"genres": genres_count}
 
 
 @router.get("/years/{user_id}")
@@ -216,42 +166,30 @@ async def get_year_stats(
     user_id: str,
     library_ids: Optional[str] = Query(None, description="逗号分隔的媒体库ID列表"),
     media_type: Optional[str] = Query(None, description="movie 或 show"),
+    db: AsyncSession = Depends(get_db),
 ):
     """获取年份分布统计"""
     years_count = {}
-    visible_library_ids = library_ids.split(",") if library_ids else None
     
     try:
-        libraries = await emby_service.get_libraries(user_id)
-        
-        for library in libraries:
-            if visible_library_ids and library.id not in visible_library_ids:
-                continue
-            
-            if media_type == "movie" and library.collection_type != "movies":
-                continue
-            if media_type == "show" and library.collection_type != "tvshows":
-                continue
-            
-            if library.collection_type in ["movies", "tvshows"]:
-                items = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Movie" if library.collection_type == "movies" else "Series",
-                    is_played=True,
-                    limit=500,
+        query = (
+            select(LibraryItemIndex.year, func.count(LibraryItemIndex.id))
+            .where(
+                and_(
+                    _library_index_filter(user_id, library_ids, media_type),
+                    LibraryItemIndex.year.isnot(None),
                 )
-                
-                for item in items.items:
-                    if item.year:
-                        years_count[item.year] = years_count.get(item.year, 0) + 1
+            )
+            .group_by(LibraryItemIndex.year)
+            .order_by(LibraryItemIndex.year)
+        )
+        result = await db.execute(query)
+        years_count = {year: count for year, count in result.all()}
                 
     except Exception as e:
         print(f"Error fetching year stats: {e}")
     
-    # 按年份排序
-    sorted_years = sorted(years_count.items(), key=lambda x: x[0])
-    return {"years": dict(sorted_years)}
+    return {"years": years_count}
 
 
 @router.get("/ratings/{user_id}")
@@ -375,52 +313,38 @@ async def get_top_rated(
     library_ids: Optional[str] = Query(None, description="逗号分隔的媒体库ID列表"),
     media_type: str = Query("movie", description="movie 或 show"),
     limit: int = Query(10, ge=1, le=50),
+    db: AsyncSession = Depends(get_db),
 ):
     """获取评分最高的已看内容"""
-    visible_library_ids = library_ids.split(",") if library_ids else None
     items = []
     
     try:
-        libraries = await emby_service.get_libraries(user_id)
-        
-        for library in libraries:
-            if visible_library_ids and library.id not in visible_library_ids:
-                continue
-            
-            if media_type == "movie" and library.collection_type != "movies":
-                continue
-            if media_type == "show" and library.collection_type != "tvshows":
-                continue
-            
-            if library.collection_type in ["movies", "tvshows"]:
-                result = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Movie" if library.collection_type == "movies" else "Series",
-                    is_played=True,
-                    sort_by="CommunityRating",
-                    sort_order="Descending",
-                    limit=limit,
+        result = await db.execute(
+            select(LibraryItemIndex)
+            .where(
+                and_(
+                    _library_index_filter(user_id, library_ids, media_type),
+                    LibraryItemIndex.community_rating > 0,
                 )
-                
-                for item in result.items:
-                    if item.community_rating:
-                        items.append({
-                            "id": item.id,
-                            "name": item.name,
-                            "type": item.type,
-                            "year": item.year,
-                            "community_rating": item.community_rating,
-                            "genres": item.genres[:3],
-                        })
+            )
+            .order_by(LibraryItemIndex.community_rating.desc())
+            .limit(limit)
+        )
         
-        # 按评分排序
-        items.sort(key=lambda x: x["community_rating"] or 0, reverse=True)
+        for item in result.scalars().all():
+            items.append({
+                "id": item.item_id,
+                "name": item.name,
+                "type": item.item_type,
+                "year": item.year,
+                "community_rating": item.community_rating,
+                "genres": (item.genres or [])[:3],
+            })
         
     except Exception as e:
         print(f"Error fetching top rated: {e}")
     
-    return {"items": items[:limit]}
+    return {"items": items}
 
 
 # 保留旧的 API 以兼容
@@ -435,55 +359,18 @@ async def get_stats(
     visible_library_ids = library_ids.split(",") if library_ids else None
     
     try:
-        libraries = await emby_service.get_libraries(user_id)
-        
-        for library in libraries:
-            if visible_library_ids and library.id not in visible_library_ids:
+        for counts in await get_library_counts(user_id):
+            if visible_library_ids and counts["library_id"] not in visible_library_ids:
                 continue
                 
-            if library.collection_type == "movies":
-                items = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Movie",
-                    limit=1,
-                )
-                stats.total_movies += items.total_count
-                
-                watched_items = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Movie",
-                    is_played=True,
-                    limit=1,
-                )
-                stats.watched_movies += watched_items.total_count
-                
-            elif library.collection_type == "tvshows":
-                items = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Series",
-                    limit=1,
-                )
-                stats.total_shows += items.total_count
+            if counts["collection_type"] == "movies":
+                stats.total_movies += counts["movies"]
+                stats.watched_movies += counts["movies_played"]
                 
-                episodes = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Episode",
-                    limit=1,
-                )
-                stats.total_episodes += episodes.total_count
-                
-                watched_episodes = await emby_service.get_items(
-                    user_id=user_id,
-                    parent_id=library.id,
-                    include_item_types="Episode",
-                    is_played=True,
-                    limit=1,
-                )
-                stats.watched_episodes += watched_episodes.total_count
+            elif counts["collection_type"] == "tvshows":
+                stats.total_shows += counts["series"]
+                stats.total_episodes += counts["episodes"]
+                stats.watched_episodes += counts["episodes_played"]
     except Exception:
         pass
     
@@ -493,6 +380,17 @@ async def get_stats(
     return stats
 
 
+def _rollup_range(start: datetime, end: datetime):
+    """按 (date, hour) 粒度筛选汇总表中 [start, end] 范围内的数据"""
+    start_day, end_day = start.date(), end.date()
+    return and_(
+        WatchDailyRollup.date >= start_day,
+        WatchDailyRollup.date <= end_day,
+        or_(WatchDailyRollup.date != start_day, WatchDailyRollup.hour >= start.hour),
+        or_(WatchDailyRollup.date != end_day, WatchDailyRollup.hour <= end.hour),
+    )
+
+
 @router.get("/trends/{user_id}")
 async def get_watch_trends(
     user_id: str,
@@ -514,27 +412,30 @@ async def get_watch_trends(
         current += timedelta(days=1)
     
     try:
-        # 查询指定时间范围内的观看记录
+        # 从每日汇总表按日期和类型聚合
         result = await db.execute(
-            select(WatchHistory)
+            select(
+                WatchDailyRollup.date,
+                WatchDailyRollup.media_type,
+                func.sum(WatchDailyRollup.count),
+            )
             .where(
                 and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at >= start_date,
-                    WatchHistory.watched_at <= end_date,
+                    WatchDailyRollup.user_id == user_id,
+                    _rollup_range(start_date, end_date),
                 )
             )
+            .group_by(WatchDailyRollup.date, WatchDailyRollup.media_type)
         )
         
-        for item in result.scalars().all():
-            if item.watched_at:
-                date_str = item.watched_at.strftime("%Y-%m-%d")
-                if date_str in daily_data:
-                    if item.media_type == "Movie":
-                        daily_data[date_str]["movies"] += 1
-                    elif item.media_type == "Episode":
-                        daily_data[date_str]["episodes"] += 1
-                    daily_data[date_str]["total"] += 1
+        for day, media_type, count in result.all():
+            date_str = day.strftime("%Y-%m-%d")
+            if date_str in daily_data:
+                if media_type == "Movie":
+                    daily_data[date_str]["movies"] += count
+                elif media_type == "Episode":
+                    daily_data[date_str]["episodes"] += count
+                daily_data[date_str]["total"] += count
                     
     except Exception as e:
         print(f"Error fetching watch trends: {e}")
@@ -565,26 +466,20 @@ async def get_time_distribution(
     
     try:
         result = await db.execute(
-            select(WatchHistory)
-            .where(
-                and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at.isnot(None),
-                )
-            )
+            select(WatchDailyRollup.hour, func.sum(WatchDailyRollup.count))
+            .where(WatchDailyRollup.user_id == user_id)
+            .group_by(WatchDailyRollup.hour)
         )
         
-        for item in result.scalars().all():
-            if item.watched_at:
-                hour = item.watched_at.hour
-                if 6 <= hour < 12:
-                    distribution["morning"]["count"] += 1
-                elif 12 <= hour < 18:
-                    distribution["afternoon"]["count"] += 1
-                elif 18 <= hour < 24:
-                    distribution["evening"]["count"] += 1
-                else:
-                    distribution["night"]["count"] += 1
+        for hour, count in result.all():
+            if 6 <= hour < 12:
+                distribution["morning"]["count"] += count
+            elif 12 <= hour < 18:
+                distribution["afternoon"]["count"] += count
+            elif 18 <= hour < 24:
+                distribution["evening"]["count"] += count
+            else:
+                distribution["night"]["count"] += count
                     
     except Exception as e:
         print(f"Error fetching time distribution: {e}")
@@ -609,22 +504,21 @@ async def get_watch_heatmap(
     
     try:
         result = await db.execute(
-            select(WatchHistory)
+            select(WatchDailyRollup.date, func.sum(WatchDailyRollup.count))
             .where(
                 and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at >= start_date,
-                    WatchHistory.watched_at <= end_date,
+                    WatchDailyRollup.user_id == user_id,
+                    _rollup_range(start_date, end_date),
                 )
             )
+            .group_by(WatchDailyRollup.date)
         )
         
         # 按日期统计
-        daily_counts = defaultdict(int)
-        for item in result.scalars().all():
-            if item.watched_at:
-                date_str = item.watched_at.strftime("%Y-%m-%d")
-                daily_counts[date_str] += 1
+        daily_counts = {
+            day.strftime("%Y-%m-%d"): count
+            for day, count in result.all()
+        }
         
         # 生成热力图数据
         current = start_date
@@ -667,22 +561,13 @@ async def get_watch_streak(
     获取观看连续天数统计
     """
     try:
+        # 获取所有观看日期（汇总表中每个日期至少有一条记录）
         result = await db.execute(
-            select(WatchHistory.watched_at)
-            .where(
-                and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at.isnot(None),
-                )
-            )
-            .order_by(WatchHistory.watched_at.desc())
+            select(WatchDailyRollup.date)
+            .where(WatchDailyRollup.user_id == user_id)
+            .distinct()
         )
-        
-        # 获取所有观看日期（去重）
-        watch_dates = set()
-        for row in result.fetchall():
-            if row[0]:
-                watch_dates.add(row[0].date())
+        watch_dates = set(result.scalars().all())
         
         if not watch_dates:
             return {
@@ -754,27 +639,30 @@ async def get_monthly_stats(
         end_date = datetime(year, 12, 31, 23, 59, 59)
         
         result = await db.execute(
-            select(WatchHistory)
+            select(
+                WatchDailyRollup.date,
+                WatchDailyRollup.media_type,
+                func.sum(WatchDailyRollup.count),
+                func.sum(WatchDailyRollup.runtime_minutes),
+            )
             .where(
                 and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at >= start_date,
-                    WatchHistory.watched_at <= end_date,
+                    WatchDailyRollup.user_id == user_id,
+                    WatchDailyRollup.date >= start_date.date(),
+                    WatchDailyRollup.date <= end_date.date(),
                 )
             )
+            .group_by(WatchDailyRollup.date, WatchDailyRollup.media_type)
         )
         
-        for item in result.scalars().all():
-            if item.watched_at:
-                month = item.watched_at.month
-                if item.media_type == "Movie":
-                    monthly_data[month]["movies"] += 1
-                elif item.media_type == "Episode":
-                    monthly_data[month]["episodes"] += 1
-                monthly_data[month]["total"] += 1
-                
-                if item.runtime_minutes:
-                    monthly_data[month]["watch_time"] += item.runtime_minutes
+        for day, media_type, count, minutes in result.all():
+            month = day.month
+            if media_type == "Movie":
+                monthly_data[month]["movies"] += count
+            elif media_type == "Episode":
+                monthly_data[month]["episodes"] += count
+            monthly_data[month]["total"] += count
+            monthly_data[month]["watch_time"] += minutes or 0
                     
     except Exception as e:
         print(f"Error fetching monthly stats: {e}")
@@ -801,19 +689,13 @@ async def get_weekday_stats(
     
     try:
         result = await db.execute(
-            select(WatchHistory)
-            .where(
-                and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at.isnot(None),
-                )
-            )
+            select(WatchDailyRollup.date, func.sum(WatchDailyRollup.count))
+            .where(WatchDailyRollup.user_id == user_id)
+            .group_by(WatchDailyRollup.date)
         )
         
-        for item in result.scalars().all():
-            if item.watched_at:
-                weekday = item.watched_at.weekday()
-                weekday_data[weekday]["count"] += 1
+        for day, count in result.all():
+            weekday_data[day.weekday()]["count"] += count
                 
     except Exception as e:
         print(f"Error fetching weekday stats: {e}")
@@ -829,14 +711,42 @@ async def get_yearly_review(
 ):
     """
     获取年度回顾 - 类似 Spotify Wrapped / Trakt Year in Review
+    
+    已结束年份的结果会持久缓存，该年观看记录变化时失效
     """
     if year is None:
         year = datetime.now().year
+    closed_year = year < datetime.now().year
     
-    start_date = datetime(year, 1, 1)
-    end_date = datetime(year, 12, 31, 23, 59, 59)
+    if closed_year:
+        cached = await db.execute(
+            select(YearlyReviewCache.data).where(
+                and_(YearlyReviewCache.user_id == user_id, YearlyReviewCache.year == year)
+            )
+        )
+        data = cached.scalar_one_or_none()
+        if data is not None:
+            return data
+    
+    try:
+        review = await _build_yearly_review(db, user_id, year)
+    except Exception as e:
+        print(f"Error fetching yearly review: {e}")
+        return _empty_yearly_review(year)
+    
+    if closed_year:
+        try:
+            db.add(YearlyReviewCache(user_id=user_id, year=year, data=review))
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            print(f"Error caching yearly review: {e}")
     
-    review = {
+    return review
+
+
+def _empty_yearly_review(year: int) -> dict:
+    return {
         "year": year,
         "summary": {
             "total_movies": 0,
@@ -860,216 +770,251 @@ async def get_yearly_review(
         "favorite_time": None,  # 最爱观看时段
         "longest_streak": 0,  # 最长连续观看天数
     }
+
+
+async def _build_yearly_review(db: AsyncSession, user_id: str, year: int) -> dict:
+    """用分组查询计算年度回顾，只读取聚合结果而不加载每条记录"""
+    review = _empty_yearly_review(year)
     
-    try:
-        # 查询年度所有观看记录
-        result = await db.execute(
-            select(WatchHistory)
-            .where(
-                and_(
-                    WatchHistory.user_id == user_id,
-                    WatchHistory.watched_at >= start_date,
-                    WatchHistory.watched_at <= end_date,
-                )
+    start_date = datetime(year, 1, 1)
+    end_date = datetime(year, 12, 31, 23, 59, 59)
+    in_year = and_(
+        WatchHistory.user_id == user_id,
+        WatchHistory.watched_at >= start_date,
+        WatchHistory.watched_at <= end_date,
+    )
+    
+    # 按日期、小时、类型汇总的数量和时长（来自每日汇总表）
+    result = await db.execute(
+        select(
+            WatchDailyRollup.date,
+            WatchDailyRollup.hour,
+            WatchDailyRollup.media_type,
+            WatchDailyRollup.count,
+            WatchDailyRollup.runtime_minutes,
+        )
+        .where(
+            and_(
+                WatchDailyRollup.user_id == user_id,
+                WatchDailyRollup.date >= start_date.date(),
+                WatchDailyRollup.date <= end_date.date(),
             )
-            .order_by(WatchHistory.watched_at)
         )
-        
-        items = result.scalars().all()
-        
-        if not items:
-            return review
-        
-        # 基础统计
-        genres_count = defaultdict(int)
-        series_count = defaultdict(lambda: {"name": "", "count": 0, "tmdb_id": None})
-        monthly_count = defaultdict(lambda: {"movies": 0, "episodes": 0, "watch_time": 0})
-        daily_count = defaultdict(int)
-        time_slots = {"morning": 0, "afternoon": 0, "evening": 0, "night": 0}
-        watch_dates = set()
-        
-        movies = []
-        shows = []
-        
-        for item in items:
-            # 总数统计
-            if item.media_type == "Movie":
-                review["summary"]["total_movies"] += 1
-                if item.community_rating:
-                    movies.append({
-                        "title": item.title,
-                        "year": item.year,
-                        "rating": item.community_rating,
-                        "tmdb_id": item.tmdb_id,
-                        "watched_at": item.watched_at.isoformat() if item.watched_at else None,
-                    })
-            elif item.media_type == "Episode":
-                review["summary"]["total_episodes"] += 1
-                # 统计剧集
-                if item.series_name:
-                    series_count[item.series_name]["name"] = item.series_name
-                    series_count[item.series_name]["count"] += 1
-                    if item.tmdb_id:
-                        series_count[item.series_name]["tmdb_id"] = item.tmdb_id
-            elif item.media_type == "Series":
-                if item.community_rating:
-                    shows.append({
-                        "title": item.title,
-                        "year": item.year,
-                        "rating": item.community_rating,
-                        "tmdb_id": item.tmdb_id,
-                    })
-            
-            review["summary"]["total_items"] += 1
-            
-            # 观看时长
-            if item.runtime_minutes:
-                review["summary"]["total_watch_time_minutes"] += item.runtime_minutes
-            
-            # 类型统计
-            if item.genres:
-                for genre in item.genres:
-                    genres_count[genre] += 1
-            
-            # 月度统计
-            if item.watched_at:
-                month = item.watched_at.month
-                if item.media_type == "Movie":
-                    monthly_count[month]["movies"] += 1
-                elif item.media_type == "Episode":
-                    monthly_count[month]["episodes"] += 1
-                if item.runtime_minutes:
-                    monthly_count[month]["watch_time"] += item.runtime_minutes
-                
-                # 日期统计
-                date_str = item.watched_at.strftime("%Y-%m-%d")
-                daily_count[date_str] += 1
-                watch_dates.add(item.watched_at.date())
-                
-                # 时段统计
-                hour = item.watched_at.hour
-                if 6 <= hour < 12:
-                    time_slots["morning"] += 1
-                elif 12 <= hour < 18:
-                    time_slots["afternoon"] += 1
-                elif 18 <= hour < 24:
-                    time_slots["evening"] += 1
-                else:
-                    time_slots["night"] += 1
-        
-        # 计算汇总数据
-        review["summary"]["total_watch_time_hours"] = round(review["summary"]["total_watch_time_minutes"] / 60, 1)
-        review["summary"]["total_watch_time_days"] = round(review["summary"]["total_watch_time_minutes"] / 1440, 1)
-        review["summary"]["watch_days"] = len(watch_dates)
-        
-        if review["summary"]["watch_days"] > 0:
-            review["summary"]["average_per_day"] = round(
-                review["summary"]["total_items"] / review["summary"]["watch_days"], 1
+    )
+    buckets = result.all()
+    
+    if not buckets:
+        return review
+    
+    monthly_count = defaultdict(lambda: {"movies": 0, "episodes": 0, "watch_time": 0})
+    daily_count = defaultdict(int)
+    time_slots = {"morning": 0, "afternoon": 0, "evening": 0, "night": 0}
+    
+    for day, hour, media_type, count, minutes in buckets:
+        # 总数统计
+        if media_type == "Movie":
+            review["summary"]["total_movies"] += count
+            monthly_count[day.month]["movies"] += count
+        elif media_type == "Episode":
+            review["summary"]["total_episodes"] += count
+            monthly_count[day.month]["episodes"] += count
+        review["summary"]["total_items"] += count
+        
+        # 观看时长
+        review["summary"]["total_watch_time_minutes"] += minutes or 0
+        monthly_count[day.month]["watch_time"] += minutes or 0
+        
+        # 日期统计
+        daily_count[day] += count
+        
+        # 时段统计
+        if 6 <= hour < 12:
+            time_slots["morning"] += count
+        elif 12 <= hour < 18:
+            time_slots["afternoon"] += count
+        elif 18 <= hour < 24:
+            time_slots["evening"] += count
+        else:
+            time_slots["night"] += count
+    
+    # 计算汇总数据
+    review["summary"]["total_watch_time_hours"] = round(review["summary"]["total_watch_time_minutes"] / 60, 1)
+    review["summary"]["total_watch_time_days"] = round(review["summary"]["total_watch_time_minutes"] / 1440, 1)
+    review["summary"]["watch_days"] = len(daily_count)
+    
+    if review["summary"]["watch_days"] > 0:
+        review["summary"]["average_per_day"] = round(
+            review["summary"]["total_items"] / review["summary"]["watch_days"], 1
+        )
+    
+    # 最爱类型 (Top 5)，同数量时按首次观看先后排序
+    result = await db.execute(
+        select(WatchHistoryGenre.genre, func.count())
+        .select_from(WatchHistory)
+        .join(WatchHistoryGenre, WatchHistoryGenre.history_id == WatchHistory.id)
+        .where(in_year)
+        .group_by(WatchHistoryGenre.genre)
+        .order_by(func.count().desc(), func.min(WatchHistory.watched_at))
+        .limit(5)
+    )
+    review["top_genres"] = [{"name": name, "count": count} for name, count in result.all()]
+    
+    # 评分最高的电影 (Top 5)
+    result = await db.execute(
+        select(
+            WatchHistory.title,
+            WatchHistory.year,
+            WatchHistory.community_rating,
+            WatchHistory.tmdb_id,
+            WatchHistory.watched_at,
+        )
+        .where(and_(in_year, WatchHistory.media_type == "Movie", WatchHistory.community_rating > 0))
+        .order_by(WatchHistory.community_rating.desc(), WatchHistory.watched_at)
+        .limit(5)
+    )
+    review["top_movies"] = [
+        {
+            "title": row.title,
+            "year": row.year,
+            "rating": row.community_rating,
+            "tmdb_id": row.tmdb_id,
+            "watched_at": row.watched_at.isoformat() if row.watched_at else None,
+        }
+        for row in result.all()
+    ]
+    
+    # 评分最高的剧集 (Top 5)
+    result = await db.execute(
+        select(
+            WatchHistory.title,
+            WatchHistory.year,
+            WatchHistory.community_rating,
+            WatchHistory.tmdb_id,
+        )
+        .where(and_(in_year, WatchHistory.media_type == "Series", WatchHistory.community_rating > 0))
+        .order_by(WatchHistory.community_rating.desc(), WatchHistory.watched_at)
+        .limit(5)
+    )
+    review["top_shows"] = [
+        {
+            "title": row.title,
+            "year": row.year,
+            "rating": row.community_rating,
+            "tmdb_id": row.tmdb_id,
+        }
+        for row in result.all()
+    ]
+    
+    # 看得最多的剧集 (Top 5)
+    result = await db.execute(
+        select(
+            WatchHistory.series_name,
+            func.count(WatchHistory.id),
+            func.max(WatchHistory.tmdb_id),
+        )
+        .where(
+            and_(
+                in_year,
+                WatchHistory.media_type == "Episode",
+                WatchHistory.series_name.isnot(None),
+                WatchHistory.series_name != "",
             )
-        
-        # 最爱类型 (Top 5)
-        sorted_genres = sorted(genres_count.items(), key=lambda x: x[1], reverse=True)[:5]
-        review["top_genres"] = [{"name": g[0], "count": g[1]} for g in sorted_genres]
-        
-        # 评分最高的电影 (Top 5)
-        movies.sort(key=lambda x: x["rating"] or 0, reverse=True)
-        review["top_movies"] = movies[:5]
-        
-        # 评分最高的剧集 (Top 5)
-        shows.sort(key=lambda x: x["rating"] or 0, reverse=True)
-        review["top_shows"] = shows[:5]
-        
-        # 看得最多的剧集 (Top 5)
-        sorted_series = sorted(series_count.values(), key=lambda x: x["count"], reverse=True)[:5]
-        review["most_watched_series"] = sorted_series
-        
-        # 月度分布
-        month_names = ["", "一月", "二月", "三月", "四月", "五月", "六月", 
-                       "七月", "八月", "九月", "十月", "十一月", "十二月"]
-        review["monthly_breakdown"] = [
-            {
-                "month": i,
-                "name": month_names[i],
-                "movies": monthly_count[i]["movies"],
-                "episodes": monthly_count[i]["episodes"],
-                "total": monthly_count[i]["movies"] + monthly_count[i]["episodes"],
-                "watch_time_hours": round(monthly_count[i]["watch_time"] / 60, 1),
-            }
-            for i in range(1, 13)
-        ]
-        
-        # 第一部和最后一部
-        if items:
-            first = items[0]
-            review["first_watch"] = {
-                "title": first.title,
-                "type": first.media_type,
-                "date": first.watched_at.strftime("%Y-%m-%d") if first.watched_at else None,
-            }
-            last = items[-1]
-            review["last_watch"] = {
-                "title": last.title,
-                "type": last.media_type,
-                "date": last.watched_at.strftime("%Y-%m-%d") if last.watched_at else None,
-            }
-        
-        # 最忙的一天
-        if daily_count:
-            busiest = max(daily_count.items(), key=lambda x: x[1])
-            review["busiest_day"] = {"date": busiest[0], "count": busiest[1]}
-        
-        # 最爱时段
-        if time_slots:
-            time_labels = {
-                "morning": "早间 (6-12点)",
-                "afternoon": "下午 (12-18点)",
-                "evening": "晚间 (18-24点)",
-                "night": "深夜 (0-6点)",
+        )
+        .group_by(WatchHistory.series_name)
+        .order_by(func.count(WatchHistory.id).desc(), func.min(WatchHistory.watched_at))
+        .limit(5)
+    )
+    review["most_watched_series"] = [
+        {"name": name, "count": count, "tmdb_id": tmdb_id}
+        for name, count, tmdb_id in result.all()
+    ]
+    
+    # 月度分布
+    month_names = ["", "一月", "二月", "三月", "四月", "五月", "六月", 
+                   "七月", "八月", "九月", "十月", "十一月", "十二月"]
+    review["monthly_breakdown"] = [
+        {
+            "month": i,
+            "name": month_names[i],
+            "movies": monthly_count[i]["movies"],
+            "episodes": monthly_count[i]["episodes"],
+            "total": monthly_count[i]["movies"] + monthly_count[i]["episodes"],
+            "watch_time_hours": round(monthly_count[i]["watch_time"] / 60, 1),
+        }
+        for i in range(1, 13)
+    ]
+    
+    # 第一部和最后一部
+    first_last = (
+        ("first_watch", (WatchHistory.watched_at.asc(), WatchHistory.id.asc())),
+        ("last_watch", (WatchHistory.watched_at.desc(), WatchHistory.id.desc())),
+    )
+    for key, order in first_last:
+        result = await db.execute(
+            select(WatchHistory.title, WatchHistory.media_type, WatchHistory.watched_at)
+            .where(in_year)
+            .order_by(*order)
+            .limit(1)
+        )
+        row = result.first()
+        if row:
+            review[key] = {
+                "title": row.title,
+                "type": row.media_type,
+                "date": row.watched_at.strftime("%Y-%m-%d") if row.watched_at else None,
             }
-            favorite = max(time_slots.items(), key=lambda x: x[1])
-            review["favorite_time"] = {"slot": favorite[0], "label": time_labels[favorite[0]], "count": favorite[1]}
-        
-        # 最长连续天数
-        if watch_dates:
-            sorted_dates = sorted(watch_dates)
-            longest = 1
+    
+    # 最忙的一天（同数量时取较早的日期）
+    sorted_dates = sorted(daily_count)
+    busiest = max(sorted_dates, key=lambda d: daily_count[d])
+    review["busiest_day"] = {"date": busiest.strftime("%Y-%m-%d"), "count": daily_count[busiest]}
+    
+    # 最爱时段
+    time_labels = {
+        "morning": "早间 (6-12点)",
+        "afternoon": "下午 (12-18点)",
+        "evening": "晚间 (18-24点)",
+        "night": "深夜 (0-6点)",
+    }
+    favorite = max(time_slots.items(), key=lambda x: x[1])
+    review["favorite_time"] = {"slot": favorite[0], "label": time_labels[favorite[0]], "count": favorite[1]}
+    
+    # 最长连续天数
+    longest = 1
+    current = 1
+    for i in range(1, len(sorted_dates)):
+        if (sorted_dates[i] - sorted_dates[i-1]).days == 1:
+            current += 1
+            longest = max(longest, current)
+        else:
             current = 1
-            for i in range(1, len(sorted_dates)):
-                if (sorted_dates[i] - sorted_dates[i-1]).days == 1:
-                    current += 1
-                    longest = max(longest, current)
-                else:
-                    current = 1
-            review["longest_streak"] = longest
-        
-        # 里程碑
-        milestones = []
-        total = review["summary"]["total_items"]
-        if total >= 10:
-            milestones.append({"type": "count", "value": 10, "label": "观看了 10 部作品"})
-        if total >= 50:
-            milestones.append({"type": "count", "value": 50, "label": "观看了 50 部作品"})
-        if total >= 100:
-            milestones.append({"type": "count", "value": 100, "label": "观看了 100 部作品"})
-        if total >= 200:
-            milestones.append({"type": "count", "value": 200, "label": "观看了 200 部作品"})
-        if total >= 500:
-            milestones.append({"type": "count", "value": 500, "label": "观看了 500 部作品"})
-        
-        hours = review["summary"]["total_watch_time_hours"]
-        if hours >= 24:
-            milestones.append({"type": "time", "value": 24, "label": "观看超过 1 天"})
-        if hours >= 168:
-            milestones.append({"type": "time", "value": 168, "label": "观看超过 1 周"})
-        if hours >= 720:
-            milestones.append({"type": "time", "value": 720, "label": "观看超过 1 个月"})
-        
-        if review["longest_streak"] >= 7:
-            milestones.append({"type": "streak", "value": 7, "label": f"连续观看 {review['longest_streak']} 天"})
-        
-        review["milestones"] = milestones
-        
-    except Exception as e:
-        print(f"Error fetching yearly review: {e}")
+    review["longest_streak"] = longest
+    
+    # 里程碑
+    milestones = []
+    total = review["summary"]["total_items"]
+    if total >= 10:
+        milestones.append({"type": "count", "value": 10, "label": "观看了 10 部作品"})
+    if total >= 50:
+        milestones.append({"type": "count", "value": 50, "label": "观看了 50 部作品"})
+    if total >= 100:
+        milestones.append({"type": "count", "value": 100, "label": "观看了 100 部作品"})
+    if total >= 200:
+        milestones.append({"type": "count", "value": 200, "label": "观看了 200 部作品"})
+    if total >= 500:
+        milestones.append({"type": "count", "value": 500, "label": "观看了 500 部作品"})
+    
+    hours = review["summary"]["total_watch_time_hours"]
+    if hours >= 24:
+        milestones.append({"type": "time", "value": 24, "label": "观看超过 1 天"})
+    if hours >= 168:
+        milestones.append({"type": "time", "value": 168, "label": "观看超过 1 周"})
+    if hours >= 720:
+        milestones.append({"type": "time", "value": 720, "label": "观看超过 1 个月"})
+    
+    if review["longest_streak"] >= 7:
+        milestones.append({"type": "streak", "value": 7, "label": f"连续观看 {review['longest_streak']} 天"})
+    
+    review["milestones"] = milestones
     
     return review
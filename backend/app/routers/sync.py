@@ -10,7 +10,9 @@ from app.services.sync import (
     sync_user_history,
     get_cached_libraries,
     get_sync_status,
-    _is_running,
+    get_sync_progress,
+    is_sync_running,
+    refresh_counts_and_progress,
 )
 from app.services.emby import emby_service
 
@@ -21,7 +23,8 @@ router = APIRouter(prefix="/sync", tags=["Sync"])
 async def get_global_sync_status():
     """获取全局同步状态"""
     return {
-        "is_running": _is_running,
+        "is_running": is_sync_running(),
+        "progress": get_sync_progress(),
     }
 
 
@@ -32,7 +35,7 @@ async def get_user_sync_status(
 ):
     """获取用户同步状态"""
     status = await get_sync_status(user_id, db)
-    status["is_running"] = _is_running
+    status["is_running"] = is_sync_running()
     return status
 
 
@@ -40,31 +43,33 @@ async def get_user_sync_status(
 async def trigger_sync(
     background_tasks: BackgroundTasks,
     user_id: str = Query(None, description="指定用户 ID，不指定则同步所有用户"),
+    full: bool = Query(False, description="是否全量同步（默认只同步新的播放记录）"),
 ):
     """手动触发同步"""
-    if _is_running:
+    if is_sync_running():
         raise HTTPException(status_code=400, detail="同步任务正在进行中")
     
     if user_id:
         # 同步指定用户
-        background_tasks.add_task(sync_single_user, user_id)
+        background_tasks.add_task(sync_single_user, user_id, full)
         return {"message": f"已开始同步用户 {user_id}"}
     else:
         # 同步所有用户
-        background_tasks.add_task(sync_all_users)
+        background_tasks.add_task(sync_all_users, full)
         return {"message": "已开始同步所有用户"}
 
 
-async def sync_single_user(user_id: str):
+async def sync_single_user(user_id: str, full: bool = False):
     """同步单个用户（后台任务）"""
     from app.database import async_session_maker
     
     async with async_session_maker() as db:
         try:
             await sync_user_libraries(user_id, db)
-            await sync_user_history(user_id, db)
+            await sync_user_history(user_id, db, full=full)
         except Exception as e:
             print(f"同步用户 {user_id} 失败: {e}")
+        await refresh_counts_and_progress(user_id, db)
 
 
 @router.get("/libraries/{user_id}")
@@ -147,7 +152,7 @@ async def refresh_libraries(
     db: AsyncSession = Depends(get_db),
 ):
     """刷新媒体库缓存"""
-    if _is_running:
+    if is_sync_running():
         raise HTTPException(status_code=400, detail="同步任务正在进行中")
     
     # 更新状态为运行中
@@ -179,3 +184,5 @@ async def sync_user_libraries_task(user_id: str):
             await sync_user_libraries(user_id, db)
         except Exception as e:
             print(f"同步用户 {user_id} 媒体库失败: {e}")
+        # 媒体库扫描后剧集的总集数可能变化，重新计算所有剧集进度
+        await refresh_counts_and_progress(user_id, db, force=True)
@@ -278,3 +278,9 @@ async def get_tv_similar(tv_id: int, page: int = Query(1, ge=1)):
         return await tmdb_service.get_tv_similar(tv_id, page)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/client-stats")
+async def get_client_stats():
+    """获取 TMDB 请求与限流计数"""
+    return tmdb_service.get_client_stats()
@@ -5,6 +5,7 @@ from typing import Optional
 from datetime import datetime
 from app.database import get_db
 from app.models import Watchlist, WatchHistory
+from app.services.rollup import apply_rollup_changes
 from app.schemas import WatchlistCreate, WatchlistResponse, WatchHistoryCreate, WatchHistoryResponse
 
 router = APIRouter(prefix="/watchlist", tags=["Watchlist"])
@@ -132,9 +133,16 @@ async def add_watch_history(
     existing = result.scalar_one_or_none()
     
     if existing:
-        # 更新现有记录
+        # 更新现有记录（媒体类型可能变化，同步更新每日汇总）
+        removed = (existing.watched_at, existing.media_type, existing.runtime_minutes)
         for key, value in item.model_dump().items():
             setattr(existing, key, value)
+        await apply_rollup_changes(
+            db,
+            existing.user_id,
+            added=[(existing.watched_at, existing.media_type, existing.runtime_minutes)],
+            removed=[removed],
+        )
         existing.last_watched_at = datetime.utcnow()
         await db.commit()
         await db.refresh(existing)
@@ -144,6 +152,9 @@ async def add_watch_history(
     db_item = WatchHistory(**item.model_dump())
     db_item.last_watched_at = datetime.utcnow()
     db.add(db_item)
+    await apply_rollup_changes(
+        db, db_item.user_id, added=[(db_item.watched_at, db_item.media_type, db_item.runtime_minutes)]
+    )
     await db.commit()
     await db.refresh(db_item)
     return db_item
@@ -161,6 +172,9 @@ async def delete_watch_history(
     if not item:
         raise HTTPException(status_code=404, detail="未找到该记录")
     
+    await apply_rollup_changes(
+        db, item.user_id, removed=[(item.watched_at, item.media_type, item.runtime_minutes)]
+    )
     await db.delete(item)
     await db.commit()
     return {"success": True}
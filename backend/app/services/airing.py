@@ -0,0 +1,402 @@
+"""剧集播出日程：追踪剧集的下一集播出信息，后台根据 TMDB 变更定时刷新，日历按播出日期查询"""
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from typing import Iterable, Optional
+from sqlalchemy import select, delete, and_, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import async_session_maker
+from app.models import AiringSchedule, WatchHistory, Watchlist, SeriesMetadataCache, LibrarySyncStatus
+from app.services.tmdb import tmdb_service
+from app.services.series_tree import get_series_detail
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+_refresh_task = None
+_is_refreshing = False
+# 写入日程的操作串行执行，避免后台任务和请求同时插入同一剧集
+_store_lock = asyncio.Lock()
+
+# 超过该时间未被检查的记录直接删除（仍被追踪的剧集下次会重新获取）
+_PRUNE_AFTER = timedelta(days=30)
+
+# TMDB 变更接口最多查询 14 天
+_CHANGES_MAX_WINDOW = timedelta(days=14)
+# 在 library_sync_status 中记录上次成功读取 TMDB 剧集变更列表的时间
+_CHANGES_STATUS_KEY = "__tmdb_tv_changes__"
+
+
+async def get_watching_tmdb_ids(
+    db: AsyncSession,
+    user_id: str,
+    resolve_missing: bool = True,
+) -> dict[int, str]:
+    """
+    获取用户正在追的剧集 TMDB ID -> 剧名
+
+    优先使用同步时保存的剧集 TMDB ID，缺失时再从 Emby 获取（带缓存）；
+    resolve_missing 为 False 时只使用本地数据，缺失的剧集跳过
+    """
+    result = await db.execute(
+        select(WatchHistory.series_id, WatchHistory.series_name)
+        .where(
+            and_(
+                WatchHistory.user_id == user_id,
+                WatchHistory.media_type == "Episode",
+                WatchHistory.series_id.isnot(None)
+            )
+        )
+        .distinct()
+    )
+    series_names = {}
+    for series_id, series_name in result.all():
+        series_names.setdefault(series_id, series_name)
+    if not series_names:
+        return {}
+
+    # 同步时保存的剧集 TMDB ID（集记录的 tmdb_id 可能是单集的 ID，不能直接使用）
+    tmdb_ids = {}
+    meta_result = await db.execute(
+        select(SeriesMetadataCache.series_id, SeriesMetadataCache.tmdb_id)
+        .where(SeriesMetadataCache.series_id.in_(list(series_names)))
+    )
+    for series_id, tmdb_id in meta_result.all():
+        if tmdb_id:
+            tmdb_ids[series_id] = tmdb_id
+
+    missing = [series_id for series_id in series_names if series_id not in tmdb_ids]
+    if missing and resolve_missing:
+        details = await asyncio.gather(
+            *(get_series_detail(user_id, series_id) for series_id in missing),
+            return_exceptions=True,
+        )
+        for series_id, detail in zip(missing, details):
+            if not isinstance(detail, Exception) and detail.provider_ids.get("Tmdb"):
+                tmdb_ids[series_id] = detail.provider_ids["Tmdb"]
+
+    watching = {}
+    for series_id, series_name in series_names.items():
+        try:
+            watching.setdefault(int(tmdb_ids[series_id]), series_name)
+        except (KeyError, ValueError, TypeError):
+            continue
+    return watching
+
+
+async def _get_tracked_tmdb_ids(db: AsyncSession) -> set[int]:
+    """
+    所有用户正在追的剧集和想看列表中的剧集的 TMDB ID
+
+    本地还没有剧集信息的从 Emby 获取并保存，iCal 等只读本地数据的接口依赖这里补全缺失的剧集；
+    已有 TMDB ID 或剧集信息未过期（Emby 中没有 TMDB ID）的不再获取
+    """
+    from app.services.sync import refresh_series_info
+
+    known_series = select(SeriesMetadataCache.series_id).where(
+        or_(
+            SeriesMetadataCache.tmdb_id.isnot(None),
+            SeriesMetadataCache.expires_at > datetime.utcnow(),
+        )
+    )
+    missing_result = await db.execute(
+        select(WatchHistory.series_id, func.min(WatchHistory.user_id))
+        .where(
+            and_(
+                WatchHistory.media_type == "Episode",
+                WatchHistory.series_id.isnot(None),
+                WatchHistory.series_id.notin_(known_series),
+            )
+        )
+        .group_by(WatchHistory.series_id)
+    )
+    # 剧集信息与用户无关，每部剧集只用一个看过它的用户获取一次
+    missing_by_user = {}
+    for series_id, user_id in missing_result.all():
+        missing_by_user.setdefault(user_id, []).append(series_id)
+    for user_id, series_ids in missing_by_user.items():
+        await refresh_series_info(user_id, series_ids)
+
+    watched_series = (
+        select(WatchHistory.series_id)
+        .where(
+            and_(
+                WatchHistory.media_type == "Episode",
+                WatchHistory.series_id.isnot(None)
+            )
+        )
+        .distinct()
+    )
+    meta_result = await db.execute(
+        select(SeriesMetadataCache.tmdb_id)
+        .where(
+            and_(
+                SeriesMetadataCache.series_id.in_(watched_series),
+                SeriesMetadataCache.tmdb_id.isnot(None)
+            )
+        )
+    )
+    tracked = set()
+    for tmdb_id in meta_result.scalars().all():
+        try:
+            tracked.add(int(tmdb_id))
+        except (ValueError, TypeError):
+            continue
+
+    watchlist_result = await db.execute(
+        select(Watchlist.tmdb_id).where(Watchlist.media_type == "tv")
+    )
+    for tmdb_id in watchlist_result.scalars().all():
+        try:
+            tracked.add(int(tmdb_id))
+        except (ValueError, TypeError):
+            continue
+    return tracked
+
+
+def _stale_clause(now: datetime):
+    """
+    需要重新获取的记录：
+
+    - 未完结或有待播出的集，且超过 airing_max_age_hours 未检查
+    - 下一集已经播出，且播出后还没有检查过
+    """
+    cutoff = now - timedelta(hours=settings.airing_max_age_hours)
+    return or_(
+        and_(
+            AiringSchedule.checked_at < cutoff,
+            or_(AiringSchedule.in_production.is_(True), AiringSchedule.air_date.isnot(None)),
+        ),
+        and_(
+            AiringSchedule.air_date < now.date(),
+            func.date(AiringSchedule.checked_at) <= AiringSchedule.air_date,
+        ),
+    )
+
+
+def _schedule_values(detail: dict) -> dict:
+    """从 TMDB 剧集详情提取下一集播出信息"""
+    next_episode = detail.get("next_episode_to_air") or {}
+    air_date = None
+    if next_episode.get("air_date"):
+        try:
+            air_date = datetime.strptime(next_episode["air_date"], "%Y-%m-%d").date()
+        except ValueError:
+            air_date = None
+    if air_date is None:
+        next_episode = {}
+
+    return {
+        "name": detail.get("name"),
+        "poster_path": detail.get("poster_path"),
+        "backdrop_path": detail.get("backdrop_path"),
+        "vote_average": detail.get("vote_average"),
+        "in_production": bool(detail.get("in_production")),
+        "air_date": air_date,
+        "season_number": next_episode.get("season_number"),
+        "episode_number": next_episode.get("episode_number"),
+        "episode_name": next_episode.get("name"),
+        "overview": next_episode.get("overview"),
+    }
+
+
+async def _store_schedule(db: AsyncSession, details: dict[int, dict]):
+    """写入播出信息，内容没有变化时只更新检查时间"""
+    if not details:
+        return
+
+    async with _store_lock:
+        now = datetime.utcnow()
+        result = await db.execute(
+            select(AiringSchedule).where(AiringSchedule.tmdb_id.in_(list(details)))
+        )
+        existing = {record.tmdb_id: record for record in result.scalars().all()}
+
+        for tmdb_id, detail in details.items():
+            values = _schedule_values(detail)
+            record = existing.get(tmdb_id)
+            if record is None:
+                db.add(AiringSchedule(tmdb_id=tmdb_id, checked_at=now, updated_at=now, **values))
+                continue
+            record.checked_at = now
+            if any(getattr(record, key) != value for key, value in values.items()):
+                for key, value in values.items():
+                    setattr(record, key, value)
+                record.updated_at = now
+
+        await db.commit()
+
+
+async def ensure_airing_schedule(db: AsyncSession, tmdb_ids: Iterable[int]):
+    """确保这些剧集有播出信息：没有记录的从 TMDB 获取，过期的跳过缓存重新获取"""
+    ids = set(tmdb_ids)
+    if not ids:
+        return
+
+    now = datetime.utcnow()
+    result = await db.execute(
+        select(AiringSchedule.tmdb_id, _stale_clause(now))
+        .where(AiringSchedule.tmdb_id.in_(list(ids)))
+    )
+    stale = set()
+    known = set()
+    for tmdb_id, is_stale in result.all():
+        known.add(tmdb_id)
+        if is_stale:
+            stale.add(tmdb_id)
+
+    missing = ids - known
+    if not missing and not stale:
+        return
+
+    fetched, refreshed = await asyncio.gather(
+        tmdb_service.get_tv_shows(missing),
+        tmdb_service.get_tv_shows(stale, force=True),
+    )
+    await _store_schedule(db, {**fetched, **refreshed})
+
+
+async def get_airing_between(
+    db: AsyncSession,
+    tmdb_ids: Iterable[int],
+    start: date,
+    end: date,
+) -> dict[int, AiringSchedule]:
+    """查询指定剧集中下一集在 [start, end] 内播出的记录"""
+    ids = list(set(tmdb_ids))
+    if not ids:
+        return {}
+    result = await db.execute(
+        select(AiringSchedule)
+        .where(
+            and_(
+                AiringSchedule.air_date >= start,
+                AiringSchedule.air_date <= end,
+                AiringSchedule.tmdb_id.in_(ids)
+            )
+        )
+    )
+    return {record.tmdb_id: record for record in result.scalars().all()}
+
+
+async def _get_changes_status(db: AsyncSession) -> LibrarySyncStatus:
+    """获取记录 TMDB 剧集变更读取进度的状态行（不存在时创建）"""
+    result = await db.execute(
+        select(LibrarySyncStatus).where(LibrarySyncStatus.user_id == _CHANGES_STATUS_KEY)
+    )
+    status = result.scalar_one_or_none()
+    if status is None:
+        status = LibrarySyncStatus(user_id=_CHANGES_STATUS_KEY, sync_status="idle")
+        db.add(status)
+    return status
+
+
+async def refresh_airing_schedule() -> Optional[dict]:
+    """
+    刷新所有追踪剧集的播出日程
+
+    新追踪的剧集直接获取；已有记录中过期的、以及 TMDB 变更列表中出现的跳过缓存重新获取
+    """
+    global _is_refreshing
+
+    if _is_refreshing:
+        logger.info("播出日程刷新正在运行中，跳过")
+        return None
+
+    _is_refreshing = True
+    try:
+        async with async_session_maker() as db:
+            now = datetime.utcnow()
+            tracked = await _get_tracked_tmdb_ids(db)
+
+            result = await db.execute(
+                select(AiringSchedule.tmdb_id, AiringSchedule.checked_at, _stale_clause(now))
+            )
+            checked_at = {}
+            stale = set()
+            for tmdb_id, checked, is_stale in result.all():
+                checked_at[tmdb_id] = checked
+                if is_stale:
+                    stale.add(tmdb_id)
+
+            new_ids = tracked - set(checked_at)
+            stale &= tracked
+
+            # 其余记录根据上次读取之后的 TMDB 变更列表判断是否需要刷新；
+            # 没有读取记录或已超过 14 天时本次只按过期时间刷新
+            changes_status = await _get_changes_status(db)
+            since = changes_status.last_sync_at
+            changed = set()
+            polled = True
+            candidates = (tracked & set(checked_at)) - stale
+            if candidates and since and since >= now - _CHANGES_MAX_WINDOW:
+                try:
+                    changed, complete = await tmdb_service.get_tv_changed_ids(
+                        since.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")
+                    )
+                    if complete:
+                        changed &= candidates
+                    else:
+                        # 变更列表不完整，无法判断的剧集全部重新获取
+                        changed = candidates
+                except Exception as e:
+                    polled = False
+                    logger.warning(f"获取 TMDB 剧集变更失败: {e}")
+
+            refresh_ids = stale | changed
+            fetched, refreshed = await asyncio.gather(
+                tmdb_service.get_tv_shows(new_ids),
+                tmdb_service.get_tv_shows(refresh_ids, force=True),
+            )
+            await _store_schedule(db, {**fetched, **refreshed})
+
+            if polled:
+                changes_status.last_sync_at = now
+
+            # 删除长时间未检查的记录（不再追踪的剧集）
+            await db.execute(
+                delete(AiringSchedule).where(AiringSchedule.checked_at < now - _PRUNE_AFTER)
+            )
+            await db.commit()
+
+        summary = {
+            "tracked": len(tracked),
+            "added": len(fetched),
+            "refreshed": len(refreshed),
+            "changed": len(changed),
+        }
+        logger.info(f"播出日程刷新完成: {summary}")
+        return summary
+    finally:
+        _is_refreshing = False
+
+
+async def scheduled_airing_task():
+    """定时刷新播出日程"""
+    interval = settings.airing_refresh_minutes
+    logger.info(f"播出日程刷新任务启动，间隔 {interval} 分钟")
+
+    while True:
+        try:
+            await refresh_airing_schedule()
+        except Exception as e:
+            logger.error(f"刷新播出日程失败: {e}")
+        await asyncio.sleep(interval * 60)
+
+
+def start_airing_scheduler():
+    """启动播出日程刷新任务"""
+    global _refresh_task
+
+    if settings.airing_refresh_minutes > 0:
+        _refresh_task = asyncio.create_task(scheduled_airing_task())
+
+
+def stop_airing_scheduler():
+    """停止播出日程刷新任务"""
+    global _refresh_task
+
+    if _refresh_task:
+        _refresh_task.cancel()
+        _refresh_task = None
@@ -0,0 +1,266 @@
+"""TMDB 响应缓存（内存 LRU + MediaCache 持久化）"""
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable, Optional, Union
+from sqlalchemy import select, delete
+from app.database import async_session_maker
+from app.models import MediaCache
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+class LRUCache:
+    """简单的内存 LRU 缓存，值为 (过期时间, 数据)"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(maxsize, 1)
+        self._data: OrderedDict[str, tuple[datetime, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Optional[tuple[datetime, Any]]:
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data.move_to_end(key)
+        return entry
+
+    def set(self, key: str, expires_at: datetime, value: Any):
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: str):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SingleFlight:
+    """合并同一 key 的并发请求：只有第一个调用执行 fetch，其余调用等待同一结果"""
+
+    def __init__(self):
+        self._pending: dict[str, asyncio.Future] = {}
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._pending
+
+    async def run(self, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        while True:
+            pending = self._pending.get(key)
+            if pending is None:
+                break
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # 执行 fetch 的调用被取消时由当前调用重新执行；当前调用自身被取消则继续抛出
+                if not pending.cancelled() or asyncio.current_task().cancelling():
+                    raise
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            value = await fetch()
+            future.set_result(value)
+            return value
+        except Exception as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免 "exception was never retrieved" 警告
+            future.exception()
+            raise
+        finally:
+            self._pending.pop(key, None)
+            # 被取消（或抛出 BaseException）时也要结束 future，否则等待者会一直挂起
+            if not future.done():
+                future.cancel()
+
+
+class TMDBResponseCache:
+    """
+    两级读穿缓存：先查内存 LRU，再查 MediaCache 表，最后请求 TMDB
+
+    过期但仍在 stale 窗口内的数据会直接返回，同时在后台刷新
+    """
+
+    def __init__(self, memory_size: int, stale_seconds: int):
+        self.memory = LRUCache(memory_size)
+        self.stale_window = timedelta(seconds=stale_seconds)
+        self._refreshing: set[str] = set()
+        self._background_tasks: set[asyncio.Task] = set()
+        self._inflight = SingleFlight()
+        self.stats = {
+            "memory_hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "stale_hits": 0,
+            "refreshes": 0,
+            "coalesced": 0,
+        }
+
+    async def get_or_fetch(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[dict]],
+        ttl: Union[int, Callable[[dict], int]],
+        tmdb_id: Optional[int] = None,
+        media_type: Optional[str] = None,
+        force: bool = False,
+    ) -> dict:
+        """
+        读取缓存，缺失时调用 fetch 获取并写入缓存（同一 key 的并发请求只获取一次）
+
+        force 为 True 时跳过缓存直接获取（如已知上游数据有变更）
+        """
+        entry = self.memory.get(key)
+        if not force and entry is not None and datetime.utcnow() < entry[0]:
+            self.stats["memory_hits"] += 1
+            return entry[1]
+
+        if key in self._inflight:
+            self.stats["coalesced"] += 1
+
+        async def load() -> dict:
+            if force:
+                self.stats["misses"] += 1
+                return await self._refresh(key, fetch, ttl, tmdb_id, media_type)
+            return await self._resolve(key, entry, fetch, ttl, tmdb_id, media_type)
+
+        return await self._inflight.run(key, load)
+
+    async def _resolve(
+        self,
+        key: str,
+        entry: Optional[tuple[datetime, Any]],
+        fetch: Callable[[], Awaitable[dict]],
+        ttl: Union[int, Callable[[dict], int]],
+        tmdb_id: Optional[int],
+        media_type: Optional[str],
+    ) -> dict:
+        """内存未命中（或已过期）时查 MediaCache 表，再请求 TMDB"""
+        now = datetime.utcnow()
+        if entry is None:
+            entry = await self._load(key)
+            if entry is not None:
+                expires_at, data = entry
+                self.memory.set(key, expires_at, data)
+                if now < expires_at:
+                    self.stats["db_hits"] += 1
+                    return data
+
+        if entry is not None and now < entry[0] + self.stale_window:
+            # 过期但可用：先返回旧数据，后台刷新
+            self.stats["stale_hits"] += 1
+            self._schedule_refresh(key, fetch, ttl, tmdb_id, media_type)
+            return entry[1]
+
+        self.stats["misses"] += 1
+        try:
+            return await self._refresh(key, fetch, ttl, tmdb_id, media_type)
+        except Exception:
+            if entry is not None:
+                logger.warning(f"刷新缓存 {key} 失败，返回过期数据")
+                return entry[1]
+            raise
+
+    async def _refresh(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[dict]],
+        ttl: Union[int, Callable[[dict], int]],
+        tmdb_id: Optional[int],
+        media_type: Optional[str],
+    ) -> dict:
+        data = await fetch()
+        seconds = ttl(data) if callable(ttl) else ttl
+        expires_at = datetime.utcnow() + timedelta(seconds=seconds)
+        self.memory.set(key, expires_at, data)
+        await self._store(key, data, expires_at, tmdb_id, media_type)
+        return data
+
+    def _schedule_refresh(self, key, fetch, ttl, tmdb_id, media_type):
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+
+        async def runner():
+            try:
+                await self._refresh(key, fetch, ttl, tmdb_id, media_type)
+                self.stats["refreshes"] += 1
+            except Exception as e:
+                logger.warning(f"后台刷新缓存 {key} 失败: {e}")
+            finally:
+                self._refreshing.discard(key)
+
+        task = asyncio.create_task(runner())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _load(self, key: str) -> Optional[tuple[datetime, dict]]:
+        """从 MediaCache 表读取"""
+        try:
+            async with async_session_maker() as db:
+                result = await db.execute(
+                    select(MediaCache.expires_at, MediaCache.data).where(MediaCache.cache_key == key)
+                )
+                row = result.first()
+        except Exception as e:
+            logger.warning(f"读取 TMDB 缓存失败 {key}: {e}")
+            return None
+
+        if row is None or row.data is None:
+            return None
+        return (row.expires_at or datetime.min, row.data)
+
+    async def _store(
+        self,
+        key: str,
+        data: dict,
+        expires_at: datetime,
+        tmdb_id: Optional[int],
+        media_type: Optional[str],
+    ):
+        """写入 MediaCache 表（失败不影响请求）"""
+        try:
+            async with async_session_maker() as db:
+                result = await db.execute(select(MediaCache).where(MediaCache.cache_key == key))
+                record = result.scalar_one_or_none()
+                if record:
+                    record.data = data
+                    record.expires_at = expires_at
+                    record.updated_at = datetime.utcnow()
+                else:
+                    db.add(MediaCache(
+                        cache_key=key,
+                        tmdb_id=tmdb_id,
+                        media_type=media_type,
+                        data=data,
+                        expires_at=expires_at,
+                    ))
+                await db.commit()
+        except Exception as e:
+            logger.warning(f"写入 TMDB 缓存失败 {key}: {e}")
+
+    async def purge_expired(self) -> int:
+        """删除超出 stale 窗口的持久化缓存"""
+        cutoff = datetime.utcnow() - self.stale_window
+        async with async_session_maker() as db:
+            result = await db.execute(
+                delete(MediaCache).where(MediaCache.expires_at < cutoff)
+            )
+            await db.commit()
+            return result.rowcount or 0
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "memory_entries": len(self.memory)}
+
+
+tmdb_cache = TMDBResponseCache(
+    memory_size=settings.tmdb_cache_memory_size,
+    stale_seconds=settings.tmdb_cache_stale_seconds,
+)
@@ -1,12 +1,66 @@
+import asyncio
 import httpx
 import logging
 from typing import Optional
+from urllib.parse import urlsplit
 from app.config import get_settings
 from app.schemas import EmbyLibrary, EmbyMediaItem, EmbyMediaList
 
 settings = get_settings()
 logger = logging.getLogger(__name__)
 
+# 进程级共享的 HTTP 客户端（复用 TCP/TLS 连接）
+_http_client: Optional[httpx.AsyncClient] = None
+# 按主机限制并发请求数
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+def _create_http_client() -> httpx.AsyncClient:
+    """创建带连接池的 HTTP 客户端"""
+    return httpx.AsyncClient(
+        timeout=settings.emby_timeout,
+        http2=settings.emby_http2,
+        limits=httpx.Limits(
+            max_connections=settings.emby_max_connections,
+            max_keepalive_connections=settings.emby_max_keepalive_connections,
+            keepalive_expiry=settings.emby_keepalive_expiry,
+        ),
+    )
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的 HTTP 客户端（未启动时延迟创建）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = _create_http_client()
+    return _http_client
+
+
+def _get_host_semaphore(url: str) -> asyncio.Semaphore:
+    """获取指定主机的并发信号量"""
+    host = urlsplit(url).netloc
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(settings.emby_max_concurrency_per_host, 1))
+        _host_semaphores[host] = semaphore
+    return semaphore
+
+
+async def start_emby_client():
+    """启动共享的 Emby HTTP 客户端"""
+    get_http_client()
+    logger.info("Emby HTTP 客户端已启动")
+
+
+async def close_emby_client():
+    """关闭共享的 Emby HTTP 客户端"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        _host_semaphores.clear()
+        logger.info("Emby HTTP 客户端已关闭")
+
 
 class EmbyService:
     def __init__(self):
@@ -22,13 +76,18 @@ class EmbyService:
         if not self.base_url or not self.api_key:
             raise ValueError("Emby URL 或 API Key 未配置")
     
-    async def _request(self, method: str, endpoint: str, params: dict = None) -> dict:
+    async def _send(self, method: str, endpoint: str, params: dict = None) -> httpx.Response:
+        """通过共享连接池发送请求"""
         self._check_config()
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            url = f"{self.base_url}{endpoint}"
-            response = await client.request(method, url, headers=self.headers, params=params)
-            response.raise_for_status()
-            return response.json()
+        url = f"{self.base_url}{endpoint}"
+        async with _get_host_semaphore(url):
+            response = await get_http_client().request(method, url, headers=self.headers, params=params)
+        response.raise_for_status()
+        return response
+    
+    async def _request(self, method: str, endpoint: str, params: dict = None) -> dict:
+        response = await self._send(method, endpoint, params)
+        return response.json()
     
     async def get_server_info(self) -> dict:
         """获取服务器信息"""
@@ -104,6 +163,32 @@ class EmbyService:
             total_count=data.get("TotalRecordCount", 0),
         )
     
+    async def count_items(
+        self,
+        user_id: str,
+        parent_id: Optional[str] = None,
+        include_item_types: Optional[str] = None,
+        filters: Optional[str] = None,
+        is_played: Optional[bool] = None,
+    ) -> int:
+        """只获取符合条件的媒体项数量（Limit=0，不返回条目）"""
+        params = {
+            "Recursive": "true",
+            "Limit": 0,
+            "EnableImages": "false",
+        }
+        if parent_id:
+            params["ParentId"] = parent_id
+        if include_item_types:
+            params["IncludeItemTypes"] = include_item_types
+        if filters:
+            params["Filters"] = filters
+        if is_played is not None:
+            params["IsPlayed"] = str(is_played).lower()
+
+        data = await self._request("GET", f"/Users/{user_id}/Items", params)
+        return data.get("TotalRecordCount", 0)
+
     async def get_item(self, user_id: str, item_id: str) -> EmbyMediaItem:
         """获取单个媒体项详情"""
         data = await self._request(
@@ -113,6 +198,40 @@ class EmbyService:
         )
         return self._parse_media_item(data)
     
+    async def get_items_by_ids(self, user_id: str, item_ids: list[str], chunk_size: int = 100) -> list[EmbyMediaItem]:
+        """
+        按 ID 批量获取媒体项详情（使用 Ids 过滤，分批并发请求）
+
+        单批失败时记录日志并返回其余批次的结果，全部失败时抛出第一个错误
+        """
+        async def fetch_chunk(chunk: list[str]) -> list[EmbyMediaItem]:
+            data = await self._request(
+                "GET",
+                f"/Users/{user_id}/Items",
+                params={
+                    "Ids": ",".join(chunk),
+                    "Fields": "Overview,Genres,ProviderIds,UserData,MediaSources,CommunityRating,ProductionYear",
+                    "EnableImageTypes": "Primary,Backdrop",
+                },
+            )
+            return [self._parse_media_item(item) for item in data.get("Items", [])]
+        
+        unique_ids = list(dict.fromkeys(item_ids))
+        chunks = [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+        results = await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks), return_exceptions=True)
+        
+        items = []
+        errors = []
+        for chunk, chunk_items in zip(chunks, results):
+            if isinstance(chunk_items, Exception):
+                logger.warning(f"批量获取媒体项失败（{len(chunk)} 个）: {chunk_items}")
+                errors.append(chunk_items)
+                continue
+            items.extend(chunk_items)
+        if errors and len(errors) == len(chunks):
+            raise errors[0]
+        return items
+    
     async def get_seasons(self, user_id: str, series_id: str) -> list[EmbyMediaItem]:
         """获取剧集的季列表"""
         data = await self._request(
@@ -162,27 +281,16 @@ class EmbyService:
     
     async def mark_played(self, user_id: str, item_id: str) -> None:
         """标记为已播放"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            url = f"{self.base_url}/Users/{user_id}/PlayedItems/{item_id}"
-            response = await client.post(url, headers=self.headers)
-            response.raise_for_status()
+        await self._send("POST", f"/Users/{user_id}/PlayedItems/{item_id}")
     
     async def mark_unplayed(self, user_id: str, item_id: str) -> None:
         """标记为未播放"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            url = f"{self.base_url}/Users/{user_id}/PlayedItems/{item_id}"
-            response = await client.delete(url, headers=self.headers)
-            response.raise_for_status()
+        await self._send("DELETE", f"/Users/{user_id}/PlayedItems/{item_id}")
     
     async def toggle_favorite(self, user_id: str, item_id: str, is_favorite: bool) -> None:
         """切换收藏状态"""
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            url = f"{self.base_url}/Users/{user_id}/FavoriteItems/{item_id}"
-            if is_favorite:
-                response = await client.post(url, headers=self.headers)
-            else:
-                response = await client.delete(url, headers=self.headers)
-            response.raise_for_status()
+        method = "POST" if is_favorite else "DELETE"
+        await self._send(method, f"/Users/{user_id}/FavoriteItems/{item_id}")
     
     def _parse_media_item(self, item: dict) -> EmbyMediaItem:
         """解析媒体项数据"""
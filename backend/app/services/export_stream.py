@@ -0,0 +1,140 @@
+"""流式导出：服务端游标分批读取观看历史，增量编码为 CSV / NDJSON / JSON，可选 gzip 压缩"""
+import csv
+import io
+import json
+import zlib
+from typing import AsyncIterator
+from sqlalchemy import select
+from app.database import async_session_maker
+from app.models import WatchHistory
+from app.config import get_settings
+
+settings = get_settings()
+
+# 导出的观看历史字段（顺序即 CSV 列顺序）
+HISTORY_COLUMNS = (
+    WatchHistory.title,
+    WatchHistory.media_type,
+    WatchHistory.year,
+    WatchHistory.series_name,
+    WatchHistory.season_number,
+    WatchHistory.episode_number,
+    WatchHistory.watched,
+    WatchHistory.watch_progress,
+    WatchHistory.watched_at,
+    WatchHistory.community_rating,
+    WatchHistory.genres,
+    WatchHistory.runtime_minutes,
+    WatchHistory.emby_id,
+    WatchHistory.tmdb_id,
+)
+HISTORY_FIELDS = [column.key for column in HISTORY_COLUMNS]
+
+
+class Counter:
+    """记录流式编码过程中输出的条目数（生成器结束后读取）"""
+
+    def __init__(self):
+        self.value = 0
+
+
+async def iter_history(user_id: str, newest_first: bool = False) -> AsyncIterator[list[dict]]:
+    """
+    分批读取用户的观看历史
+
+    使用独立的会话和服务端游标，响应开始发送后请求的数据库会话可能已关闭
+    """
+    query = select(*HISTORY_COLUMNS).where(WatchHistory.user_id == user_id)
+    if newest_first:
+        query = query.order_by(WatchHistory.watched_at.desc())
+    query = query.execution_options(yield_per=settings.export_batch_size)
+
+    async with async_session_maker() as db:
+        result = await db.stream(query)
+        async for rows in result.partitions():
+            batch = []
+            for row in rows:
+                item = dict(zip(HISTORY_FIELDS, row))
+                if item["watched_at"]:
+                    item["watched_at"] = item["watched_at"].isoformat()
+                batch.append(item)
+            yield batch
+
+
+async def csv_chunks(batches: AsyncIterator[list[dict]], fieldnames: list[str]) -> AsyncIterator[str]:
+    """逐批编码为 CSV（没有数据时输出空文件），列表字段以逗号连接"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    header_written = False
+    async for batch in batches:
+        if not batch:
+            continue
+        if not header_written:
+            writer.writeheader()
+            header_written = True
+        for row in batch:
+            writer.writerow({
+                key: ",".join(value) if isinstance(value, list) else value
+                for key, value in row.items()
+            })
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+async def ndjson_chunks(batches: AsyncIterator[list[dict]]) -> AsyncIterator[str]:
+    """逐批编码为 NDJSON（每行一个 JSON 对象）"""
+    async for batch in batches:
+        if batch:
+            yield "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch)
+
+
+def _indent(value, level: int) -> str:
+    """与 json.dumps(indent=2) 嵌套在第 level 层时的输出一致"""
+    text = json.dumps(value, ensure_ascii=False, indent=2)
+    return text.replace("\n", "\n" + "  " * level)
+
+
+async def json_array_chunks(
+    batches: AsyncIterator[list[dict]],
+    level: int,
+    counter: Counter,
+) -> AsyncIterator[str]:
+    """
+    逐批编码为 JSON 数组（与 indent=2 的输出格式一致）
+
+    数组位于对象的第 level 层，输出从 "[" 开始，到 "]" 结束
+    """
+    item_prefix = "\n" + "  " * (level + 1)
+    async for batch in batches:
+        if not batch:
+            continue
+        parts = []
+        for row in batch:
+            parts.append(("[" if counter.value == 0 else ",") + item_prefix + _indent(row, level + 1))
+            counter.value += 1
+        yield "".join(parts)
+    yield "[]" if counter.value == 0 else "\n" + "  " * level + "]"
+
+
+def json_field(key: str, value, level: int, first: bool = False) -> str:
+    """对象中的一个字段（第 level 层，不是第一个字段时以逗号开头）"""
+    prefix = "" if first else ","
+    return f'{prefix}\n{"  " * level}{json.dumps(key, ensure_ascii=False)}: {_indent(value, level)}'
+
+
+def json_key(key: str, level: int, first: bool = False) -> str:
+    """对象中一个字段的键（值随后流式输出）"""
+    prefix = "" if first else ","
+    return f'{prefix}\n{"  " * level}{json.dumps(key, ensure_ascii=False)}: '
+
+
+async def gzip_chunks(chunks: AsyncIterator[str]) -> AsyncIterator[bytes]:
+    """边编码边 gzip 压缩"""
+    compressor = zlib.compressobj(wbits=31)  # 31: 带 gzip 头
+    async for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
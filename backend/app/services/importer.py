@@ -0,0 +1,302 @@
+"""流式导入：增量解析上传文件，按批去重并批量写入，导入进度通过任务 ID 查询"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+from sqlalchemy import select, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import async_session_maker
+from app.models import WatchHistory, UserRating
+from app.services.json_stream import iter_json
+from app.services.rollup import apply_rollup_changes
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+Read = Callable[[int], Awaitable[bytes]]
+
+# 最多保留的导入任务数（超出时丢弃最早结束的任务）
+_MAX_JOBS = 50
+_jobs: dict[str, dict] = {}
+_background_tasks: set[asyncio.Task] = set()
+
+
+class ImportFormatError(ValueError):
+    """上传文件的格式或版本不受支持"""
+
+
+def create_job(user_id: str, kind: str, total_bytes: Optional[int] = None) -> dict:
+    """登记一个导入任务"""
+    finished = [job for job in _jobs.values() if job["status"] != "running"]
+    finished.sort(key=lambda job: job["finished_at"])
+    for job in finished[:max(len(_jobs) - _MAX_JOBS + 1, 0)]:
+        _jobs.pop(job["job_id"], None)
+
+    job = {
+        "job_id": uuid.uuid4().hex,
+        "kind": kind,
+        "user_id": user_id,
+        "status": "running",
+        "bytes_read": 0,
+        "total_bytes": total_bytes,
+        "processed": 0,
+        "results": {},
+        "error": None,
+        "started_at": datetime.utcnow().isoformat(),
+        "finished_at": None,
+    }
+    _jobs[job["job_id"]] = job
+    return job
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """获取导入任务状态"""
+    return _jobs.get(job_id)
+
+
+def fail_job(job: dict, error: str):
+    """将导入任务标记为失败"""
+    job["status"] = "failed"
+    job["error"] = error
+    job["finished_at"] = datetime.utcnow().isoformat()
+
+
+def _tracked(read: Read, job: dict) -> Read:
+    """读取时记录已读取的字节数"""
+    async def wrapper(size: int) -> bytes:
+        data = await read(size)
+        job["bytes_read"] += len(data)
+        return data
+    return wrapper
+
+
+def _parse_datetime(value: Any, fallback: Optional[datetime], trakt: bool = False) -> Optional[datetime]:
+    if not value:
+        return fallback
+    try:
+        if trakt:
+            value = value.replace("Z", "+00:00")
+        return datetime.fromisoformat(value)
+    except Exception:
+        return fallback
+
+
+async def _existing_keys(db: AsyncSession, model, user_id: str) -> set[tuple]:
+    """预加载用户已有记录的 (title, media_type)，用于去重"""
+    result = await db.stream(
+        select(model.title, model.media_type)
+        .where(model.user_id == user_id)
+        .execution_options(yield_per=settings.import_batch_size)
+    )
+    return {tuple(row) async for row in result}
+
+
+async def _flush_history(db: AsyncSession, user_id: str, rows: list[dict]):
+    """批量写入观看记录，同步更新每日汇总，并提交"""
+    if not rows:
+        return
+    # 直接使用表级批量插入（每批的字段相同，比 ORM 批量插入快）
+    await db.execute(insert(WatchHistory.__table__), rows)
+    await apply_rollup_changes(
+        db,
+        user_id,
+        added=[(row["watched_at"], row["media_type"], row.get("runtime_minutes")) for row in rows],
+    )
+    await db.commit()
+    rows.clear()
+
+
+async def _flush_ratings(db: AsyncSession, rows: list[dict]):
+    """批量写入评分并提交"""
+    if not rows:
+        return
+    await db.execute(insert(UserRating), rows)
+    await db.commit()
+    rows.clear()
+
+
+def _trakt_row(user_id: str, item: dict) -> Optional[dict]:
+    """解析 Trakt 历史记录，无法识别时返回 None"""
+    if not isinstance(item, dict):
+        return None
+    media_type = (item.get("type") or "").lower()
+    if media_type == "movie":
+        movie = item.get("movie", {})
+        title = movie.get("title")
+        year = movie.get("year")
+        tmdb_id = movie.get("ids", {}).get("tmdb")
+    elif media_type == "episode":
+        show = item.get("show", {})
+        episode = item.get("episode", {})
+        title = episode.get("title")
+        year = show.get("year")
+        tmdb_id = show.get("ids", {}).get("tmdb")
+    else:
+        return None
+
+    if not title:
+        return None
+
+    return {
+        "user_id": user_id,
+        "title": title,
+        "media_type": "Movie" if media_type == "movie" else "Episode",
+        "year": year,
+        "tmdb_id": tmdb_id,
+        "watched": True,
+        "watched_at": _parse_datetime(item.get("watched_at"), datetime.now(), trakt=True),
+        "source": "trakt_import",
+    }
+
+
+def _backup_history_row(user_id: str, item: dict) -> dict:
+    return {
+        "user_id": user_id,
+        "title": item.get("title"),
+        "media_type": item.get("media_type"),
+        "year": item.get("year"),
+        "series_name": item.get("series_name"),
+        "season_number": item.get("season_number"),
+        "episode_number": item.get("episode_number"),
+        "watched": item.get("watched", True),
+        "watch_progress": item.get("watch_progress", 100),
+        "watched_at": _parse_datetime(item.get("watched_at"), None),
+        "community_rating": item.get("community_rating"),
+        "genres": item.get("genres", []),
+        "runtime_minutes": item.get("runtime_minutes"),
+        "tmdb_id": item.get("tmdb_id"),
+        "source": "backup_import",
+    }
+
+
+def _backup_rating_row(user_id: str, item: dict) -> dict:
+    return {
+        "user_id": user_id,
+        "title": item.get("title"),
+        "media_type": item.get("media_type"),
+        "rating": item.get("rating"),
+        "review": item.get("review"),
+        "tmdb_id": item.get("tmdb_id"),
+        "rated_at": _parse_datetime(item.get("rated_at"), None),
+    }
+
+
+async def import_trakt_history(db: AsyncSession, user_id: str, read: Read, job: dict) -> dict:
+    """导入 Trakt 导出的观看历史（数组，或带 history 字段的对象）"""
+    results = job["results"] = {"imported": 0, "skipped": 0}
+    existing = await _existing_keys(db, WatchHistory, user_id)
+    pending = []
+
+    async for _, item, is_item in iter_json(_tracked(read, job), {(), ("history",)}):
+        if not is_item:
+            continue
+        job["processed"] += 1
+        row = _trakt_row(user_id, item)
+        if row is None or (row["title"], row["media_type"]) in existing:
+            results["skipped"] += 1
+            continue
+
+        existing.add((row["title"], row["media_type"]))
+        pending.append(row)
+        results["imported"] += 1
+        if len(pending) >= settings.import_batch_size:
+            await _flush_history(db, user_id, pending)
+
+    await _flush_history(db, user_id, pending)
+    return results
+
+
+async def import_backup(db: AsyncSession, user_id: str, read: Read, job: dict) -> dict:
+    """从备份文件恢复观看历史和评分"""
+    results = job["results"] = {
+        "history": {"imported": 0, "skipped": 0},
+        "watchlist": {"imported": 0, "skipped": 0},
+        "ratings": {"imported": 0, "skipped": 0},
+        "lists": {"imported": 0, "skipped": 0},
+    }
+    history_keys = await _existing_keys(db, WatchHistory, user_id)
+    rating_keys = await _existing_keys(db, UserRating, user_id)
+    history_rows, rating_rows = [], []
+    # 导出的备份中 version 位于 data 之前；键顺序被改变时先缓存数据，确认版本后再写入
+    version = None
+
+    item_paths = {("data", "history"), ("data", "ratings")}
+    async for path, item, is_item in iter_json(_tracked(read, job), item_paths):
+        if path == ("version",):
+            version = item
+            if version != "1.0":
+                raise ImportFormatError("不支持的备份版本")
+        if not is_item:
+            continue
+        if not isinstance(item, dict):
+            continue
+        job["processed"] += 1
+
+        key = (item.get("title"), item.get("media_type"))
+        if path == ("data", "history"):
+            if key in history_keys:
+                results["history"]["skipped"] += 1
+                continue
+            history_keys.add(key)
+            history_rows.append(_backup_history_row(user_id, item))
+            results["history"]["imported"] += 1
+            if len(history_rows) >= settings.import_batch_size and version is not None:
+                await _flush_history(db, user_id, history_rows)
+        else:
+            if key in rating_keys:
+                results["ratings"]["skipped"] += 1
+                continue
+            rating_keys.add(key)
+            rating_rows.append(_backup_rating_row(user_id, item))
+            results["ratings"]["imported"] += 1
+            if len(rating_rows) >= settings.import_batch_size and version is not None:
+                await _flush_ratings(db, rating_rows)
+
+    if version != "1.0":
+        raise ImportFormatError("不支持的备份版本")
+    await _flush_history(db, user_id, history_rows)
+    await _flush_ratings(db, rating_rows)
+    return results
+
+
+ImportFunc = Callable[[AsyncSession, str, Read, dict], Awaitable[dict]]
+
+
+async def run_import(importer: ImportFunc, db: AsyncSession, user_id: str, read: Read, job: dict) -> dict:
+    """执行导入并更新任务状态（失败时回滚未提交的批次，已提交的批次保留）"""
+    try:
+        results = await importer(db, user_id, read, job)
+        job["status"] = "completed"
+        return results
+    except Exception as e:
+        await db.rollback()
+        fail_job(job, str(e))
+        raise
+    finally:
+        job["finished_at"] = datetime.utcnow().isoformat()
+
+
+def start_background_import(importer: ImportFunc, user_id: str, path: str, job: dict):
+    """在后台从临时文件导入，完成后删除临时文件"""
+    async def runner():
+        try:
+            with open(path, "rb") as f:
+                async def read(size: int) -> bytes:
+                    return await asyncio.to_thread(f.read, size)
+
+                async with async_session_maker() as db:
+                    await run_import(importer, db, user_id, read, job)
+        except Exception as e:
+            logger.error(f"导入任务 {job['job_id']} 失败: {e}")
+        finally:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    task = asyncio.create_task(runner())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
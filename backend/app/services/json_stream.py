@@ -0,0 +1,124 @@
+"""增量 JSON 解析：从上传流中逐个读取指定路径下数组的元素，不需要把整个文件读入内存"""
+import codecs
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+JSONPath = tuple[str, ...]
+
+_WHITESPACE = " \t\r\n"
+# 已解析部分超过该长度时从缓冲区中丢弃
+_COMPACT_THRESHOLD = 1 << 20
+
+
+class _Reader:
+    """按需从流中读取文本，供 raw_decode 在缓冲区上逐个解析值"""
+
+    def __init__(self, read: Callable[[int], Awaitable[bytes]], chunk_size: int):
+        self._read = read
+        self._chunk_size = chunk_size
+        self._decoder = codecs.getincrementaldecoder("utf-8-sig")()
+        self._json = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    async def fill(self) -> bool:
+        """读取下一块数据，已到结尾时返回 False"""
+        if self.eof:
+            return False
+        data = await self._read(self._chunk_size)
+        if self.pos > _COMPACT_THRESHOLD:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        if not data:
+            self.eof = True
+            self.buf += self._decoder.decode(b"", final=True)
+        else:
+            self.buf += self._decoder.decode(data)
+        return True
+
+    async def peek(self) -> str:
+        """跳过空白并返回下一个字符（已到结尾时返回空字符串）"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not await self.fill():
+                return ""
+
+    async def take(self, expected: str) -> str:
+        """读取下一个字符，必须是 expected 中的一个"""
+        char = await self.peek()
+        if not char or char not in expected:
+            raise json.JSONDecodeError(f"Expecting one of {expected!r}", self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    async def value(self) -> Any:
+        """解析下一个完整的值"""
+        await self.peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # 数据不完整，读取更多后重试
+                if not await self.fill():
+                    raise
+                continue
+            if end == len(self.buf) and await self.fill():
+                # 数字等值可能被截断在缓冲区末尾
+                continue
+            self.pos = end
+            return value
+
+
+async def iter_json(
+    read: Callable[[int], Awaitable[bytes]],
+    item_paths: set[JSONPath],
+    chunk_size: int = 64 * 1024,
+) -> AsyncIterator[tuple[JSONPath, Any, bool]]:
+    """
+    增量解析 JSON，产出 (路径, 值, 是否为数组元素)
+
+    item_paths 中路径上的数组逐个元素产出；通往这些路径的对象逐个字段展开；
+    其余的值整体解析后产出。例如 {("data", "history")} 会逐个产出 data.history 中的元素，
+    同时整体产出 version 等其他字段
+    """
+    reader = _Reader(read, chunk_size)
+    prefixes = {path[:i] for path in item_paths for i in range(len(path))}
+
+    async def walk(path: JSONPath) -> AsyncIterator[tuple[JSONPath, Any, bool]]:
+        char = await reader.peek()
+        if path in item_paths and char == "[":
+            reader.pos += 1
+            if await reader.peek() == "]":
+                reader.pos += 1
+                return
+            while True:
+                yield path, await reader.value(), True
+                if await reader.take(",]") == "]":
+                    return
+
+        elif path in prefixes and char == "{":
+            reader.pos += 1
+            if await reader.peek() == "}":
+                reader.pos += 1
+                return
+            while True:
+                key = await reader.value()
+                if not isinstance(key, str):
+                    raise json.JSONDecodeError("Expecting property name", reader.buf, reader.pos)
+                await reader.take(":")
+                async for entry in walk(path + (key,)):
+                    yield entry
+                if await reader.take(",}") == "}":
+                    return
+
+        else:
+            yield path, await reader.value(), False
+
+    async for entry in walk(()):
+        yield entry
+    if await reader.peek():
+        raise json.JSONDecodeError("Extra data", reader.buf, reader.pos)
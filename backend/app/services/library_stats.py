@@ -0,0 +1,107 @@
+"""Emby 媒体库数量快照（按用户缓存，定时同步时刷新）"""
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Optional
+from app.services.emby import emby_service
+from app.schemas import EmbyLibrary
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+# user_id -> (过期时间, 媒体库数量列表)
+_snapshots: dict[str, tuple[datetime, list[dict]]] = {}
+_locks: dict[str, asyncio.Lock] = {}
+
+
+async def _count_or_zero(**kwargs) -> int:
+    """统计数量，失败时按 0 处理（如部分 Emby 版本不支持 IsResumable）"""
+    try:
+        return await emby_service.count_items(**kwargs)
+    except Exception as e:
+        logger.warning(f"获取媒体数量失败 {kwargs}: {e}")
+        return 0
+
+
+async def _fetch_library_counts(user_id: str, library: EmbyLibrary) -> dict:
+    """并发获取单个媒体库的总数、已看数和正在观看数"""
+    counts = {
+        "library_id": library.id,
+        "library_name": library.name,
+        "collection_type": library.collection_type,
+    }
+
+    if library.collection_type == "movies":
+        base = {"user_id": user_id, "parent_id": library.id, "include_item_types": "Movie"}
+        total, played, resumable = await asyncio.gather(
+            emby_service.count_items(**base),
+            emby_service.count_items(**base, is_played=True),
+            _count_or_zero(**base, filters="IsResumable"),
+        )
+        counts.update(movies=total, movies_played=played, movies_resumable=resumable)
+
+    elif library.collection_type == "tvshows":
+        base = {"user_id": user_id, "parent_id": library.id}
+        series, episodes, played, resumable = await asyncio.gather(
+            emby_service.count_items(**base, include_item_types="Series"),
+            emby_service.count_items(**base, include_item_types="Episode"),
+            emby_service.count_items(**base, include_item_types="Episode", is_played=True),
+            _count_or_zero(**base, include_item_types="Episode", filters="IsResumable"),
+        )
+        counts.update(
+            series=series,
+            episodes=episodes,
+            episodes_played=played,
+            episodes_resumable=resumable,
+        )
+
+    return counts
+
+
+async def refresh_library_counts(user_id: str) -> list[dict]:
+    """重新从 Emby 获取用户所有媒体库的数量并更新快照"""
+    libraries = await emby_service.get_libraries(user_id)
+    snapshot = await asyncio.gather(
+        *(_fetch_library_counts(user_id, library) for library in libraries)
+    )
+    snapshot = list(snapshot)
+    ttl = timedelta(seconds=settings.library_counts_ttl_seconds)
+    _snapshots[user_id] = (datetime.utcnow() + ttl, snapshot)
+    return snapshot
+
+
+async def get_library_counts(user_id: str) -> list[dict]:
+    """获取用户媒体库数量快照，过期时刷新（同一用户的并发请求只刷新一次）"""
+    entry = _snapshots.get(user_id)
+    if entry and datetime.utcnow() < entry[0]:
+        return entry[1]
+
+    lock = _locks.setdefault(user_id, asyncio.Lock())
+    async with lock:
+        entry = _snapshots.get(user_id)
+        if entry and datetime.utcnow() < entry[0]:
+            return entry[1]
+        return await refresh_library_counts(user_id)
+
+
+def peek_library_counts(user_id: str) -> Optional[list[dict]]:
+    """获取当前缓存的快照（不检查过期，也不刷新）"""
+    entry = _snapshots.get(user_id)
+    return entry[1] if entry else None
+
+
+def count_episodes(snapshot: Optional[list[dict]]) -> Optional[int]:
+    """快照中所有剧集库的总集数"""
+    if snapshot is None:
+        return None
+    return sum(counts.get("episodes", 0) for counts in snapshot)
+
+
+def invalidate_library_counts(user_id: Optional[str] = None):
+    """使快照过期（如标记已看/未看后），下次读取时重新获取"""
+    user_ids = list(_snapshots) if user_id is None else [user_id]
+    for uid in user_ids:
+        entry = _snapshots.get(uid)
+        if entry:
+            _snapshots[uid] = (datetime.min, entry[1])
@@ -0,0 +1,364 @@
+"""剧集追剧进度计算与持久化（series_progress）"""
+import asyncio
+import hashlib
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable, Optional
+from sqlalchemy import select, func, and_, or_, delete, insert, update, cast, Integer
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import WatchHistory, SeriesProgress
+from app.services.series_tree import SeriesTree, get_series_detail, get_series_tree, invalidate_series
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+
+class EpisodeWatchIndex:
+    """用户剧集观看记录的内存索引（一次查询加载，替代逐集查询）"""
+
+    def __init__(self, rows):
+        self._by_emby_id = {}
+        self._by_number = {}
+        self._pairs_by_series = defaultdict(set)
+        for row in rows:
+            if row.emby_id:
+                self._by_emby_id[row.emby_id] = row
+            if row.series_id is None:
+                continue
+            key = (row.series_id, row.season_number, row.episode_number)
+            current = self._by_number.get(key)
+            # 同一集有多条记录时取最近观看的一条
+            if current is None or (row.watched_at and (not current.watched_at or row.watched_at > current.watched_at)):
+                self._by_number[key] = row
+            if row.season_number is not None and row.episode_number is not None:
+                self._pairs_by_series[row.series_id].add((row.season_number, row.episode_number))
+
+    @classmethod
+    async def load(cls, db: AsyncSession, user_id: str) -> "EpisodeWatchIndex":
+        result = await db.execute(
+            select(
+                WatchHistory.emby_id,
+                WatchHistory.series_id,
+                WatchHistory.season_number,
+                WatchHistory.episode_number,
+                WatchHistory.watched,
+                WatchHistory.watch_progress,
+                WatchHistory.watched_at,
+            )
+            .where(
+                and_(
+                    WatchHistory.user_id == user_id,
+                    or_(WatchHistory.media_type == "Episode", WatchHistory.series_id.isnot(None)),
+                )
+            )
+        )
+        return cls(result.all())
+
+    def get(self, emby_id: str):
+        """按 Emby ID 查找观看记录"""
+        return self._by_emby_id.get(emby_id)
+
+    def get_by_number(self, series_ids: list[str], season_number: int, episode_number: Optional[int]):
+        """按季号和集号查找观看记录（兼容重建媒体库后 Emby ID 变化的旧记录）"""
+        if episode_number is None:
+            return None
+        candidates = [
+            self._by_number[key]
+            for key in ((sid, season_number, episode_number) for sid in series_ids)
+            if key in self._by_number
+        ]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda row: row.watched_at or datetime.min)
+
+    def watched_pairs(self, series_ids: list[str]) -> set[tuple[int, int]]:
+        """已看的 (season_number, episode_number) 集合，按季号和集号去重"""
+        pairs = set()
+        for sid in series_ids:
+            pairs |= self._pairs_by_series.get(sid, set())
+        return pairs
+
+
+async def build_show_progress(user_id: str, show_data: dict, watch_index: EpisodeWatchIndex) -> Optional[dict]:
+    """计算单个剧集的进度（失败返回 None）"""
+    series_id = show_data["primary_series_id"]
+    series_name = show_data["series_name"]
+    last_watched = show_data["last_watched"]
+
+    try:
+        # 从 Emby 获取剧集详情、季列表及每季的集列表（带缓存）
+        series_detail, tree = await asyncio.gather(
+            get_series_detail(user_id, series_id),
+            get_series_tree(user_id, series_id),
+        )
+
+        # 获取总集数
+        total_episodes = 0
+        seasons_info = []
+        watched_pairs = watch_index.watched_pairs(show_data["series_ids"])
+
+        for season, episodes in tree:
+            # season 是 EmbyMediaItem 对象，使用属性访问
+            if season.name and season.name.startswith("Specials"):
+                continue  # 跳过特别篇
+
+            season_id = season.id
+            season_number = season.index_number or 0
+
+            # 该季的集数
+            season_total = len(episodes)
+            total_episodes += season_total
+
+            # 统计该季已看集数（按 season_number + episode_number 去重，包括所有 series_id 的记录）
+            season_watched_count = sum(1 for s, _ in watched_pairs if s == season_number)
+            # 确保不超过实际集数
+            season_watched_count = min(season_watched_count, season_total)
+
+            # 获取每集的观看状态
+            episodes_info = []
+            for ep in sorted(episodes, key=lambda x: x.index_number or 0):
+                ep_record = watch_index.get(ep.id)
+
+                # 如果没有找到记录，尝试用 season_number + episode_number 查找（兼容旧记录）
+                if not ep_record:
+                    ep_record = watch_index.get_by_number(
+                        show_data["series_ids"], season_number, ep.index_number
+                    )
+
+                # 判断是否已看完：watched 为 True 或 进度 >= 90%
+                progress_percent = ep_record.watch_progress if ep_record else 0
+                is_watched = False
+                if ep_record:
+                    is_watched = ep_record.watched or progress_percent >= 90
+
+                episodes_info.append({
+                    "episode_id": ep.id,
+                    "episode_number": ep.index_number or 0,
+                    "episode_name": ep.name,
+                    "is_watched": is_watched,
+                    "progress_percent": progress_percent if not is_watched else 100,
+                })
+
+            seasons_info.append({
+                "season_id": season_id,
+                "season_number": season_number,
+                "season_name": season.name,
+                "total_episodes": season_total,
+                "watched_episodes": season_watched_count,
+                "progress": round(season_watched_count / season_total * 100, 1) if season_total > 0 else 0,
+                "poster_path": season.primary_image_tag,
+                "episodes": episodes_info,
+            })
+
+        # 计算总的已看集数（按 season_number + episode_number 去重）
+        watched_count = len(watched_pairs)
+        # 确保不超过实际总集数
+        watched_count = min(watched_count, total_episodes)
+
+        # 计算总进度
+        progress = round(watched_count / total_episodes * 100, 1) if total_episodes > 0 else 0
+
+        # 获取下一集信息
+        next_episode = find_next_episode(tree, watch_index)
+
+        return {
+            "series_id": series_id,
+            "series_name": series_name or series_detail.name,
+            "poster_path": series_detail.primary_image_tag,
+            "backdrop_path": series_detail.backdrop_image_tag,
+            "total_episodes": total_episodes,
+            "watched_episodes": watched_count,
+            "progress": progress,
+            "last_watched": last_watched.isoformat() if last_watched else None,
+            "seasons": seasons_info,
+            "next_episode": next_episode,
+            "tmdb_id": series_detail.provider_ids.get("Tmdb") if series_detail.provider_ids else None,
+            "status": series_detail.status if hasattr(series_detail, 'status') else None,
+        }
+
+    except Exception as e:
+        print(f"获取剧集 {series_id} 进度失败: {e}")
+        return None
+
+
+def find_next_episode(tree: SeriesTree, watch_index: EpisodeWatchIndex):
+    """在已获取的季/集列表中查找第一集未看的剧集"""
+    for season, episodes in sorted(tree, key=lambda x: x[0].index_number or 0):
+        if season.name and season.name.startswith("Specials"):
+            continue
+        
+        season_number = season.index_number or 0
+        
+        for ep in sorted(episodes, key=lambda x: x.index_number or 0):
+            if not watch_index.get(ep.id):
+                # 找到第一个未看的集
+                return {
+                    "episode_id": ep.id,
+                    "season_number": season_number,
+                    "episode_number": ep.index_number or 0,
+                    "episode_name": ep.name,
+                    "overview": ep.overview,
+                    "runtime": ep.runtime_ticks // 600000000 if ep.runtime_ticks else 0,
+                    "still_path": ep.primary_image_tag,
+                }
+    
+    return None  # 全部看完
+
+
+def normalize_show_name(series_name: Optional[str]) -> str:
+    """标准化剧名（去除空格、转小写）用于合并重建媒体库后的重复剧集"""
+    return series_name.strip().lower() if series_name else ""
+
+
+async def group_watched_shows(db: AsyncSession, user_id: str) -> list[dict]:
+    """
+    从观看历史中获取所有看过的剧集，按剧名合并不同 series_id 的记录
+
+    按最近观看时间倒序返回，每个剧集附带观看记录摘要（fingerprint）用于判断进度是否需要重新计算
+    """
+    result = await db.execute(
+        select(
+            WatchHistory.series_id,
+            WatchHistory.series_name,
+            func.max(WatchHistory.watched_at).label("last_watched"),
+            func.count(WatchHistory.id),
+            func.sum(cast(WatchHistory.watched, Integer)),
+            func.sum(WatchHistory.watch_progress),
+        )
+        .where(
+            and_(
+                WatchHistory.user_id == user_id,
+                WatchHistory.media_type == "Episode",
+                WatchHistory.series_id.isnot(None),
+                WatchHistory.series_name.isnot(None),
+            )
+        )
+        .group_by(WatchHistory.series_id, WatchHistory.series_name)
+        .order_by(func.max(WatchHistory.watched_at).desc())
+    )
+
+    shows_by_name = {}
+    for series_id, series_name, last_watched, count, watched, progress in result.all():
+        normalized_name = normalize_show_name(series_name)
+        summary = f"{series_id}|{count}|{watched or 0}|{round(progress or 0, 1)}"
+
+        if normalized_name not in shows_by_name:
+            shows_by_name[normalized_name] = {
+                "show_key": normalized_name,
+                "series_ids": [series_id],
+                "series_name": series_name,
+                "last_watched": last_watched,
+                "primary_series_id": series_id,  # 使用最新的 series_id 作为主 ID
+                "summaries": [summary],
+            }
+        else:
+            # 合并记录
+            show = shows_by_name[normalized_name]
+            show["series_ids"].append(series_id)
+            show["summaries"].append(summary)
+            # 使用最新的观看时间
+            if last_watched and (not show["last_watched"] or last_watched > show["last_watched"]):
+                show["last_watched"] = last_watched
+                show["primary_series_id"] = series_id
+
+    shows = list(shows_by_name.values())
+    for show in shows:
+        last_watched = show["last_watched"].isoformat() if show["last_watched"] else ""
+        digest = hashlib.sha1(";".join(sorted(show.pop("summaries"))).encode()).hexdigest()
+        show["fingerprint"] = f"{last_watched}#{digest}"
+    return shows
+
+
+async def refresh_series_progress(
+    db: AsyncSession,
+    user_id: str,
+    show_keys: Optional[Iterable[str]] = None,
+    force: bool = False,
+) -> int:
+    """
+    重新计算并保存剧集进度（提交事务）
+
+    show_keys 为 None 时处理用户的所有剧集并删除已不存在的剧集；
+    force 为 False 时只重新计算观看记录有变化的剧集。返回重新计算的剧集数
+    """
+    shows = await group_watched_shows(db, user_id)
+    if show_keys is not None:
+        keys = set(show_keys)
+        shows = [show for show in shows if show["show_key"] in keys]
+
+    result = await db.execute(
+        select(SeriesProgress.id, SeriesProgress.show_key, SeriesProgress.fingerprint)
+        .where(SeriesProgress.user_id == user_id)
+    )
+    existing = {row.show_key: row for row in result.all()}
+
+    stale = [
+        show for show in shows
+        if force or show["show_key"] not in existing
+        or existing[show["show_key"]].fingerprint != show["fingerprint"]
+    ]
+    if stale:
+        await _store_series_progress(db, user_id, stale, existing)
+
+    if show_keys is None:
+        current_keys = {show["show_key"] for show in shows}
+        removed_ids = [row.id for key, row in existing.items() if key not in current_keys]
+        if removed_ids:
+            await db.execute(delete(SeriesProgress).where(SeriesProgress.id.in_(removed_ids)))
+
+    await db.commit()
+    return len(stale)
+
+
+async def _store_series_progress(db: AsyncSession, user_id: str, shows: list[dict], existing: dict):
+    """并发计算剧集进度并写入 series_progress（计算失败的剧集保留旧数据）"""
+    watch_index = await EpisodeWatchIndex.load(db, user_id)
+    semaphore = asyncio.Semaphore(max(settings.progress_max_concurrency, 1))
+
+    async def build(show: dict) -> Optional[dict]:
+        async with semaphore:
+            return await build_show_progress(user_id, show, watch_index)
+
+    results = await asyncio.gather(*(build(show) for show in shows))
+
+    new_rows = []
+    updated_rows = []
+    for show, data in zip(shows, results):
+        if data is None:
+            continue
+        row = {
+            "user_id": user_id,
+            "show_key": show["show_key"],
+            "series_id": data["series_id"],
+            "series_ids": show["series_ids"],
+            "series_name": data["series_name"],
+            "total_episodes": data["total_episodes"],
+            "watched_episodes": data["watched_episodes"],
+            "progress": data["progress"],
+            "last_watched": show["last_watched"],
+            "fingerprint": show["fingerprint"],
+            "data": data,
+        }
+        if show["show_key"] in existing:
+            row["id"] = existing[show["show_key"]].id
+            updated_rows.append(row)
+        else:
+            new_rows.append(row)
+
+    if new_rows:
+        await db.execute(insert(SeriesProgress), new_rows)
+    if updated_rows:
+        await db.execute(update(SeriesProgress), updated_rows)
+
+
+async def refresh_all_series_progress(db: AsyncSession, user_id: str) -> int:
+    """媒体库扫描后刷新用户所有剧集的总集数（先清除剧集结构缓存）"""
+    result = await db.execute(
+        select(SeriesProgress.series_ids).where(SeriesProgress.user_id == user_id)
+    )
+    for series_ids in result.scalars().all():
+        for series_id in series_ids or []:
+            invalidate_series(series_id)
+    return await refresh_series_progress(db, user_id, force=True)
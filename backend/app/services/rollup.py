@@ -0,0 +1,111 @@
+"""观看记录派生数据维护：每日汇总（watch_daily_rollup）和年度回顾缓存"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Iterable, Optional
+from sqlalchemy import delete, and_, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.models import WatchDailyRollup, YearlyReviewCache
+
+# (watched_at, media_type, runtime_minutes)
+RollupEntry = tuple[Optional[datetime], Optional[str], Optional[int]]
+
+
+def _accumulate(deltas: dict, entries: Iterable[RollupEntry], sign: int):
+    for watched_at, media_type, runtime_minutes in entries:
+        if not watched_at:
+            continue
+        key = (watched_at.date(), watched_at.hour, media_type or "")
+        deltas[key][0] += sign
+        deltas[key][1] += sign * (runtime_minutes or 0)
+
+
+async def apply_rollup_changes(
+    db: AsyncSession,
+    user_id: str,
+    added: Iterable[RollupEntry] = (),
+    removed: Iterable[RollupEntry] = (),
+):
+    """
+    按观看记录的增删增量更新汇总表（不提交事务）
+
+    修改 watched_at 等同于先移除旧记录再添加新记录
+    """
+    added, removed = list(added), list(removed)
+    await invalidate_yearly_reviews(
+        db, user_id, {watched_at.year for watched_at, _, _ in added + removed if watched_at}
+    )
+
+    deltas = defaultdict(lambda: [0, 0])
+    _accumulate(deltas, added, 1)
+    _accumulate(deltas, removed, -1)
+    deltas = {key: value for key, value in deltas.items() if value != [0, 0]}
+    if not deltas:
+        return
+
+    rows = [
+        {
+            "user_id": user_id,
+            "date": date,
+            "hour": hour,
+            "media_type": media_type,
+            "count": count,
+            "runtime_minutes": minutes,
+        }
+        for (date, hour, media_type), (count, minutes) in deltas.items()
+    ]
+    stmt = sqlite_insert(WatchDailyRollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "date", "hour", "media_type"],
+        set_={
+            "count": WatchDailyRollup.count + stmt.excluded.count,
+            "runtime_minutes": WatchDailyRollup.runtime_minutes + stmt.excluded.runtime_minutes,
+        },
+    )
+    await db.execute(stmt, rows)
+
+    await db.execute(
+        delete(WatchDailyRollup).where(
+            and_(WatchDailyRollup.user_id == user_id, WatchDailyRollup.count <= 0)
+        )
+    )
+
+
+async def rebuild_rollup(db: AsyncSession, user_id: Optional[str] = None):
+    """从 watch_history 重建汇总表（不提交事务）"""
+    params = {}
+    user_filter = ""
+    if user_id is not None:
+        user_filter = "AND user_id = :user_id"
+        params["user_id"] = user_id
+        await db.execute(delete(WatchDailyRollup).where(WatchDailyRollup.user_id == user_id))
+        await db.execute(delete(YearlyReviewCache).where(YearlyReviewCache.user_id == user_id))
+    else:
+        await db.execute(delete(WatchDailyRollup))
+        await db.execute(delete(YearlyReviewCache))
+
+    await db.execute(text(f"""
+        INSERT INTO watch_daily_rollup (user_id, date, hour, media_type, count, runtime_minutes)
+        SELECT
+            user_id,
+            date(watched_at),
+            CAST(strftime('%H', watched_at) AS INTEGER),
+            COALESCE(media_type, ''),
+            COUNT(*),
+            COALESCE(SUM(runtime_minutes), 0)
+        FROM watch_history
+        WHERE watched_at IS NOT NULL {user_filter}
+        GROUP BY 1, 2, 3, 4
+    """), params)
+
+
+async def invalidate_yearly_reviews(db: AsyncSession, user_id: str, years: Iterable[int]):
+    """删除受影响年份的年度回顾缓存（不提交事务）"""
+    years = set(years)
+    if not years:
+        return
+    await db.execute(
+        delete(YearlyReviewCache).where(
+            and_(YearlyReviewCache.user_id == user_id, YearlyReviewCache.year.in_(years))
+        )
+    )
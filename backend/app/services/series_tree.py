@@ -0,0 +1,73 @@
+"""Emby 剧集结构缓存：剧集详情、季列表和每季的集列表（进度、日历、同步共用）"""
+import asyncio
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Awaitable, Callable
+from app.services.cache import LRUCache, SingleFlight
+from app.services.emby import emby_service
+from app.schemas import EmbyMediaItem
+from app.config import get_settings
+
+logger = logging.getLogger(__name__)
+settings = get_settings()
+
+SeriesTree = list[tuple[EmbyMediaItem, list[EmbyMediaItem]]]
+
+# 剧集结构与用户无关，按 series_id 缓存，所有用户共用
+_trees = LRUCache(settings.series_tree_cache_size)
+_details = LRUCache(settings.series_tree_cache_size)
+# 正在进行的请求，同一剧集的并发请求只发一次
+_inflight = SingleFlight()
+
+
+async def _cached(cache: LRUCache, key: str, fetch: Callable[[], Awaitable[Any]]) -> Any:
+    entry = cache.get(key)
+    if entry is not None and datetime.utcnow() < entry[0]:
+        return entry[1]
+
+    async def fetch_and_store() -> Any:
+        value = await fetch()
+        ttl = timedelta(seconds=settings.series_tree_cache_ttl_seconds)
+        cache.set(key, datetime.utcnow() + ttl, value)
+        return value
+
+    return await _inflight.run(key, fetch_and_store)
+
+
+async def get_series_detail(user_id: str, series_id: str) -> EmbyMediaItem:
+    """获取剧集详情（带缓存）"""
+    return await _cached(
+        _details,
+        f"detail:{series_id}",
+        lambda: emby_service.get_item(user_id, series_id),
+    )
+
+
+async def get_series_tree(user_id: str, series_id: str) -> SeriesTree:
+    """获取剧集的季列表及每季的集列表（带缓存，所有集一次请求获取后按季分组）"""
+    async def fetch() -> SeriesTree:
+        seasons, episodes = await asyncio.gather(
+            emby_service.get_seasons(user_id, series_id),
+            emby_service.get_episodes(user_id, series_id),
+        )
+        episodes_by_season = defaultdict(list)
+        for ep in episodes:
+            episodes_by_season[ep.season_id].append(ep)
+        return [(season, episodes_by_season.get(season.id, [])) for season in seasons]
+
+    return await _cached(_trees, f"tree:{series_id}", fetch)
+
+
+def get_cached_episode_ids(series_id: str) -> set[str]:
+    """缓存中该剧集已有的集 ID（未缓存时返回空集合）"""
+    entry = _trees.get(f"tree:{series_id}")
+    if entry is None:
+        return set()
+    return {ep.id for _, episodes in entry[1] for ep in episodes}
+
+
+def invalidate_series(series_id: str):
+    """剧集结构变化（如新增集）时清除缓存"""
+    _trees.pop(f"tree:{series_id}")
+    _details.pop(f"detail:{series_id}")
@@ -1,12 +1,21 @@
 """后台同步服务"""
 import asyncio
 import logging
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select, and_, delete
+from sqlalchemy import select, and_, delete, insert, update, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from app.database import async_session_maker
-from app.models import WatchHistory, LibraryCache, LibrarySyncStatus
+from app.models import WatchHistory, LibraryCache, LibraryItemIndex, LibrarySyncStatus, SeriesMetadataCache
+from app.services.cache import LRUCache
+from app.services.rollup import apply_rollup_changes, invalidate_yearly_reviews
 from app.services.emby import emby_service
+from app.services.library_stats import refresh_library_counts, peek_library_counts, count_episodes
+from app.services.progress import normalize_show_name, refresh_series_progress, refresh_all_series_progress
+from app.services.series_tree import get_cached_episode_ids, invalidate_series
+from app.schemas import EmbyMediaItem
 from app.config import get_settings
 
 logger = logging.getLogger(__name__)
@@ -16,15 +25,166 @@ settings = get_settings()
 _sync_task = None
 _is_running = False
 
-# 缓存剧集信息（genres, rating）
-_series_cache = {}
+# 多用户同步进度
+_sync_progress = {
+    "total_users": 0,
+    "completed_users": 0,
+    "failed_users": 0,
+    "running_users": [],
+    "started_at": None,
+    "finished_at": None,
+}
+
+# 缓存剧集信息（genres, rating），按 series_id 跨用户、跨同步共享
+_series_cache = LRUCache(settings.series_cache_size)
+# 待写入数据库的剧集信息
+_series_cache_pending: dict[str, tuple[datetime, dict]] = {}
+_series_cache_loaded = False
+# 并发同步时只有一个调用从数据库加载，其余调用等待加载完成
+_series_cache_load_lock = asyncio.Lock()
+
+# 批量写入时每批的行数
+BULK_CHUNK_SIZE = 500
+
+
+def _parse_emby_date(value: str) -> datetime:
+    """解析 Emby 日期为 naive UTC 时间（与数据库中存储的格式一致）"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def _chunked(items: list, size: int):
+    """按固定大小切分列表"""
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def _ensure_series_cache_loaded():
+    """首次使用时从数据库加载未过期的剧集信息缓存"""
+    global _series_cache_loaded
+    if _series_cache_loaded:
+        return
+
+    async with _series_cache_load_lock:
+        if _series_cache_loaded:
+            return
+        try:
+            async with async_session_maker() as db:
+                result = await db.execute(
+                    select(SeriesMetadataCache)
+                    .where(SeriesMetadataCache.expires_at > datetime.utcnow())
+                    .order_by(SeriesMetadataCache.expires_at.desc())
+                    .limit(settings.series_cache_size)
+                )
+                for row in reversed(result.scalars().all()):
+                    _series_cache.set(row.series_id, row.expires_at, {
+                        "genres": row.genres or [],
+                        "community_rating": row.community_rating,
+                        "primary_image_tag": row.primary_image_tag,
+                        "tmdb_id": row.tmdb_id,
+                    })
+        except Exception as e:
+            logger.warning(f"加载剧集信息缓存失败: {e}")
+        # 加载完成（或失败）后才标记，避免其他调用在加载期间绕过缓存
+        _series_cache_loaded = True
+
+
+async def _flush_series_cache():
+    """将新获取的剧集信息批量写入数据库"""
+    if not _series_cache_pending:
+        return
+    pending = dict(_series_cache_pending)
+    _series_cache_pending.clear()
+
+    rows = [
+        {
+            "series_id": series_id,
+            "genres": info["genres"],
+            "community_rating": info["community_rating"],
+            "primary_image_tag": info["primary_image_tag"],
+            "tmdb_id": info["tmdb_id"],
+            "expires_at": expires_at,
+        }
+        for series_id, (expires_at, info) in pending.items()
+    ]
+
+    # 多个用户并发同步时可能各自写入同一剧集，按 series_id 覆盖已有记录
+    stmt = sqlite_insert(SeriesMetadataCache)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["series_id"],
+        set_={
+            "genres": stmt.excluded.genres,
+            "community_rating": stmt.excluded.community_rating,
+            "primary_image_tag": stmt.excluded.primary_image_tag,
+            "tmdb_id": stmt.excluded.tmdb_id,
+            "expires_at": stmt.excluded.expires_at,
+            "updated_at": func.now(),
+        },
+    )
+
+    try:
+        async with async_session_maker() as db:
+            for chunk in _chunked(rows, BULK_CHUNK_SIZE):
+                await db.execute(stmt, chunk)
+            await db.commit()
+    except Exception as e:
+        logger.warning(f"保存剧集信息缓存失败: {e}")
+
+
+async def prefetch_series_info(user_id: str, series_ids: list[str]):
+    """批量获取缓存中缺失或已过期的剧集信息"""
+    await _ensure_series_cache_loaded()
+
+    now = datetime.utcnow()
+    missing = []
+    for series_id in dict.fromkeys(series_ids):
+        entry = _series_cache.get(series_id)
+        if not entry or now >= entry[0]:
+            missing.append(series_id)
+    if missing:
+        await _fetch_series_info(user_id, missing)
+
+
+async def refresh_series_info(user_id: str, series_ids: list[str]):
+    """重新从 Emby 获取剧集信息（忽略缓存）并保存到数据库"""
+    await _ensure_series_cache_loaded()
+    await _fetch_series_info(user_id, list(dict.fromkeys(series_ids)))
+    await _flush_series_cache()
+
+
+async def _fetch_series_info(user_id: str, series_ids: list[str]):
+    """批量获取剧集信息，写入缓存并等待保存"""
+    try:
+        series_items = await emby_service.get_items_by_ids(user_id, series_ids)
+    except Exception as e:
+        logger.warning(f"批量获取剧集信息失败: {e}")
+        return
+
+    expires_at = datetime.utcnow() + timedelta(hours=settings.series_cache_ttl_hours)
+    for series in series_items:
+        info = {
+            "genres": series.genres or [],
+            "community_rating": series.community_rating,
+            "primary_image_tag": series.primary_image_tag,
+            "tmdb_id": series.provider_ids.get("Tmdb") if series.provider_ids else None,
+        }
+        _series_cache.set(series.id, expires_at, info)
+        _series_cache_pending[series.id] = (expires_at, info)
 
 
 async def get_series_info(user_id: str, series_id: str) -> dict:
-    """获取剧集的 genres 和 rating 信息（带缓存）"""
-    cache_key = f"{user_id}:{series_id}"
-    if cache_key in _series_cache:
-        return _series_cache[cache_key]
+    """
+    获取剧集的 genres 和 rating 信息（带缓存）
+
+    剧集信息与用户无关，按 series_id 在所有用户和多次同步之间共享
+    """
+    await _ensure_series_cache_loaded()
+
+    entry = _series_cache.get(series_id)
+    if entry and datetime.utcnow() < entry[0]:
+        return entry[1]
 
     try:
         series = await emby_service.get_item(user_id, series_id)
@@ -34,132 +194,237 @@ async def get_series_info(user_id: str, series_id: str) -> dict:
             "primary_image_tag": series.primary_image_tag,
             "tmdb_id": series.provider_ids.get("Tmdb") if series.provider_ids else None,
         }
-        _series_cache[cache_key] = info
+        expires_at = datetime.utcnow() + timedelta(hours=settings.series_cache_ttl_hours)
+        _series_cache.set(series_id, expires_at, info)
+        _series_cache_pending[series_id] = (expires_at, info)
         return info
     except Exception as e:
         logger.warning(f"获取剧集信息失败 {series_id}: {e}")
+        if entry:
+            # 获取失败时使用过期的缓存
+            return entry[1]
         return {"genres": [], "community_rating": None, "primary_image_tag": None, "tmdb_id": None}
 
 
-async def sync_user_history(user_id: str, db: AsyncSession) -> dict:
-    """同步单个用户的观看历史"""
-    added = 0
-    updated = 0
-
+async def _fetch_all_pages(
+    user_id: str,
+    page_size: int = 500,
+    stop: Optional[Callable[[list[EmbyMediaItem]], bool]] = None,
+    **query,
+) -> list[EmbyMediaItem]:
+    """
+    分页获取全部结果
+
+    先请求第一页拿到 TotalRecordCount，其余页在有限窗口内并发获取；
+    stop 返回 True 时不再获取后续窗口
+    """
+    first = await emby_service.get_items(user_id=user_id, start_index=0, limit=page_size, **query)
+    items = list(first.items)
+    if stop and stop(first.items):
+        return items
+
+    starts = list(range(page_size, first.total_count, page_size))
+    window = max(settings.sync_page_concurrency, 1)
+    for i in range(0, len(starts), window):
+        pages = await asyncio.gather(*(
+            emby_service.get_items(user_id=user_id, start_index=start, limit=page_size, **query)
+            for start in starts[i:i + window]
+        ))
+        for page in pages:
+            items.extend(page.items)
+        if stop and any(stop(page.items) for page in pages):
+            break
+
+    return items
+
+
+async def _fetch_played_by_date(user_id: str, item_type: str) -> list[EmbyMediaItem]:
+    """
+    按 DatePlayed 倒序获取有播放记录的项目（不依赖 IsPlayed 标记）
+
+    没有播放日期的项目排在最后，遇到后即可停止
+    """
     try:
-        # 分页获取所有已播放的电影
-        all_items_dict = {}
-
-        # 获取电影（分页）
-        start_index = 0
-        page_size = 500
-        while True:
-            movies_played = await emby_service.get_items(
-                user_id=user_id,
-                include_item_types="Movie",
-                is_played=True,
-                sort_by="DatePlayed",
-                sort_order="Descending",
-                start_index=start_index,
-                limit=page_size,
-            )
-            for item in movies_played.items:
-                all_items_dict[item.id] = item
+        return await _fetch_all_pages(
+            user_id,
+            stop=lambda items: any(not item.last_played_date for item in items),
+            include_item_types=item_type,
+            sort_by="DatePlayed",
+            sort_order="Descending",
+        )
+    except Exception as e:
+        logger.warning(f"获取按日期排序的 {item_type} 失败: {e}")
+        return []
+
+
+async def _fetch_all_played_items(user_id: str) -> dict:
+    """全量获取用户所有有播放记录的媒体（按 id 去重）"""
+    movies_played, episodes_played, resume_items, movies_by_date, episodes_by_date = await asyncio.gather(
+        # 已播放的电影和剧集
+        _fetch_all_pages(
+            user_id,
+            include_item_types="Movie",
+            is_played=True,
+            sort_by="DatePlayed",
+            sort_order="Descending",
+        ),
+        _fetch_all_pages(
+            user_id,
+            include_item_types="Episode",
+            is_played=True,
+            sort_by="DatePlayed",
+            sort_order="Descending",
+        ),
+        # 正在观看的
+        emby_service.get_resume_items(user_id=user_id, limit=100),
+        # 额外获取：按 DatePlayed 排序的所有有播放记录的项目
+        # 这可以捕获 302 直链播放时可能未正确标记 Played 状态的记录
+        _fetch_played_by_date(user_id, "Movie"),
+        _fetch_played_by_date(user_id, "Episode"),
+    )
 
-            if len(movies_played.items) < page_size:
-                break
-            start_index += page_size
+    all_items_dict = {}
+    for item in movies_played + episodes_played + resume_items:
+        all_items_dict[item.id] = item
 
-        # 获取剧集（分页）
-        start_index = 0
-        while True:
-            episodes_played = await emby_service.get_items(
-                user_id=user_id,
-                include_item_types="Episode",
-                is_played=True,
-                sort_by="DatePlayed",
-                sort_order="Descending",
-                start_index=start_index,
-                limit=page_size,
-            )
-            for item in episodes_played.items:
-                all_items_dict[item.id] = item
+    # 只添加有 LastPlayedDate 的项目
+    for item in movies_by_date + episodes_by_date:
+        if item.last_played_date and item.id not in all_items_dict:
+            all_items_dict[item.id] = item
 
-            if len(episodes_played.items) < page_size:
-                break
-            start_index += page_size
+    return all_items_dict
 
-        # 获取正在观看的
-        resume_items = await emby_service.get_resume_items(user_id=user_id, limit=100)
-        for item in resume_items:
-            all_items_dict[item.id] = item
 
-        # 额外获取：按 DatePlayed 排序的所有有播放记录的项目（不依赖 IsPlayed 标记）
-        # 这可以捕获 302 直链播放时可能未正确标记 Played 状态的记录
-        start_index = 0
-        while True:
-            try:
-                played_by_date = await emby_service.get_items(
-                    user_id=user_id,
-                    include_item_types="Movie",
-                    sort_by="DatePlayed",
-                    sort_order="Descending",
-                    start_index=start_index,
-                    limit=page_size,
-                )
-                # 只添加有 LastPlayedDate 的项目
-                for item in played_by_date.items:
-                    if item.last_played_date and item.id not in all_items_dict:
-                        all_items_dict[item.id] = item
-
-                if len(played_by_date.items) < page_size:
-                    break
-                start_index += page_size
-                # 限制最多获取 2000 条
-                if start_index >= 2000:
-                    break
-            except Exception as e:
-                logger.warning(f"获取按日期排序的电影失败: {e}")
-                break
+async def _fetch_played_items_since(user_id: str, since: datetime) -> dict:
+    """
+    增量获取 since 之后播放过的媒体
 
-        # 同样处理剧集
-        start_index = 0
-        while True:
-            try:
-                played_by_date = await emby_service.get_items(
-                    user_id=user_id,
-                    include_item_types="Episode",
-                    sort_by="DatePlayed",
-                    sort_order="Descending",
-                    start_index=start_index,
-                    limit=page_size,
-                )
-                for item in played_by_date.items:
-                    if item.last_played_date and item.id not in all_items_dict:
-                        all_items_dict[item.id] = item
-
-                if len(played_by_date.items) < page_size:
-                    break
-                start_index += page_size
-                if start_index >= 2000:
-                    break
-            except Exception as e:
-                logger.warning(f"获取按日期排序的剧集失败: {e}")
-                break
+    按 DatePlayed 倒序分页，遇到整页都早于 since 时停止
+    """
+    def is_newer(item: EmbyMediaItem) -> bool:
+        if not item.last_played_date:
+            return False
+        try:
+            return _parse_emby_date(item.last_played_date) > since
+        except ValueError:
+            return False
+
+    items, resume_items = await asyncio.gather(
+        _fetch_all_pages(
+            user_id,
+            page_size=200,
+            stop=lambda page: not any(is_newer(item) for item in page),
+            include_item_types="Movie,Episode",
+            sort_by="DatePlayed",
+            sort_order="Descending",
+        ),
+        # 正在观看的进度也可能变化
+        emby_service.get_resume_items(user_id=user_id, limit=100),
+    )
+
+    all_items_dict = {item.id: item for item in items if is_newer(item)}
+    for item in resume_items:
+        all_items_dict[item.id] = item
+
+    return all_items_dict
+
+
+async def _get_or_create_sync_status(user_id: str, db: AsyncSession) -> LibrarySyncStatus:
+    """获取用户的同步状态记录（不存在时创建）"""
+    result = await db.execute(
+        select(LibrarySyncStatus).where(LibrarySyncStatus.user_id == user_id)
+    )
+    status = result.scalar_one_or_none()
+    if not status:
+        status = LibrarySyncStatus(user_id=user_id, sync_status="idle")
+        db.add(status)
+    return status
+
+
+async def sync_user_history(user_id: str, db: AsyncSession, full: bool = False) -> dict:
+    """
+    同步单个用户的观看历史
+
+    默认只获取上次同步之后播放的记录（增量），超过全量对账间隔或 full=True 时全量同步
+    """
+    added = 0
+    updated = 0
+
+    try:
+        # 根据高水位决定增量或全量同步
+        status = await _get_or_create_sync_status(user_id, db)
+        high_water_mark = status.history_high_water_mark
+        now = datetime.utcnow()
+        incremental = (
+            not full
+            and high_water_mark is not None
+            and status.last_full_sync_at is not None
+            and now - status.last_full_sync_at < timedelta(hours=settings.sync_full_interval_hours)
+        )
+
+        if incremental:
+            # 留出少量重叠，避免边界上的记录被遗漏
+            since = high_water_mark - timedelta(minutes=5)
+            all_items_dict = await _fetch_played_items_since(user_id, since)
+        else:
+            all_items_dict = await _fetch_all_played_items(user_id)
 
         all_items = list(all_items_dict.values())
-        logger.info(f"用户 {user_id} 共发现 {len(all_items)} 个播放记录")
+        logger.info(f"用户 {user_id} {'增量' if incremental else '全量'}同步发现 {len(all_items)} 个播放记录")
         
-        for item in all_items:
-            existing = await db.execute(
-                select(WatchHistory).where(
-                    and_(
-                        WatchHistory.user_id == user_id,
-                        WatchHistory.emby_id == item.id
-                    )
+        # 一次性加载该用户已有的记录（按 emby_id 索引），避免逐条查询
+        existing_result = await db.execute(
+            select(
+                WatchHistory.id,
+                WatchHistory.emby_id,
+                WatchHistory.watch_progress,
+                WatchHistory.play_count,
+                WatchHistory.watched,
+                WatchHistory.watched_at,
+                WatchHistory.genres,
+                WatchHistory.community_rating,
+                WatchHistory.poster_path,
+                WatchHistory.tmdb_id,
+                WatchHistory.media_type,
+                WatchHistory.runtime_minutes,
+            ).where(
+                and_(
+                    WatchHistory.user_id == user_id,
+                    WatchHistory.emby_id.isnot(None),
                 )
             )
-            existing_record = existing.scalar_one_or_none()
+        )
+        existing_records = {row.emby_id: row for row in existing_result}
+        
+        # 批量补全缺少评分或类型的媒体信息（每批 100 个 ID）
+        needs_enrichment = [item for item in all_items if not item.community_rating or not item.genres]
+        await prefetch_series_info(
+            user_id,
+            [item.series_id for item in needs_enrichment if item.type == "Episode" and item.series_id],
+        )
+        enriched_items = {}
+        movie_ids = [item.id for item in needs_enrichment if not (item.type == "Episode" and item.series_id)]
+        if movie_ids:
+            try:
+                enriched_items = {
+                    full_item.id: full_item
+                    for full_item in await emby_service.get_items_by_ids(user_id, movie_ids)
+                }
+            except Exception as e:
+                logger.warning(f"批量获取媒体信息失败: {e}")
+        
+        new_rows = []
+        updated_rows = []
+        # 每日汇总的增量（移除旧观看时间，添加新观看时间）
+        rollup_removed = []
+        rollup_added = []
+        # 其他字段（类型、评分等）变化也会影响所在年份的年度回顾
+        review_years = set()
+        # 有新增或更新集的剧集，同步后重新计算追剧进度
+        touched_shows = set()
+        
+        for item in all_items:
+            existing_record = existing_records.get(item.id)
             
             # 计算进度
             progress = 0
@@ -172,7 +437,7 @@ async def sync_user_history(user_id: str, db: AsyncSession) -> dict:
             watched_at = None
             if item.last_played_date:
                 try:
-                    watched_at = datetime.fromisoformat(item.last_played_date.replace("Z", "+00:00"))
+                    watched_at = _parse_emby_date(item.last_played_date)
                 except:
                     pass
             if not watched_at:
@@ -215,9 +480,9 @@ async def sync_user_history(user_id: str, db: AsyncSession) -> dict:
                                 tmdb_id = int(series_info.get("tmdb_id"))
                             except (ValueError, TypeError):
                                 pass
-                    else:
-                        # 电影或其他类型，获取完整信息
-                        full_item = await emby_service.get_item(user_id, item.id)
+                    elif item.id in enriched_items:
+                        # 电影或其他类型，使用批量获取的完整信息
+                        full_item = enriched_items[item.id]
                         if not genres:
                             genres = full_item.genres or []
                         if not community_rating:
@@ -235,76 +500,121 @@ async def sync_user_history(user_id: str, db: AsyncSession) -> dict:
                     logger.warning(f"获取完整媒体信息失败 {item.id}: {e}")
             
             if existing_record:
-                needs_update = False
+                changes = {}
 
-                if abs(progress - existing_record.watch_progress) > 0.1:
-                    existing_record.watch_progress = progress
-                    needs_update = True
+                if abs(progress - (existing_record.watch_progress or 0)) > 0.1:
+                    changes["watch_progress"] = progress
 
-                if item.play_count > existing_record.play_count:
-                    existing_record.play_count = item.play_count
-                    needs_update = True
+                if item.play_count > (existing_record.play_count or 0):
+                    changes["play_count"] = item.play_count
 
                 if item.played != existing_record.watched:
-                    existing_record.watched = item.played
-                    needs_update = True
+                    changes["watched"] = item.played
 
                 if watched_at and item.last_played_date:
                     if not existing_record.watched_at or watched_at > existing_record.watched_at:
-                        existing_record.watched_at = watched_at
-                        existing_record.last_played_date = item.last_played_date
-                        needs_update = True
+                        changes["watched_at"] = watched_at
+                        changes["last_played_date"] = item.last_played_date
 
                 # 更新 genres 和 community_rating
                 if genres and (not existing_record.genres or existing_record.genres != genres):
-                    existing_record.genres = genres
-                    needs_update = True
+                    changes["genres"] = genres
 
                 if community_rating and existing_record.community_rating != community_rating:
-                    existing_record.community_rating = community_rating
-                    needs_update = True
+                    changes["community_rating"] = community_rating
 
                 # 更新 poster_path 和 tmdb_id（如果之前没有）
                 if poster_path and not existing_record.poster_path:
-                    existing_record.poster_path = poster_path
-                    needs_update = True
+                    changes["poster_path"] = poster_path
 
                 if tmdb_id and not existing_record.tmdb_id:
-                    existing_record.tmdb_id = tmdb_id
-                    needs_update = True
-
-                if needs_update:
-                    updated += 1
+                    changes["tmdb_id"] = tmdb_id
+
+                if changes:
+                    changes["id"] = existing_record.id
+                    updated_rows.append(changes)
+                    if item.type == "Episode":
+                        touched_shows.add(normalize_show_name(item.series_name))
+                    if "watched_at" in changes:
+                        rollup_removed.append((
+                            existing_record.watched_at, existing_record.media_type, existing_record.runtime_minutes
+                        ))
+                        rollup_added.append((
+                            changes["watched_at"], existing_record.media_type, existing_record.runtime_minutes
+                        ))
+                    elif existing_record.watched_at:
+                        review_years.add(existing_record.watched_at.year)
             else:
-                new_record = WatchHistory(
-                    user_id=user_id,
-                    emby_id=item.id,
-                    tmdb_id=tmdb_id,
-                    media_type=item.type,
-                    title=item.name,
-                    series_id=item.series_id,
-                    series_name=item.series_name,
-                    season_number=item.parent_index_number,
-                    episode_number=item.index_number,
-                    year=item.year,
-                    runtime_minutes=runtime_minutes,
-                    community_rating=community_rating,
-                    genres=genres,
-                    poster_path=poster_path,
-                    watched=item.played,
-                    watch_progress=progress,
-                    play_count=max(item.play_count, 1),
-                    watched_at=watched_at,
-                    last_played_date=item.last_played_date,
-                    source="emby",
-                )
-                db.add(new_record)
-                added += 1
+                if item.type == "Episode":
+                    touched_shows.add(normalize_show_name(item.series_name))
+                new_rows.append({
+                    "user_id": user_id,
+                    "emby_id": item.id,
+                    "tmdb_id": tmdb_id,
+                    "media_type": item.type,
+                    "title": item.name,
+                    "series_id": item.series_id,
+                    "series_name": item.series_name,
+                    "season_number": item.parent_index_number,
+                    "episode_number": item.index_number,
+                    "year": item.year,
+                    "runtime_minutes": runtime_minutes,
+                    "community_rating": community_rating,
+                    "genres": genres,
+                    "poster_path": poster_path,
+                    "watched": item.played,
+                    "watch_progress": progress,
+                    "play_count": max(item.play_count, 1),
+                    "watched_at": watched_at,
+                    "last_played_date": item.last_played_date,
+                    "source": "emby",
+                })
+        
+        # 新同步到的集不在已缓存的剧集结构中时，让进度页重新获取
+        new_episodes = defaultdict(set)
+        for row in new_rows:
+            if row["media_type"] == "Episode" and row["series_id"]:
+                new_episodes[row["series_id"]].add(row["emby_id"])
+        for series_id, episode_ids in new_episodes.items():
+            if not episode_ids <= get_cached_episode_ids(series_id):
+                invalidate_series(series_id)
+        
+        # 分批批量写入
+        for chunk in _chunked(new_rows, BULK_CHUNK_SIZE):
+            await db.execute(insert(WatchHistory), chunk)
+        for chunk in _chunked(updated_rows, BULK_CHUNK_SIZE):
+            await db.execute(update(WatchHistory), chunk)
+        rollup_added.extend((row["watched_at"], row["media_type"], row["runtime_minutes"]) for row in new_rows)
+        await apply_rollup_changes(db, user_id, added=rollup_added, removed=rollup_removed)
+        await invalidate_yearly_reviews(db, user_id, review_years)
+        added = len(new_rows)
+        updated = len(updated_rows)
+        
+        # 更新高水位（最新的播放时间）
+        for item in all_items:
+            if not item.last_played_date:
+                continue
+            try:
+                played_at = _parse_emby_date(item.last_played_date)
+            except ValueError:
+                continue
+            if high_water_mark is None or played_at > high_water_mark:
+                high_water_mark = played_at
+        status.history_high_water_mark = high_water_mark
+        if not incremental:
+            status.last_full_sync_at = now
         
         await db.commit()
         
-        # 清理缓存
-        _series_cache.clear()
+        # 保存新获取的剧集信息
+        await _flush_series_cache()
+        
+        # 更新涉及剧集的追剧进度
+        if touched_shows:
+            try:
+                await refresh_series_progress(db, user_id, show_keys=touched_shows)
+            except Exception as e:
+                logger.warning(f"更新用户 {user_id} 剧集进度失败: {e}")
         
     except Exception as e:
         await db.rollback()
@@ -314,7 +624,79 @@ async def sync_user_history(user_id: str, db: AsyncSession) -> dict:
     return {"added": added, "updated": updated}
 
 
-async def sync_all_users():
+async def _get_allowed_users() -> list[tuple[str, str]]:
+    """获取允许同步的 Emby 用户 (id, name) 列表"""
+    users = await emby_service.get_users()
+    
+    # 过滤允许的用户
+    allowed_ids = settings.allowed_emby_user_ids
+    if allowed_ids:
+        # 支持用户名和用户ID匹配，users 是字典列表
+        users = [u for u in users if u.get("Id") in allowed_ids or u.get("Name") in allowed_ids]
+    
+    return [
+        (
+            user.get("Id") if isinstance(user, dict) else user.Id,
+            user.get("Name") if isinstance(user, dict) else user.Name,
+        )
+        for user in users
+    ]
+
+
+async def _run_user_syncs(users: list[tuple[str, str]], worker) -> None:
+    """
+    以有限并发为每个用户执行同步
+
+    每个用户使用独立的数据库会话，单个用户失败不影响其他用户
+    """
+    semaphore = asyncio.Semaphore(max(settings.sync_max_concurrent_users, 1))
+    _sync_progress.update({
+        "total_users": len(users),
+        "completed_users": 0,
+        "failed_users": 0,
+        "running_users": [],
+        "started_at": datetime.utcnow().isoformat(),
+        "finished_at": None,
+    })
+    
+    async def run(user_id: str, user_name: str):
+        async with semaphore:
+            _sync_progress["running_users"].append(user_name)
+            try:
+                async with async_session_maker() as db:
+                    ok = await worker(user_id, user_name, db)
+            except Exception as e:
+                logger.error(f"用户 {user_name} 同步失败: {e}")
+                ok = False
+            finally:
+                _sync_progress["running_users"].remove(user_name)
+            _sync_progress["completed_users"] += 1
+            if not ok:
+                _sync_progress["failed_users"] += 1
+    
+    await asyncio.gather(*(run(user_id, user_name) for user_id, user_name in users))
+    _sync_progress["finished_at"] = datetime.utcnow().isoformat()
+
+
+async def refresh_counts_and_progress(user_id: str, db: AsyncSession, force: bool = False):
+    """
+    同步后刷新媒体库数量快照（概览统计直接读取）和追剧进度
+
+    剧集库的总集数有变化（或启动后首次同步）或 force 为 True 时重新计算所有剧集，
+    否则按指纹只重新计算观看记录有变化的剧集（手动添加、导入等非同步写入）
+    """
+    try:
+        previous = peek_library_counts(user_id)
+        counts = await refresh_library_counts(user_id)
+        if force or count_episodes(previous) != count_episodes(counts):
+            await refresh_all_series_progress(db, user_id)
+        else:
+            await refresh_series_progress(db, user_id)
+    except Exception as e:
+        logger.warning(f"用户 {user_id} 媒体库数量和追剧进度刷新失败: {e}")
+
+
+async def sync_all_users(full: bool = False):
     """同步所有允许的用户的观看历史和媒体库"""
     global _is_running
     
@@ -325,35 +707,31 @@ async def sync_all_users():
     _is_running = True
     logger.info("开始同步所有用户数据...")
     
-    try:
-        # 获取所有 Emby 用户
-        users = await emby_service.get_users()
+    async def worker(user_id: str, user_name: str, db: AsyncSession) -> bool:
+        ok = True
         
-        # 过滤允许的用户
-        allowed_ids = settings.allowed_emby_user_ids
-        if allowed_ids:
-            # 支持用户名和用户ID匹配，users 是字典列表
-            users = [u for u in users if u.get("Id") in allowed_ids or u.get("Name") in allowed_ids]
+        # 同步媒体库
+        try:
+            lib_result = await sync_user_libraries(user_id, db)
+            logger.info(f"用户 {user_name} 媒体库同步完成: {lib_result['synced']} 个")
+        except Exception as e:
+            logger.error(f"用户 {user_name} 媒体库同步失败: {e}")
+            ok = False
         
-        async with async_session_maker() as db:
-            for user in users:
-                user_id = user.get("Id") if isinstance(user, dict) else user.Id
-                user_name = user.get("Name") if isinstance(user, dict) else user.Name
-                
-                # 同步媒体库
-                try:
-                    lib_result = await sync_user_libraries(user_id, db)
-                    logger.info(f"用户 {user_name} 媒体库同步完成: {lib_result['synced']} 个")
-                except Exception as e:
-                    logger.error(f"用户 {user_name} 媒体库同步失败: {e}")
-                
-                # 同步观看历史
-                try:
-                    result = await sync_user_history(user_id, db)
-                    logger.info(f"用户 {user_name} 观看历史同步完成: 新增 {result['added']}, 更新 {result['updated']}")
-                except Exception as e:
-                    logger.error(f"用户 {user_name} 观看历史同步失败: {e}")
+        # 同步观看历史
+        try:
+            result = await sync_user_history(user_id, db, full=full)
+            logger.info(f"用户 {user_name} 观看历史同步完成: 新增 {result['added']}, 更新 {result['updated']}")
+        except Exception as e:
+            logger.error(f"用户 {user_name} 观看历史同步失败: {e}")
+            ok = False
         
+        await refresh_counts_and_progress(user_id, db)
+        return ok
+    
+    try:
+        users = await _get_allowed_users()
+        await _run_user_syncs(users, worker)
         logger.info("所有用户同步完成")
         
     except Exception as e:
@@ -362,6 +740,16 @@ async def sync_all_users():
         _is_running = False
 
 
+def is_sync_running() -> bool:
+    """是否有全量同步任务正在运行"""
+    return _is_running
+
+
+def get_sync_progress() -> dict:
+    """获取最近一次多用户同步的进度"""
+    return {**_sync_progress, "running_users": list(_sync_progress["running_users"])}
+
+
 async def scheduled_sync_task():
     """定时同步任务"""
     interval = settings.sync_interval_minutes
@@ -399,37 +787,96 @@ def stop_sync_scheduler():
         logger.info("同步调度器已停止")
 
 
+async def _fetch_library_index_rows(user_id: str, libraries: list) -> tuple[list[dict], set[str]]:
+    """
+    并发获取电影和剧集媒体库的全部条目，转换为索引行
+
+    返回 (索引行, 获取失败的媒体库 ID)，单个媒体库失败不影响其他媒体库
+    """
+    index_types = {"movies": "Movie", "tvshows": "Series"}
+    targets = [library for library in libraries if library.collection_type in index_types]
+    results = await asyncio.gather(*(
+        _fetch_all_pages(
+            user_id,
+            parent_id=library.id,
+            include_item_types=index_types[library.collection_type],
+        )
+        for library in targets
+    ), return_exceptions=True)
+    
+    rows = {}
+    failed = set()
+    for library, items in zip(targets, results):
+        if isinstance(items, Exception):
+            logger.warning(f"获取媒体库 {library.name} 条目失败: {items}")
+            failed.add(library.id)
+            continue
+        for item in items:
+            # 同一条目可能出现在多个媒体库中，只保留一条
+            rows.setdefault(item.id, {
+                "user_id": user_id,
+                "library_id": library.id,
+                "item_id": item.id,
+                "item_type": item.type,
+                "name": item.name,
+                "year": item.year,
+                "community_rating": item.community_rating,
+                "genres": item.genres,
+                "tmdb_id": item.provider_ids.get("Tmdb"),
+                "played": item.played,
+            })
+    return list(rows.values()), failed
+
+
+async def _fetch_library_item_count(user_id: str, library) -> int:
+    """获取媒体库中的项目数量，失败时使用媒体库列表中的数量"""
+    try:
+        if library.collection_type in ["movies", "tvshows", "music", "musicvideos", "homevideos"]:
+            # 获取实际数量
+            return await emby_service.count_items(
+                user_id=user_id,
+                parent_id=library.id,
+            )
+    except Exception as e:
+        logger.warning(f"获取媒体库 {library.name} 数量失败: {e}")
+    return library.item_count or 0
+
+
 async def sync_user_libraries(user_id: str, db: AsyncSession) -> dict:
-    """同步单个用户的媒体库信息"""
+    """
+    同步单个用户的媒体库信息
+
+    先从 Emby 获取全部数据，再在一个短事务中替换本地缓存，避免抓取期间长时间持有写锁
+    """
     synced = 0
     
     try:
-        # 获取用户的媒体库列表
+        # 获取用户的媒体库列表、条目索引和数量（此时还没有写入数据库）
         libraries = await emby_service.get_libraries(user_id)
+        (index_rows, failed_libraries), item_counts = await asyncio.gather(
+            _fetch_library_index_rows(user_id, libraries),
+            asyncio.gather(*(_fetch_library_item_count(user_id, library) for library in libraries)),
+        )
         
         # 删除该用户旧的缓存
         await db.execute(
             delete(LibraryCache).where(LibraryCache.user_id == user_id)
         )
         
-        for library in libraries:
-            # 获取媒体库中的项目数量
-            item_count = 0
-            try:
-                if library.collection_type in ["movies", "tvshows", "music", "musicvideos", "homevideos"]:
-                    # 获取实际数量
-                    items = await emby_service.get_items(
-                        user_id=user_id,
-                        parent_id=library.id,
-                        limit=1,
-                    )
-                    item_count = items.total_count
-                else:
-                    item_count = library.item_count or 0
-            except Exception as e:
-                logger.warning(f"获取媒体库 {library.name} 数量失败: {e}")
-                item_count = library.item_count or 0
-            
+        # 重建媒体库条目索引（年份分布、高分榜等统计直接查询本地），获取失败的媒体库保留旧的索引
+        await db.execute(
+            delete(LibraryItemIndex).where(
+                and_(
+                    LibraryItemIndex.user_id == user_id,
+                    LibraryItemIndex.library_id.notin_(failed_libraries),
+                )
+            )
+        )
+        for chunk in _chunked(index_rows, BULK_CHUNK_SIZE):
+            # 保留的旧索引中可能已有同一条目（同时属于多个媒体库）
+            await db.execute(sqlite_insert(LibraryItemIndex).on_conflict_do_nothing(), chunk)
+        
+        for library, item_count in zip(libraries, item_counts):
             # 创建缓存记录
             cache_record = LibraryCache(
                 user_id=user_id,
@@ -497,25 +944,19 @@ async def sync_all_libraries():
     """同步所有用户的媒体库信息"""
     logger.info("开始同步所有用户媒体库...")
     
+    async def worker(user_id: str, user_name: str, db: AsyncSession) -> bool:
+        try:
+            result = await sync_user_libraries(user_id, db)
+            logger.info(f"用户 {user_name} 媒体库同步完成: {result['synced']} 个媒体库")
+            await refresh_all_series_progress(db, user_id)
+            return True
+        except Exception as e:
+            logger.error(f"用户 {user_name} 媒体库同步失败: {e}")
+            return False
+    
     try:
-        # 获取所有 Emby 用户
-        users = await emby_service.get_users()
-        
-        # 过滤允许的用户
-        allowed_ids = settings.allowed_emby_user_ids
-        if allowed_ids:
-            users = [u for u in users if u.get("Id") in allowed_ids or u.get("Name") in allowed_ids]
-        
-        async with async_session_maker() as db:
-            for user in users:
-                user_id = user.get("Id") if isinstance(user, dict) else user.Id
-                user_name = user.get("Name") if isinstance(user, dict) else user.Name
-                try:
-                    result = await sync_user_libraries(user_id, db)
-                    logger.info(f"用户 {user_name} 媒体库同步完成: {result['synced']} 个媒体库")
-                except Exception as e:
-                    logger.error(f"用户 {user_name} 媒体库同步失败: {e}")
-        
+        users = await _get_allowed_users()
+        await _run_user_syncs(users, worker)
         logger.info("所有用户媒体库同步完成")
         
     except Exception as e:
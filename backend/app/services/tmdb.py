@@ -1,8 +1,109 @@
+import asyncio
 import httpx
-from typing import Optional
+import logging
+import random
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Optional
 from app.config import get_settings
+from app.services.cache import tmdb_cache
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# 进程级共享的 HTTP 客户端
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+class TokenBucket:
+    """令牌桶限流器（客户端侧控制 TMDB 请求速率）"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(capacity, 1)
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """获取一个令牌，返回等待的秒数"""
+        if self.rate <= 0:
+            return 0.0
+
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    delay = self._blocked_until - now
+                else:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    delay = (1 - self._tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        """服务端限流时暂停发放令牌"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+_rate_limiter = TokenBucket(settings.tmdb_rate_limit, settings.tmdb_rate_burst)
+# 批量获取详情时限制同时进行的请求数，配合令牌桶避免瞬间占满配额
+_fanout_semaphore = asyncio.Semaphore(max(settings.tmdb_max_concurrency, 1))
+# TMDB 变更列表最多可翻到的页数
+_TV_CHANGES_MAX_PAGES = 500
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取共享的 HTTP 客户端（未启动时延迟创建）"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=settings.tmdb_timeout,
+            limits=httpx.Limits(
+                max_connections=settings.tmdb_max_connections,
+                max_keepalive_connections=settings.tmdb_max_keepalive_connections,
+            ),
+        )
+    return _http_client
+
+
+async def start_tmdb_client():
+    """启动共享的 TMDB HTTP 客户端"""
+    get_http_client()
+    logger.info("TMDB HTTP 客户端已启动")
+
+
+async def close_tmdb_client():
+    """关闭共享的 TMDB HTTP 客户端"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        logger.info("TMDB HTTP 客户端已关闭")
+
+
+def _parse_retry_after(response: httpx.Response) -> Optional[float]:
+    """解析 Retry-After 响应头（秒数或 HTTP 日期）"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
 
 
 class TMDBService:
@@ -10,46 +111,160 @@ class TMDBService:
         self.base_url = settings.tmdb_base_url
         self.api_key = settings.tmdb_api_key
         self.image_base_url = settings.tmdb_image_base_url
+        # 请求与限流计数
+        self.stats = {
+            "requests": 0,
+            "throttled": 0,
+            "throttle_wait_seconds": 0.0,
+            "rate_limited": 0,
+            "server_errors": 0,
+            "retries": 0,
+            "failures": 0,
+        }
     
     def _check_config(self):
         """检查 TMDB API Key 是否配置"""
         if not self.api_key:
             raise ValueError("TMDB API Key 未配置")
     
+    def _backoff_delay(self, attempt: int) -> float:
+        """指数退避 + 随机抖动"""
+        return settings.tmdb_retry_backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+    
     async def _request(self, endpoint: str, params: dict = None) -> dict:
         self._check_config()
-        if params is None:
-            params = {}
+        params = dict(params or {})
         params["api_key"] = self.api_key
         params["language"] = "zh-CN"
         
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            url = f"{self.base_url}{endpoint}"
-            response = await client.get(url, params=params)
-            response.raise_for_status()
-            return response.json()
+        url = f"{self.base_url}{endpoint}"
+        attempt = 0
+        while True:
+            waited = await _rate_limiter.acquire()
+            if waited > 0:
+                self.stats["throttled"] += 1
+                self.stats["throttle_wait_seconds"] += waited
+            self.stats["requests"] += 1
+            
+            try:
+                response = await get_http_client().get(url, params=params)
+            except httpx.TransportError:
+                if attempt >= settings.tmdb_max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                delay = self._backoff_delay(attempt)
+            else:
+                if response.status_code == 429 or response.status_code >= 500:
+                    if response.status_code == 429:
+                        self.stats["rate_limited"] += 1
+                    else:
+                        self.stats["server_errors"] += 1
+                    if attempt >= settings.tmdb_max_retries:
+                        self.stats["failures"] += 1
+                        response.raise_for_status()
+                    delay = _parse_retry_after(response)
+                    if delay is None:
+                        delay = self._backoff_delay(attempt)
+                    if response.status_code == 429:
+                        # 服务端限流时让所有请求一起退避
+                        _rate_limiter.pause(delay)
+                else:
+                    response.raise_for_status()
+                    return response.json()
+            
+            attempt += 1
+            self.stats["retries"] += 1
+            logger.debug(f"TMDB 请求 {endpoint} 将在 {delay:.2f} 秒后重试（第 {attempt} 次）")
+            await asyncio.sleep(delay)
+    
+    async def _cached_request(
+        self,
+        endpoint: str,
+        params: dict = None,
+        ttl=None,
+        tmdb_id: Optional[int] = None,
+        media_type: Optional[str] = None,
+        force: bool = False,
+    ) -> dict:
+        """带缓存的请求（内存 LRU + MediaCache 表），force 为 True 时跳过缓存重新获取"""
+        if not settings.tmdb_cache_enabled:
+            return await self._request(endpoint, params)
+        self._check_config()
+        
+        params = dict(params or {})
+        query = "&".join(f"{k}={params[k]}" for k in sorted(params))
+        cache_key = f"zh-CN:{endpoint}?{query}"
+        return await tmdb_cache.get_or_fetch(
+            cache_key,
+            lambda: self._request(endpoint, params),
+            ttl if ttl is not None else settings.tmdb_cache_list_ttl,
+            tmdb_id=tmdb_id,
+            media_type=media_type,
+            force=force,
+        )
+    
+    @staticmethod
+    def _tv_show_ttl(data: dict) -> int:
+        """有下一集播出信息的剧集使用较短的缓存时间"""
+        if data.get("next_episode_to_air") or data.get("in_production"):
+            return settings.tmdb_cache_airing_ttl
+        return settings.tmdb_cache_detail_ttl
+    
+    def get_client_stats(self) -> dict:
+        """获取请求与限流计数"""
+        return {
+            **self.stats,
+            "throttle_wait_seconds": round(self.stats["throttle_wait_seconds"], 3),
+            "rate_limit": settings.tmdb_rate_limit,
+            "rate_burst": settings.tmdb_rate_burst,
+            "cache": tmdb_cache.get_stats(),
+        }
     
     async def get_movie(self, movie_id: int) -> dict:
         """获取电影详情"""
-        return await self._request(
+        return await self._cached_request(
             f"/movie/{movie_id}",
-            params={"append_to_response": "credits,videos,similar,recommendations"}
+            params={"append_to_response": "credits,videos,similar,recommendations"},
+            ttl=settings.tmdb_cache_detail_ttl,
+            tmdb_id=movie_id,
+            media_type="movie",
         )
     
-    async def get_tv_show(self, tv_id: int) -> dict:
+    async def get_tv_show(self, tv_id: int, force: bool = False) -> dict:
         """获取剧集详情"""
-        return await self._request(
+        return await self._cached_request(
             f"/tv/{tv_id}",
-            params={"append_to_response": "credits,videos,similar,recommendations"}
+            params={"append_to_response": "credits,videos,similar,recommendations"},
+            ttl=self._tv_show_ttl,
+            tmdb_id=tv_id,
+            media_type="tv",
+            force=force,
         )
     
+    async def get_tv_shows(self, tv_ids: Iterable[int], force: bool = False) -> dict[int, dict]:
+        """并发获取多个剧集详情（去重，失败的剧集不包含在结果中）"""
+        async def fetch(tv_id: int) -> Optional[dict]:
+            async with _fanout_semaphore:
+                try:
+                    return await self.get_tv_show(tv_id, force=force)
+                except Exception as e:
+                    logger.warning(f"获取剧集 {tv_id} 详情失败: {e}")
+                    return None
+        
+        unique_ids = list(dict.fromkeys(tv_ids))
+        results = await asyncio.gather(*(fetch(tv_id) for tv_id in unique_ids))
+        return {tv_id: data for tv_id, data in zip(unique_ids, results) if data is not None}
+    
     async def get_tv_season(self, tv_id: int, season_number: int) -> dict:
         """获取季详情"""
-        return await self._request(f"/tv/{tv_id}/season/{season_number}")
+        return await self._cached_request(f"/tv/{tv_id}/season/{season_number}", ttl=settings.tmdb_cache_airing_ttl)
     
     async def get_tv_episode(self, tv_id: int, season_number: int, episode_number: int) -> dict:
         """获取集详情"""
-        return await self._request(f"/tv/{tv_id}/season/{season_number}/episode/{episode_number}")
+        return await self._cached_request(
+            f"/tv/{tv_id}/season/{season_number}/episode/{episode_number}",
+            ttl=settings.tmdb_cache_airing_ttl,
+        )
     
     async def search_movie(self, query: str, page: int = 1, year: Optional[int] = None) -> dict:
         """搜索电影"""
@@ -71,58 +286,81 @@ class TMDBService:
     
     async def get_trending(self, media_type: str = "all", time_window: str = "week", page: int = 1) -> dict:
         """获取趋势内容"""
-        return await self._request(f"/trending/{media_type}/{time_window}", params={"page": page})
+        return await self._cached_request(f"/trending/{media_type}/{time_window}", params={"page": page})
     
     async def get_popular_movies(self, page: int = 1) -> dict:
         """获取热门电影"""
-        return await self._request("/movie/popular", params={"page": page})
+        return await self._cached_request("/movie/popular", params={"page": page})
     
     async def get_popular_tv(self, page: int = 1) -> dict:
         """获取热门剧集"""
-        return await self._request("/tv/popular", params={"page": page})
+        return await self._cached_request("/tv/popular", params={"page": page})
     
     async def get_now_playing_movies(self, page: int = 1) -> dict:
         """获取正在上映的电影"""
-        return await self._request("/movie/now_playing", params={"page": page})
+        return await self._cached_request("/movie/now_playing", params={"page": page})
     
     async def get_upcoming_movies(self, page: int = 1) -> dict:
         """获取即将上映的电影"""
-        return await self._request("/movie/upcoming", params={"page": page})
+        return await self._cached_request("/movie/upcoming", params={"page": page})
     
     async def get_top_rated_movies(self, page: int = 1) -> dict:
         """获取高分电影"""
-        return await self._request("/movie/top_rated", params={"page": page})
+        return await self._cached_request("/movie/top_rated", params={"page": page})
     
     async def get_top_rated_tv(self, page: int = 1) -> dict:
         """获取高分剧集"""
-        return await self._request("/tv/top_rated", params={"page": page})
+        return await self._cached_request("/tv/top_rated", params={"page": page})
     
     async def get_person(self, person_id: int) -> dict:
         """获取人物详情"""
-        return await self._request(
+        return await self._cached_request(
             f"/person/{person_id}",
-            params={"append_to_response": "combined_credits,images"}
+            params={"append_to_response": "combined_credits,images"},
+            ttl=settings.tmdb_cache_detail_ttl,
         )
     
     async def get_genres(self, media_type: str = "movie") -> dict:
         """获取类型列表"""
-        return await self._request(f"/genre/{media_type}/list")
+        return await self._cached_request(f"/genre/{media_type}/list", ttl=settings.tmdb_cache_detail_ttl)
     
     async def get_tv_on_the_air(self, page: int = 1) -> dict:
         """获取正在播出的剧集"""
-        return await self._request("/tv/on_the_air", params={"page": page})
+        return await self._cached_request("/tv/on_the_air", params={"page": page})
     
     async def get_tv_airing_today(self, page: int = 1) -> dict:
         """获取今日播出的剧集"""
-        return await self._request("/tv/airing_today", params={"page": page})
+        return await self._cached_request("/tv/airing_today", params={"page": page})
     
     async def discover_tv(self, params: dict = None) -> dict:
         """发现剧集（支持按日期筛选）"""
-        return await self._request("/discover/tv", params=params)
+        return await self._cached_request("/discover/tv", params=params)
     
     async def discover_movie(self, params: dict = None) -> dict:
         """发现电影（支持按日期筛选）"""
-        return await self._request("/discover/movie", params=params)
+        return await self._cached_request("/discover/movie", params=params)
+    
+    async def discover_movie_pages(self, params: dict, max_pages: int) -> tuple[list[dict], bool]:
+        """
+        获取 discover 电影的前 max_pages 页结果（第一页之后的分页并发获取）
+
+        返回按页顺序合并的结果，以及是否所有分页都获取成功
+        """
+        async def fetch(page: int) -> Optional[dict]:
+            async with _fanout_semaphore:
+                try:
+                    return await self.discover_movie({**params, "page": page})
+                except Exception as e:
+                    logger.warning(f"获取 discover 电影第 {page} 页失败: {e}")
+                    return None
+        
+        first = await self.discover_movie({**params, "page": 1})
+        total_pages = min(first.get("total_pages") or 1, max(max_pages, 1))
+        pages = [first]
+        if total_pages > 1:
+            pages.extend(await asyncio.gather(*(fetch(page) for page in range(2, total_pages + 1))))
+        results = [item for data in pages if data for item in data.get("results", [])]
+        return results, all(data is not None for data in pages)
     
     async def get_tv_changes(self, start_date: str = None, end_date: str = None, page: int = 1) -> dict:
         """获取剧集变更"""
@@ -133,33 +371,62 @@ class TMDBService:
             params["end_date"] = end_date
         return await self._request("/tv/changes", params=params)
     
+    async def get_tv_changed_ids(self, start_date: str, end_date: str = None) -> tuple[set[int], bool]:
+        """
+        获取 [start_date, end_date] 内有变更的所有剧集 ID（并发获取所有分页）
+
+        返回剧集 ID 以及变更列表是否完整（TMDB 最多返回 500 页）
+        """
+        async def fetch(page: int) -> dict:
+            async with _fanout_semaphore:
+                return await self.get_tv_changes(start_date=start_date, end_date=end_date, page=page)
+        
+        first = await fetch(1)
+        pages = [first]
+        total_pages = first.get("total_pages") or 1
+        complete = total_pages <= _TV_CHANGES_MAX_PAGES
+        if not complete:
+            logger.warning(
+                f"TMDB 剧集变更共 {total_pages} 页，超过 {_TV_CHANGES_MAX_PAGES} 页的部分无法获取"
+            )
+            total_pages = _TV_CHANGES_MAX_PAGES
+        if total_pages > 1:
+            pages.extend(await asyncio.gather(*(fetch(page) for page in range(2, total_pages + 1))))
+        changed = {
+            item["id"]
+            for data in pages
+            for item in data.get("results", [])
+            if item.get("id") is not None
+        }
+        return changed, complete
+    
     async def get_watch_providers(self, media_type: str, media_id: int) -> dict:
         """获取流媒体可用性"""
         return await self._request(f"/{media_type}/{media_id}/watch/providers")
     
     async def get_movie_recommendations(self, movie_id: int, page: int = 1) -> dict:
         """获取电影推荐"""
-        return await self._request(f"/movie/{movie_id}/recommendations", params={"page": page})
+        return await self._cached_request(f"/movie/{movie_id}/recommendations", params={"page": page}, ttl=settings.tmdb_cache_detail_ttl)
     
     async def get_tv_recommendations(self, tv_id: int, page: int = 1) -> dict:
         """获取剧集推荐"""
-        return await self._request(f"/tv/{tv_id}/recommendations", params={"page": page})
+        return await self._cached_request(f"/tv/{tv_id}/recommendations", params={"page": page}, ttl=settings.tmdb_cache_detail_ttl)
     
     async def get_movie_similar(self, movie_id: int, page: int = 1) -> dict:
         """获取相似电影"""
-        return await self._request(f"/movie/{movie_id}/similar", params={"page": page})
+        return await self._cached_request(f"/movie/{movie_id}/similar", params={"page": page}, ttl=settings.tmdb_cache_detail_ttl)
     
     async def get_tv_similar(self, tv_id: int, page: int = 1) -> dict:
         """获取相似剧集"""
-        return await self._request(f"/tv/{tv_id}/similar", params={"page": page})
+        return await self._cached_request(f"/tv/{tv_id}/similar", params={"page": page}, ttl=settings.tmdb_cache_detail_ttl)
     
     async def get_movie_keywords(self, movie_id: int) -> dict:
         """获取电影关键词"""
-        return await self._request(f"/movie/{movie_id}/keywords")
+        return await self._cached_request(f"/movie/{movie_id}/keywords", ttl=settings.tmdb_cache_detail_ttl)
     
     async def get_tv_keywords(self, tv_id: int) -> dict:
         """获取剧集关键词"""
-        return await self._request(f"/tv/{tv_id}/keywords")
+        return await self._cached_request(f"/tv/{tv_id}/keywords", ttl=settings.tmdb_cache_detail_ttl)
     
     async def discover_by_genre(self, media_type: str, genre_id: int, page: int = 1, sort_by: str = "popularity.desc") -> dict:
         """按类型发现内容"""
@@ -169,9 +436,9 @@ class TMDBService:
             "page": page,
         }
         if media_type == "movie":
-            return await self._request("/discover/movie", params=params)
+            return await self._cached_request("/discover/movie", params=params)
         else:
-            return await self._request("/discover/tv", params=params)
+            return await self._cached_request("/discover/tv", params=params)
     
     async def discover_by_year(self, media_type: str, year: int, page: int = 1, sort_by: str = "popularity.desc") -> dict:
         """按年份发现内容"""
@@ -181,10 +448,10 @@ class TMDBService:
         }
         if media_type == "movie":
             params["primary_release_year"] = year
-            return await self._request("/discover/movie", params=params)
+            return await self._cached_request("/discover/movie", params=params)
         else:
             params["first_air_date_year"] = year
-            return await self._request("/discover/tv", params=params)
+            return await self._cached_request("/discover/tv", params=params)
     
     async def discover_by_network(self, network_id: int, page: int = 1) -> dict:
         """按电视网络发现剧集"""
@@ -193,7 +460,7 @@ class TMDBService:
             "sort_by": "popularity.desc",
             "page": page,
         }
-        return await self._request("/discover/tv", params=params)
+        return await self._cached_request("/discover/tv", params=params)
     
     async def get_networks(self) -> dict:
         """获取电视网络列表（常用的）"""
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# 测试使用独立的临时数据库，必须在导入 app 之前设置
+_tmpdir = tempfile.mkdtemp(prefix="emby-tracker-test-")
+os.environ.setdefault("DATABASE_URL", f"sqlite+aiosqlite:///{_tmpdir}/test.db")
+os.environ.setdefault("SYNC_ON_STARTUP", "false")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,95 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from app.database import async_session_maker, init_db
+from app.models import AiringSchedule, LibrarySyncStatus
+from app.services import airing
+
+ENDED_SHOWS = {101, 102}
+
+
+class FakeTMDB:
+    def __init__(self, changed=frozenset(), complete=True):
+        self.changed = set(changed)
+        self.complete = complete
+        self.change_queries = []
+        self.forced = set()
+
+    async def get_tv_changed_ids(self, start_date, end_date=None):
+        self.change_queries.append((start_date, end_date))
+        return set(self.changed), self.complete
+
+    async def get_tv_shows(self, tmdb_ids, force=False):
+        if force:
+            self.forced |= set(tmdb_ids)
+        return {tmdb_id: {"name": f"Show {tmdb_id}", "in_production": False} for tmdb_id in tmdb_ids}
+
+
+async def _tracked(db):
+    return set(ENDED_SHOWS)
+
+
+async def _reset(mark):
+    await init_db()
+    now = datetime.utcnow()
+    async with async_session_maker() as db:
+        await db.execute(delete(AiringSchedule))
+        await db.execute(delete(LibrarySyncStatus).where(LibrarySyncStatus.user_id == airing._CHANGES_STATUS_KEY))
+        for tmdb_id in ENDED_SHOWS:
+            db.add(AiringSchedule(tmdb_id=tmdb_id, name="Ended", in_production=False, checked_at=now, updated_at=now))
+        if mark is not None:
+            db.add(LibrarySyncStatus(user_id=airing._CHANGES_STATUS_KEY, last_sync_at=mark))
+        await db.commit()
+
+
+async def _mark():
+    async with async_session_maker() as db:
+        result = await db.execute(
+            select(LibrarySyncStatus.last_sync_at).where(LibrarySyncStatus.user_id == airing._CHANGES_STATUS_KEY)
+        )
+        return result.scalar_one()
+
+
+def _run(monkeypatch, fake, mark):
+    monkeypatch.setattr(airing, "tmdb_service", fake)
+    monkeypatch.setattr(airing, "_get_tracked_tmdb_ids", _tracked)
+
+    async def run():
+        await _reset(mark)
+        await airing.refresh_airing_schedule()
+        return await _mark()
+
+    return asyncio.run(run())
+
+
+def test_missing_mark_skips_change_feed(monkeypatch):
+    fake = FakeTMDB(changed={101})
+    before = datetime.utcnow()
+    mark = _run(monkeypatch, fake, None)
+    assert fake.change_queries == []
+    assert fake.forced == set()
+    assert mark >= before - timedelta(seconds=1)
+
+
+def test_expired_mark_skips_change_feed(monkeypatch):
+    fake = FakeTMDB(changed={101})
+    _run(monkeypatch, fake, datetime.utcnow() - timedelta(days=20))
+    assert fake.change_queries == []
+
+
+def test_change_feed_queries_from_mark(monkeypatch):
+    fake = FakeTMDB(changed={101, 999})
+    previous = datetime.utcnow() - timedelta(hours=1)
+    mark = _run(monkeypatch, fake, previous)
+    now = datetime.utcnow()
+    assert fake.change_queries == [(previous.strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d"))]
+    assert fake.forced == {101}
+    assert mark > previous
+
+
+def test_incomplete_change_feed_refreshes_all_candidates(monkeypatch):
+    fake = FakeTMDB(changed={101}, complete=False)
+    _run(monkeypatch, fake, datetime.utcnow() - timedelta(hours=1))
+    assert fake.forced == ENDED_SHOWS
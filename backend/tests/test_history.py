@@ -0,0 +1,42 @@
+import asyncio
+
+import httpx
+from sqlalchemy import select
+
+from app.database import async_session_maker, init_db
+from app.main import app
+from app.models import WatchHistory
+
+
+async def _update_with_offset():
+    await init_db()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        resp = await client.post(
+            "/api/history/",
+            params={"user_id": "history-user"},
+            json={
+                "emby_id": "movie-1",
+                "media_type": "Movie",
+                "title": "Heat",
+                "watched_at": "2026-01-01T10:00:00",
+            },
+        )
+        assert resp.status_code == 200
+        history_id = resp.json()["id"]
+
+        resp = await client.put(
+            f"/api/history/{history_id}",
+            json={"watched_at": "2026-03-02T01:30:00+08:00"},
+        )
+        assert resp.status_code == 200
+
+    async with async_session_maker() as db:
+        record = (await db.execute(select(WatchHistory).where(WatchHistory.id == history_id))).scalar_one()
+    return record.watched_at
+
+
+def test_update_history_stores_naive_utc():
+    watched_at = asyncio.run(_update_with_offset())
+    assert watched_at.tzinfo is None
+    assert watched_at.isoformat() == "2026-03-01T17:30:00"
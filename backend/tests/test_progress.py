@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime
+
+import httpx
+
+from app.database import async_session_maker, init_db
+from app.main import app
+from app.models import WatchHistory
+from app.services import progress
+
+
+async def _fake_build_show_progress(user_id, show_data, watch_index):
+    return {
+        "series_id": show_data["primary_series_id"],
+        "series_name": show_data["series_name"],
+        "total_episodes": 10,
+        "watched_episodes": 1,
+        "progress": 10.0,
+    }
+
+
+async def _shows_before_first_sync():
+    await init_db()
+    async with async_session_maker() as db:
+        db.add(WatchHistory(
+            user_id="progress-user",
+            emby_id="ep-1",
+            media_type="Episode",
+            title="Pilot",
+            series_id="series-1",
+            series_name="Breaking Bad",
+            season_number=1,
+            episode_number=1,
+            watched=True,
+            watched_at=datetime(2026, 1, 1, 20, 0),
+        ))
+        await db.commit()
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        resp = await client.get("/api/progress/shows", params={"user_id": "progress-user"})
+    assert resp.status_code == 200
+    return resp.json()
+
+
+def test_shows_progress_is_built_before_first_sync(monkeypatch):
+    monkeypatch.setattr(progress, "build_show_progress", _fake_build_show_progress)
+    body = asyncio.run(_shows_before_first_sync())
+    assert body["total_count"] == 1
+    assert body["shows"][0]["series_name"] == "Breaking Bad"
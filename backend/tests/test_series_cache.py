@@ -0,0 +1,57 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from app.database import async_session_maker, init_db
+from app.models import SeriesMetadataCache
+from app.services import sync
+
+
+def _info(rating):
+    return {"genres": ["Drama"], "community_rating": rating, "primary_image_tag": None, "tmdb_id": "1396"}
+
+
+async def _flush_twice():
+    await init_db()
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+
+    sync._series_cache_pending["series-a"] = (expires_at, _info(8.0))
+    await sync._flush_series_cache()
+
+    # 第二批包含已存在的剧集和新剧集，冲突不应导致整批丢失
+    sync._series_cache_pending["series-a"] = (expires_at, _info(9.0))
+    sync._series_cache_pending["series-b"] = (expires_at, _info(7.5))
+    await sync._flush_series_cache()
+
+    async with async_session_maker() as db:
+        rows = (await db.execute(select(SeriesMetadataCache))).scalars().all()
+    return {row.series_id: row.community_rating for row in rows}
+
+
+def test_flush_series_cache_upserts_existing_rows():
+    ratings = asyncio.run(_flush_twice())
+    assert ratings["series-a"] == 9.0
+    assert ratings["series-b"] == 7.5
+
+
+async def _concurrent_load():
+    await init_db()
+    expires_at = datetime.utcnow() + timedelta(hours=1)
+    sync._series_cache_pending["series-c"] = (expires_at, _info(6.0))
+    await sync._flush_series_cache()
+
+    sync._series_cache.clear()
+    sync._series_cache_loaded = False
+
+    async def load_and_read():
+        await sync._ensure_series_cache_loaded()
+        return sync._series_cache.get("series-c")
+
+    return await asyncio.gather(load_and_read(), load_and_read())
+
+
+def test_concurrent_callers_wait_for_series_cache_load():
+    first, second = asyncio.run(_concurrent_load())
+    assert first is not None
+    assert second is not None
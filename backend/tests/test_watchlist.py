@@ -0,0 +1,33 @@
+import asyncio
+
+import httpx
+
+from app.database import init_db
+from app.main import app
+
+
+async def _add_and_remove():
+    await init_db()
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        resp = await client.post(
+            "/api/watchlist/",
+            json={"tmdb_id": 1396, "media_type": "tv", "title": "Breaking Bad"},
+        )
+        assert resp.status_code == 200
+        item_id = resp.json()["id"]
+
+        resp = await client.delete(f"/api/watchlist/{item_id}")
+        assert resp.status_code == 200
+        assert resp.json() == {"success": True}
+
+        resp = await client.get("/api/watchlist/")
+        assert resp.status_code == 200
+        assert all(item["id"] != item_id for item in resp.json())
+
+        resp = await client.delete(f"/api/watchlist/{item_id}")
+        assert resp.status_code == 404
+
+
+def test_add_then_remove_watchlist_item():
+    asyncio.run(_add_and_remove())